@@ -0,0 +1,126 @@
+# aggregation.py: Atom to residue (or custom group) aggregation operators for deriving pivots from atom pivots
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+
+# Resolutions that can be derived from a run's atom pivot (residue only when no residue pivot is stored)
+DERIVED_RESOLUTIONS = ["residue", "backbone", "sidechain"]
+# Protein backbone atoms, including terminal and glycine alpha hydrogen names of the common force fields
+BACKBONE_ATOM_NAMES = {'N', 'H', 'HN', 'H1', 'H2', 'H3', 'CA', 'HA', 'HA1', 'HA2', 'HA3', 'C', 'O', 'OXT', 'OC1', 'OC2', 'OT1', 'OT2'}
+# Frames summed per block, so aggregating a memory-mapped pivot never copies all of it at once
+AGGREGATION_FRAME_BLOCK = 1024
+
+class AtomAggregation:
+    """
+    A sparse atoms -> groups operator: every atom row of a pivot belongs to at most one group, and a group's value is
+    the sum of its atoms' values. Stored as the atom rows sorted by group plus the start of each group's run of rows,
+    so applying it is one gather and one np.add.reduceat per frame block (the product with the 0/1 aggregation
+    matrix without materialising the matrix).
+
+    Atom rows are positions in the atom pivot, whose rows follow the topology's atoms in atom number order.
+    """
+
+    def __init__(self, group_of_atom, labels, index_name):
+        """
+        :param group_of_atom: Group code (position in labels) of each atom row, -1 for atoms left out.
+        :param labels: The group labels, the index of the aggregated pivot.
+        :param index_name: Name of the aggregated pivot's index.
+        """
+        group_of_atom = np.asarray(group_of_atom, dtype=np.int64)
+        included = np.flatnonzero(group_of_atom >= 0)
+        self.rows = included[np.argsort(group_of_atom[included], kind='stable')]
+        sorted_groups = group_of_atom[self.rows]
+        present = np.r_[True, sorted_groups[1:] != sorted_groups[:-1]] if len(sorted_groups) else np.zeros(0, dtype=bool)
+        self.starts = np.flatnonzero(present)
+        # Groups without atoms are dropped from the result
+        self.labels = pd.Index(np.asarray(labels)[sorted_groups[self.starts]], name=index_name)
+        self.n_atoms = len(group_of_atom)
+
+    def apply(self, atom_pivot):
+        """
+        Sums the atom rows of a pivot into its groups.
+
+        :param atom_pivot: atoms x frames DataFrame with one row per topology atom.
+        :return: groups x frames DataFrame with the same frames.
+        """
+        if len(atom_pivot) != self.n_atoms:
+            raise ValueError(f"The atom pivot has {len(atom_pivot)} rows, the topology {self.n_atoms} atoms.")
+        values = atom_pivot.to_numpy()
+        aggregated = np.empty((len(self.labels), values.shape[1]), dtype=np.result_type(values.dtype, np.float64))
+        if len(self.labels):
+            for start in range(0, values.shape[1], AGGREGATION_FRAME_BLOCK):
+                block = values[self.rows, start:start + AGGREGATION_FRAME_BLOCK]
+                aggregated[:, start:start + AGGREGATION_FRAME_BLOCK] = np.add.reduceat(block, self.starts, axis=0)
+        return pd.DataFrame(aggregated, index=self.labels, columns=atom_pivot.columns.copy())
+
+def _topology_atoms(topology):
+    # Atom number order: the order of the atom pivot's rows
+    return np.flatnonzero(topology.atom_valid)
+
+def grouping_from_labels(topology, group_of_atom_number, index_name):
+    """
+    Builds a custom aggregation (e.g. secondary structure segments) from a group label per atom.
+
+    :param topology: A topology.Topology.
+    :param group_of_atom_number: Callable mapping the arrays (atom_numbers, atom_names, residue_numbers) to a group
+        label per atom; None or NaN labels leave the atom out.
+    :param index_name: Name of the aggregated pivot's index.
+    :return: An AtomAggregation.
+    """
+    atoms = _topology_atoms(topology)
+    labels = pd.Series(group_of_atom_number(atoms, topology.atom_name[atoms], topology.atom_residue_number[atoms]))
+    codes, uniques = pd.factorize(labels, sort=True)
+    return AtomAggregation(codes, uniques, index_name)
+
+def residue_segments(segments):
+    """
+    Group labels for grouping_from_labels from residue ranges, e.g. {'helix A': (5, 19), 'linker': (65, 92)}.
+    Residues outside every range are left out.
+    """
+    def label(atom_numbers, atom_names, residue_numbers):
+        labels = np.full(len(residue_numbers), None, dtype=object)
+        for name, (first, last) in segments.items():
+            labels[(residue_numbers >= first) & (residue_numbers <= last)] = name
+        return labels
+    return label
+
+@lru_cache(maxsize=32)
+def atom_aggregation(topology, grouping):
+    """
+    The aggregation operator of a derived resolution, built once per topology (topologies are themselves cached
+    per file version, see topology.load_topology).
+
+    :param topology: A topology.Topology.
+    :param grouping: 'residue' (all atoms of each residue), 'backbone' or 'sidechain' (the backbone or side chain
+        atoms of each residue); all are indexed by residue number.
+    :return: An AtomAggregation.
+    """
+    if grouping not in DERIVED_RESOLUTIONS:
+        raise ValueError(f"Invalid grouping. Choose one of {DERIVED_RESOLUTIONS}.")
+    atoms = _topology_atoms(topology)
+    residue_numbers = topology.atom_residue_number[atoms]
+    if grouping != "residue":
+        is_backbone = np.isin(topology.atom_name[atoms].astype(str), list(BACKBONE_ATOM_NAMES))
+        residue_numbers = np.where(is_backbone == (grouping == "backbone"), residue_numbers, -1)
+    labels = np.unique(residue_numbers[residue_numbers >= 0])
+    codes = np.where(residue_numbers >= 0, np.searchsorted(labels, residue_numbers), -1)
+    return AtomAggregation(codes, labels, 'residue')
+
+def aggregate_atoms(atom_pivot, topology, grouping):
+    """Derives a residue level pivot (see atom_aggregation) from an atom pivot."""
+    return atom_aggregation(topology, grouping).apply(atom_pivot)
+
+def add_derived_datasets(available_datasets):
+    """
+    Adds the derived resolutions of every run with an atom pivot to a dataset registration (see
+    data_handler.register_available_datasets). Stored residue pivots are kept; atom-only runs are added to them.
+
+    :return: A new registration dict.
+    """
+    available_datasets = dict(available_datasets)
+    for (resolution, category), run_nums in list(available_datasets.items()):
+        if resolution != "atom":
+            continue
+        for derived in DERIVED_RESOLUTIONS:
+            available_datasets[(derived, category)] = sorted(set(available_datasets.get((derived, category), [])) | set(run_nums))
+    return available_datasets
@@ -1,14 +1,26 @@
 # app.py: Main Application for Kinetic Energy Visualization
 import streamlit as st
 import streamlit.components.v1 as components
+import uuid
 import numpy as np
+from functools import partial
+from contextlib import contextmanager
 from PIL import Image
 
 # Placeholder imports (functions to be implemented in other modules later)
-from data_handler import register_available_datasets, load_dataset, normalize_per_frame
-from visualization import plot_histogram, render_heatmaps, plot_aa_distribution_by_frame_mid, plot_residue_category_distribution, show_frame_details
-from reorder_handler import reorder_data, construct_KE_pairs, add_residue_category
+from pivot_cache import get_cached_dataset, get_cached_reordering_scores, get_cached_threshold_table, get_cached_KE_bins, get_cached_histogram, get_cached_ensemble
+from ensemble import ensemble_values, ENSEMBLE_WEB_MAX_VALUES
+from transforms import as_chain, apply_transform_chain
+from histogram import compute_base_histogram, rebin_histogram
+from manifest_handler import register_datasets_from_manifest, get_manifest_version, get_dataset_metadata, start_manifest_watcher
+from aggregation import add_derived_datasets
+from out_of_core import is_out_of_core, DEFAULT_WINDOW_FRAMES
+from visualization import render_timing_panel, plot_histogram, plot_threshold_sensitivity, render_heatmaps, plot_aa_distribution_by_frame_mid, plot_residue_category_distribution, show_frame_details
+from reorder_handler import apply_reordering, construct_KE_pairs, add_residue_category
 from molvis import generate_ngl_viewer_html
+from topology import get_run_topology
+from prefetcher import get_frame_prefetcher
+from instrumentation import start_rerun_timings, finish_rerun_timings, current_rerun_timings, append_timing_log, timed, record_payload
 
 # Setting up Streamlit page config
 st.set_page_config(page_title="Kinetic Energy Visualization App", layout="wide", page_icon="favicon.ico")
@@ -18,9 +30,40 @@ logo = Image.open("icons/no_bg.png")
 def is_logged_in():
     return st.session_state.get('logged_in', False)
 
+@st.cache_resource
+def cached_manifest_watcher():
+    # One watcher per server process keeps the manifest current as pivots are added or changed
+    return start_manifest_watcher()
+
 @st.cache_data
-def cached_register_available_datasets():
-    return register_available_datasets()
+def cached_register_available_datasets(manifest_version):
+    # manifest_version only keys the cache: a rewritten manifest invalidates the registration
+    # Every run with an atom pivot can also be viewed at the resolutions derived from it
+    return add_derived_datasets(register_datasets_from_manifest())
+
+def describe_dataset(metadata):
+    if metadata is None:
+        return None
+    n_rows, n_frames = metadata['shape']
+    value_range = f", KE {metadata['value_min']:.3g} - {metadata['value_max']:.3g}" if metadata['value_min'] is not None else ""
+    return f"{n_rows} {metadata['index_name'] or 'rows'}s x {n_frames} frames ({metadata['frame_min']} - {metadata['frame_max']}){value_range}"
+
+# Sidebar labels of the ensemble statistics (see ensemble.py)
+ENSEMBLE_STATISTIC_LABELS = {
+    "Mean": 'mean',
+    "Median (approx.)": 'median',
+    "Standard Deviation": 'std',
+    "5% Quantile (approx.)": 'q05',
+    "25% Quantile (approx.)": 'q25',
+    "75% Quantile (approx.)": 'q75',
+    "95% Quantile (approx.)": 'q95',
+    "Number of Runs": 'count',
+}
+
+def get_display_chain(value_type, calculation_form):
+    # The transform chain of the values shown in the heatmaps and histogram
+    base_chain = as_chain('per_frame' if value_type == 'Per Frame Distribution' else 'raw')
+    return base_chain + ((('log',),) if calculation_form == 'Logarithmic KE' else ())
 
 def setup_sidebar():
     def toggle_info_button(info_name):
@@ -83,39 +126,71 @@ def setup_sidebar():
     # Dataset Selection
     st.sidebar.subheader("Select Datasets")
 
-    available_datasets = cached_register_available_datasets()
+    with timed("register datasets"):
+        cached_manifest_watcher()
+        available_datasets = cached_register_available_datasets(get_manifest_version())
     
-    resolution = dropdown_w_info(selectbox_text="Select Resolution", sbx_options_list=["residue", "atom"], info_message="Select the level of detail for the analysis: residue or atom.", sbx_type='selectbox', ib_counter=1)
+    resolution = dropdown_w_info(selectbox_text="Select Resolution", sbx_options_list=["residue", "atom", "backbone", "sidechain"], info_message="Select the level of detail for the analysis: residue or atom, or per residue sums of only the backbone or only the side chain atoms (derived from the atom data). Runs without residue data show the sum over their atoms.", sbx_type='selectbox', ib_counter=1)
 
     reference_category = dropdown_w_info(selectbox_text="Select Reference Run Category", sbx_options_list=["effective", "ineffective", "neutral"], info_message="Select the category of the reference run: effective, ineffective, or neutral.", sbx_type='selectbox')
 
     comparison_category = dropdown_w_info(selectbox_text="Select Comparison Run Category", sbx_options_list=["effective", "ineffective", "neutral"], info_message="Select the category of the comparison run: effective, ineffective, or neutral.", sbx_type='selectbox', index=2)
+
+    st.session_state['comparison_mode'] = comparison_mode = dropdown_w_info(selectbox_text="Select Comparison Mode", sbx_options_list=["Single Runs", "Category Ensembles"], info_message="Compare one reference run with one comparison run, or every run of the reference category with every run of the comparison category as populations (per residue/atom and frame statistics over the runs).", sbx_type='radio')
+    if comparison_mode == "Category Ensembles":
+        st.session_state['ensemble_statistic'] = st.sidebar.selectbox("Select Ensemble Statistic", list(ENSEMBLE_STATISTIC_LABELS), help='Statistic over the runs of each category shown in the heatmaps and histogram. The median and quantiles are approximated from per cell histograms.')
     
     reference_run = None
     comparison_run = None
+    reference_metadata = None
     reference_data = None
     comparison_data = None
 
+    comparison_metadata = None
     if (resolution, reference_category) in available_datasets:
         reference_run = st.sidebar.selectbox("Select Reference Run", available_datasets[(resolution, reference_category)], key="reference_run")
-        if reference_run:
-            try:
-                reference_data = load_dataset(reference_run, resolution, reference_category)
-            except Exception as e:
-                st.sidebar.write(f"Error loading reference dataset: {e}")
+        reference_metadata = get_dataset_metadata(reference_run, resolution, reference_category) if reference_run else None
+        if reference_metadata:
+            st.sidebar.caption(describe_dataset(reference_metadata))
     else:
         st.sidebar.write("No datasets found for the selected resolution and reference category.")
 
     if (resolution, comparison_category) in available_datasets:
         comparison_run = st.sidebar.selectbox("Select Comparison Run", available_datasets[(resolution, comparison_category)], key="comparison_run")
-        if comparison_run:
-            try:
-                comparison_data = load_dataset(comparison_run, resolution, comparison_category)
-            except Exception as e:
-                st.sidebar.write(f"Error loading comparison dataset: {e}")
+        comparison_metadata = get_dataset_metadata(comparison_run, resolution, comparison_category) if comparison_run else None
+        if comparison_metadata:
+            st.sidebar.caption(describe_dataset(comparison_metadata))
     else:
         st.sidebar.write("No datasets found for the selected resolution and comparison category.")
 
+    # Derived resolutions have no manifest entry of their own: their frames (and size) follow the run's atom pivot
+    if reference_run and reference_metadata is None:
+        reference_metadata = get_dataset_metadata(reference_run, "atom", reference_category)
+    if comparison_run and comparison_metadata is None:
+        comparison_metadata = get_dataset_metadata(comparison_run, "atom", comparison_category)
+
+    # Runs too large to load whole are opened as a frame window; scores over other frames stream through the store
+    frame_window = None
+    if reference_run and comparison_run and (is_out_of_core(reference_metadata) or is_out_of_core(comparison_metadata)):
+        st.sidebar.subheader("Frame Window")
+        first_frame = reference_metadata['frame_min'] if reference_metadata else 0
+        last_frame = reference_metadata['frame_max'] if reference_metadata else 200
+        frame_window = st.sidebar.slider("Select Frame Window", min_value=first_frame, max_value=last_frame, value=(first_frame, min(first_frame + DEFAULT_WINDOW_FRAMES - 1, last_frame)), step=1, key="frame_window_slider", help='These runs are too large to load whole: only the frames of this window are loaded and shown (heatmaps, histograms and KE pairs). Reordering scores still cover the frames selected below, read block by block.')
+    st.session_state['frame_window'] = frame_window
+
+    if reference_run:
+        try:
+            with timed("load reference"):
+                reference_data = get_cached_dataset(reference_run, resolution, reference_category, window=frame_window)
+        except Exception as e:
+            st.sidebar.write(f"Error loading reference dataset: {e}")
+    if comparison_run:
+        try:
+            with timed("load comparison"):
+                comparison_data = get_cached_dataset(comparison_run, resolution, comparison_category, window=frame_window)
+        except Exception as e:
+            st.sidebar.write(f"Error loading comparison dataset: {e}")
+
     calculation_form = dropdown_w_info(selectbox_text="Select Calculation Form", sbx_options_list=["Linear KE", "Logarithmic KE"], info_message="Select whether to display kinetic energy values linearly or logarithmically.", sbx_type='radio')
      
     st.session_state['reordering_option'] = reordering_option = dropdown_w_info(selectbox_text="Select Reordering Option", sbx_options_list=["Original Order", "Reordered by Persistence", "Reordered by Streak Length", "Reordered by Absolute Persistence"], info_message="Choose how to reorder residues: keep the original order, reorder by persistence score, or by the longest streak above a percentile threshold. The persistence score represents how consistently a residue remains above a given per-frame percentile across all frames, while streak length measures the longest continuous period a residue exceeds that percentile. Note the appearing sliders below if you choose a reordering option.", sbx_type='radio')
@@ -125,34 +200,52 @@ def setup_sidebar():
     # Add sliders for adjusting reordering thresholds
     if reordering_option != "Original Order":
         st.sidebar.subheader("Reordering Parameters")
-        frame_min = st.sidebar.slider("Select Minimum Frame", min_value=0, max_value=200, value=42, step=1, help='The minimum frame, above which, the persistance or streak length will be evaluated.')
-        frame_max = st.sidebar.slider("Select Maximum Frame", min_value=0, max_value=200, value=200, step=1, help='The maximum frame, below which, the persistance or streak length will be evaluated.')
+        # Frame bounds come from the reference run's manifest entry
+        first_frame = reference_metadata['frame_min'] if reference_metadata else 0
+        last_frame = reference_metadata['frame_max'] if reference_metadata else 200
+        frame_min = st.sidebar.slider("Select Minimum Frame", min_value=first_frame, max_value=last_frame, value=min(max(42, first_frame), last_frame), step=1, help='The minimum frame, above which, the persistance or streak length will be evaluated.')
+        frame_max = st.sidebar.slider("Select Maximum Frame", min_value=first_frame, max_value=last_frame, value=last_frame, step=1, help='The maximum frame, below which, the persistance or streak length will be evaluated.')
         if reordering_option != "Reordered by Absolute Persistence":
             threshold = st.sidebar.slider("Select Threshold Percentile", min_value=0, max_value=100, value=70, step=1, help='The minimum per frame percentile threshold for a frame to be included in the persistence score or streak length calculation for a residue.' )
     
-    norm_reference_data = normalize_per_frame(reference_data)
-    norm_comparison_data = normalize_per_frame(comparison_data)
-    if value_type == 'Per Frame Distribution':
-        reference_data = norm_reference_data
-        comparison_data = norm_comparison_data
-
-    if reordering_option != "Original Order":
-        if reordering_option != "Reordered by Absolute Persistence":
-            reference_data, comparison_data = reorder_data(reference_data, comparison_data, reordering_option, frame_min=frame_min, frame_max=frame_max, threshold=threshold)
-        else:
-            reference_data, comparison_data = reorder_data(reference_data, comparison_data, reordering_option, frame_min=frame_min, frame_max=frame_max, threshold=70)
-        
-    if calculation_form == 'Logarithmic KE':
-        reference_data = reference_data.applymap(lambda x: np.log10(x) if x > 0 else 0)
-        comparison_data = comparison_data.applymap(lambda x: np.log10(x) if x > 0 else 0)
+    # Per frame distributions come from the shared cache, so they are computed once per run for all sessions
+    with timed("per frame views"):
+        norm_reference_data = get_cached_dataset(reference_run, resolution, reference_category, 'per_frame', frame_window) if reference_data is not None else None
+        norm_comparison_data = get_cached_dataset(comparison_run, resolution, comparison_category, 'per_frame', frame_window) if comparison_data is not None else None
+    # Each view is a transform chain memoized per run in the shared cache, so switching views back and forth is free
+    base_chain = as_chain('per_frame' if value_type == 'Per Frame Distribution' else 'raw')
+    display_chain = get_display_chain(value_type, calculation_form)
+    if reference_data is not None and comparison_data is not None:
+        with timed("display views"):
+            reference_data = get_cached_dataset(reference_run, resolution, reference_category, display_chain, frame_window)
+            comparison_data = get_cached_dataset(comparison_run, resolution, comparison_category, display_chain, frame_window)
+
+        if reordering_option != "Original Order":
+            # Scores are computed on the linear values; the row order then applies to any view
+            with timed("reordering"):
+                scores = get_cached_reordering_scores(reference_run, resolution, reference_category, base_chain, reordering_option, frame_min, frame_max, threshold if reordering_option != "Reordered by Absolute Persistence" else 70, out_of_core=frame_window is not None)
+                reference_data, comparison_data = apply_reordering(reference_data, comparison_data, scores)
+            if reordering_option != "Reordered by Absolute Persistence":
+                render_threshold_sensitivity(reference_run, resolution, reference_category, base_chain, reordering_option, frame_min, frame_max, threshold, scores, frame_window is not None)
     
     return reference_data, comparison_data, resolution, reference_category, comparison_category, calculation_form, reordering_option, value_type, norm_reference_data, norm_comparison_data, reference_run, comparison_run
 
 
 # Function to render interactive range panels for histogram and heatmap syncing
 def render_range_panels(col4):
-    def ranges_updated():
-        st.session_state['ranges_updated'] = True
+    # Range edits are applied in widget callbacks, which run before the fragment reruns, so the histogram and heatmaps
+    # drawn below always see the current ranges without a second rerun
+    def add_range():
+        last_max = st.session_state['active_ranges'][-1]['max'] if st.session_state['active_ranges'] else 0.0
+        st.session_state['active_ranges'].append({'min': last_max + 0.1, 'max': last_max + 1.0})
+    def remove_range(idx):
+        del st.session_state['active_ranges'][idx]
+        # The panels after the removed one move up: their widgets start again from the stored ranges
+        for later_idx in range(idx, len(st.session_state['active_ranges']) + 1):
+            st.session_state.pop(f"range_min_{later_idx}", None)
+            st.session_state.pop(f"range_max_{later_idx}", None)
+    def update_range(idx, bound):
+        st.session_state['active_ranges'][idx][bound] = st.session_state[f"range_{bound}_{idx}"]
     if 'active_ranges' not in st.session_state:
         st.session_state['active_ranges'] = []
     # Histogram settings for bins and range
@@ -160,162 +253,253 @@ def render_range_panels(col4):
         st.write("#### Adjust Histogram Settings")
         bin_number_col, range_min_col, range_max_col = st.columns([1, 1, 1])
         with bin_number_col:
-            st.session_state['bin_number'] = st.number_input("#Bins", min_value=1, value=st.session_state.get('bin_number', 50), step=1, on_change=ranges_updated)
+            st.session_state['bin_number'] = st.number_input("#Bins", min_value=1, value=st.session_state.get('bin_number', 50), step=1)
         with range_min_col:
             active_range_min = (st.session_state['active_ranges'][0]['min'] if st.session_state['active_ranges'] else 4.7)
             plot_act_min = st.session_state.get('plot_range_min', 0.0)
-            st.session_state['plot_range_min'] = st.number_input("Plot Range Min", value=(plot_act_min if plot_act_min <= active_range_min else active_range_min), max_value=active_range_min, min_value=0.0, step=0.1, on_change=ranges_updated)
+            st.session_state['plot_range_min'] = st.number_input("Plot Range Min", value=(plot_act_min if plot_act_min <= active_range_min else active_range_min), max_value=active_range_min, min_value=0.0, step=0.1)
         with range_max_col:
             active_range_max = (max([r['max'] for r in st.session_state['active_ranges']]) if st.session_state['active_ranges'] else 0.3)
             plot_act_max = st.session_state.get('plot_range_max', 4.0)
-            st.session_state['plot_range_max'] = st.number_input("Plot Range Max", value=(plot_act_max if plot_act_max >= active_range_max else active_range_max), min_value=active_range_max, max_value=5.0, step=0.1, on_change=ranges_updated)
-    if 'active_ranges' not in st.session_state:
-        st.session_state['active_ranges'] = []
+            st.session_state['plot_range_max'] = st.number_input("Plot Range Max", value=(plot_act_max if plot_act_max >= active_range_max else active_range_max), min_value=active_range_max, max_value=5.0, step=0.1)
 
     # Button to add a new range (up to 2 allowed)
     if len(st.session_state['active_ranges']) < 2:
         with col4:
-            if st.button("Add Range", key="add_range_button", on_click=ranges_updated):
-                last_max = st.session_state['active_ranges'][-1]['max'] if st.session_state['active_ranges'] else 0.0
-                st.session_state['active_ranges'].append({'min': last_max + 0.1, 'max': last_max + 1.0})
-                st.session_state['ranges_updated'] = True
+            st.button("Add Range", key="add_range_button", on_click=add_range)
 
     # Render the panels for active ranges
-    to_remove = []
     for idx, range_data in enumerate(st.session_state['active_ranges']):
         with col4:
             st.write(f"### Range {idx + 1}")
         with col4:
             col1, col2, col3 = st.columns([1, 1, 1])
             with col1:
-                range_data['min'] = st.number_input(f"Min (Range {idx + 1})", value=range_data['min'], key=f"range_min_{idx}", min_value=0.0 if idx == 0 else st.session_state['active_ranges'][idx - 1]['max'], max_value=range_data['max']-0.1, format="%0.01f", step=0.1, on_change=ranges_updated)
+                range_data['min'] = st.number_input(f"Min (Range {idx + 1})", value=range_data['min'], key=f"range_min_{idx}", min_value=0.0 if idx == 0 else st.session_state['active_ranges'][idx - 1]['max'], max_value=range_data['max']-0.1, format="%0.01f", step=0.1, on_change=update_range, args=(idx, 'min'))
             with col2:
-                range_data['max'] = st.number_input(f"Max (Range {idx + 1})", value=range_data['max'], key=f"range_max_{idx}", min_value=range_data['min'] + 0.1, max_value=st.session_state['active_ranges'][idx + 1]['min'] if idx == 0 and len(st.session_state['active_ranges']) == 2 else 5.0, format="%0.01f", step=0.1, on_change=ranges_updated)
+                range_data['max'] = st.number_input(f"Max (Range {idx + 1})", value=range_data['max'], key=f"range_max_{idx}", min_value=range_data['min'] + 0.1, max_value=st.session_state['active_ranges'][idx + 1]['min'] if idx == 0 and len(st.session_state['active_ranges']) == 2 else 5.0, format="%0.01f", step=0.1, on_change=update_range, args=(idx, 'max'))
             with col3:
-                if st.button(f"Remove Range {idx + 1}", key=f"remove_range_button_{idx}", on_click=ranges_updated):
-                    to_remove.append(idx)
-
-    # Remove ranges if requested
-    for idx in reversed(to_remove):
-        del st.session_state['active_ranges'][idx]
+                st.button(f"Remove Range {idx + 1}", key=f"remove_range_button_{idx}", on_click=remove_range, args=(idx,))
 
     # Button to update the plots
     with col4:
-        st.button("Update Plots and Ranges", key="update_plots_button", on_click=ranges_updated)
-
-# Main visualization area
-def render_visualization(reference_data, comparison_data, resolution, reference_category, comparison_category, calculation_form, reordering_option, value_type, norm_reference_data, norm_comparison_data, KE_prc_threshold, reference_run, comparison_run):
-    if reference_data is None or comparison_data is None:
-        st.write("Error: Please select valid datasets for both the reference and comparison runs to visualize the results.")
+        st.button("Update Plots and Ranges", key="update_plots_button")
+
+def run_histograms(reference_run, comparison_run, resolution, reference_category, comparison_category, display_chain, frame_window, bin_number, plot_range_min, plot_range_max):
+    # Counts are binned on the server from each run's cached base histogram; reordering does not change them
+    reference_histogram = get_cached_histogram(reference_run, resolution, reference_category, display_chain, bin_number, plot_range_min, plot_range_max, frame_window)
+    comparison_histogram = get_cached_histogram(comparison_run, resolution, comparison_category, display_chain, bin_number, plot_range_min, plot_range_max, frame_window)
+    return reference_histogram, comparison_histogram
+
+def data_histograms(reference_data, comparison_data, bin_number, plot_range_min, plot_range_max):
+    # Histograms of values that have no cached base histogram (e.g. ensemble statistics)
+    reference_histogram = rebin_histogram(*compute_base_histogram(reference_data), bin_number, plot_range_min, plot_range_max)
+    comparison_histogram = rebin_histogram(*compute_base_histogram(comparison_data), bin_number, plot_range_min, plot_range_max)
+    return reference_histogram, comparison_histogram
+
+@contextmanager
+def fragment_run(name):
+    # A fragment is a span of the full run it is part of, or, when only the fragment reruns, a run of its own
+    if current_rerun_timings() is not None:
+        with timed(name):
+            yield
         return
-    
-    # Placeholder for visualization (to be implemented in visualization.py later)
-    st.write(f"### Visualization for Reference Run: {reference_category} vs Comparison Run: {comparison_category}")
-    st.write(f"Resolution: {resolution}")
-    st.write(f"Calculation Form: {calculation_form}, Reordering Option: {reordering_option}, Value Type: {value_type}")
-    
-    # Render synchronized heatmaps
-    col1 = st.columns(1)[0]
-    # heatmap_placeholder = col1.empty()
-
-    # Render histogram with interactive vertical range indicators
-    st.write("### Histogram of Values")
-    col3, col4 = st.columns(2)
-    histogram_placeholder = col3.empty()
-    st.write("## Select one of the bars in charts below to see detailed info on the range.") 
-    st.write("### Selection in the left graph takes precedence over right if both contain selections.")
-    col6, col7 = st.columns(2)
-    table1 = st.columns(1)[0]
-    col8, col9, col10 = st.columns([2,3,1])
-    # Render Pymol visualizations
-    col5 = st.columns(1)[0]
-
-    step_res = 5 #<---  Bad practice, should be interactive
-    KE_pairs = construct_KE_pairs(norm_reference_data, norm_comparison_data, step_res=step_res, KE_prc_threshold=KE_prc_threshold, resolution=resolution)
-    KE_pairs = add_residue_category(KE_pairs)
-    
-    # Render range panels for histogram and heatmap syncing in col4
-    render_range_panels(col4)
-    if st.session_state.get('ranges_updated', False):
-        st.session_state['ranges_updated'] = False
-        st.rerun()
-    with col3:
-        fig = plot_histogram(reference_data, comparison_data, value_type, st.session_state.get('bin_number', 50), st.session_state.get('plot_range_min', 0.0), st.session_state.get('plot_range_max', 1.0), key="histogram")
-    
-    with col1:
-        render_heatmaps(reference_data, comparison_data)
-
-    with col6:
-        clicked_bin_frame_mid1 = plot_aa_distribution_by_frame_mid(KE_pairs, KE_prc_threshold)
-    with col7:
-        clicked_bin_frame_mid2 = plot_residue_category_distribution(KE_pairs)
-    
-    with table1:
-        st.write(KE_pairs)
-
-    if clicked_bin_frame_mid1:
-        clicked_bin_frame_mid = clicked_bin_frame_mid1
-    elif clicked_bin_frame_mid2:
-        clicked_bin_frame_mid = clicked_bin_frame_mid2
-    else:
-        clicked_bin_frame_mid = None
-    if clicked_bin_frame_mid:
-        prev_clicked_frame = st.session_state.get('prev_clicked_frame', None)
-        if prev_clicked_frame != clicked_bin_frame_mid:
-            prev_clicked_frame = st.session_state['prev_clicked_frame'] = clicked_bin_frame_mid
-            act_cent_frame = st.session_state['act_cent_frame'] = clicked_bin_frame_mid
+    st.session_state['rerun_count'] = st.session_state.get('rerun_count', 0) + 1
+    start_rerun_timings(st.session_state.get('session_id'), st.session_state['rerun_count'], scope=name)
+    try:
+        with timed(name):
+            yield
+    finally:
+        append_timing_log(finish_rerun_timings())
+
+# Heatmaps and histogram: range, bin, pooling and zoom changes rerun only this fragment
+@st.fragment
+def render_heatmap_histogram_fragment(reference_data, comparison_data, value_type, compute_histograms):
+    with fragment_run("heatmaps and histogram"):
+        # Render synchronized heatmaps
+        col1 = st.columns(1)[0]
+
+        # Render histogram with interactive vertical range indicators
+        st.write("### Histogram of Values")
+        col3, col4 = st.columns(2)
+        # Render range panels for histogram and heatmap syncing in col4
+        render_range_panels(col4)
+        with col3:
+            bin_number, plot_range_min, plot_range_max = st.session_state.get('bin_number', 50), st.session_state.get('plot_range_min', 0.0), st.session_state.get('plot_range_max', 1.0)
+            with timed("histogram counts"):
+                reference_histogram, comparison_histogram = compute_histograms(bin_number, plot_range_min, plot_range_max)
+            plot_histogram(reference_histogram, comparison_histogram, value_type, plot_range_min, plot_range_max, key="histogram")
+
+        with col1, timed("heatmaps"):
+            render_heatmaps(reference_data, comparison_data)
+
+def render_threshold_sensitivity(run_num, resolution, category, base_chain, reordering_option, frame_min, frame_max, threshold, scores, out_of_core):
+    # Scores of every threshold are one cached table (the one the threshold slider reads), so the curve costs no extra pass
+    table = get_cached_threshold_table(run_num, resolution, category, base_chain, reordering_option, frame_min, frame_max, out_of_core)
+    if table is None or scores is None:
+        return
+    with st.sidebar.expander("Persistence vs Threshold", expanded=False):
+        default_rows = scores.sort_values(ascending=False).index[:5].tolist()
+        rows = st.multiselect(f"Select {resolution.capitalize()}s", table.index.tolist(), default=default_rows, key="sensitivity_rows", help='Residues/atoms whose score is drawn against the threshold percentile of the reference run. Defaults to the five highest scores at the selected threshold.')
+        if rows:
+            with timed("threshold sensitivity"):
+                plot_threshold_sensitivity(table, rows, threshold, reordering_option, container=st)
+
+# KE pair charts: bin width, top fraction and bar selections rerun only this fragment (and the viewer inside it)
+@st.fragment
+def render_KE_pairs_fragment(resolution, reference_category, comparison_category, norm_reference_data, norm_comparison_data, KE_prc_threshold, reference_run, comparison_run, frame_window=None):
+    with fragment_run("KE pairs"):
+        st.write("## Select one of the bars in charts below to see detailed info on the range.")
+        st.write("### Selection in the left graph takes precedence over right if both contain selections.")
+        ke_param_col1, ke_param_col2 = st.columns(2)
+        col6, col7 = st.columns(2)
+        table1 = st.columns(1)[0]
+
+        # KE pair parameters: binning runs on cumulative sums, so changing these is cheap even at atom resolution
+        with ke_param_col1:
+            step_res = st.number_input("Bin Width (frames)", min_value=1, max_value=len(norm_reference_data.columns), value=5, step=1, key="step_res", help='Number of frames averaged into one bin when picking the most excited residues/atoms.')
+        with ke_param_col2:
+            KE_prc_threshold = st.slider("Top KE Fraction", min_value=0.01, max_value=0.5, value=KE_prc_threshold, step=0.01, key="KE_prc_threshold", help='Fraction of residues/atoms with the highest mean KE in a bin that are kept for the comparison.')
+        with timed("KE bins"):
+            reference_bins = get_cached_KE_bins(reference_run, resolution, reference_category, step_res, KE_prc_threshold, frame_window)
+            comparison_bins = get_cached_KE_bins(comparison_run, resolution, comparison_category, step_res, KE_prc_threshold, frame_window)
+        with timed("KE pairs"):
+            KE_pairs = construct_KE_pairs(norm_reference_data, norm_comparison_data, step_res=step_res, KE_prc_threshold=KE_prc_threshold, resolution=resolution, reference_bins=reference_bins, comparison_bins=comparison_bins,
+                                          reference_topology=get_run_topology(reference_run, reference_category), comparison_topology=get_run_topology(comparison_run, comparison_category))
+        with timed("residue categories"):
+            KE_pairs = add_residue_category(KE_pairs)
+
+        with col6, timed("residue type chart"):
+            clicked_bin_frame_mid1 = plot_aa_distribution_by_frame_mid(KE_pairs, KE_prc_threshold)
+        with col7, timed("residue category chart"):
+            clicked_bin_frame_mid2 = plot_residue_category_distribution(KE_pairs)
+
+        with table1, timed("KE table"):
+            st.write(KE_pairs)
+
+        if clicked_bin_frame_mid1:
+            clicked_bin_frame_mid = clicked_bin_frame_mid1
+        elif clicked_bin_frame_mid2:
+            clicked_bin_frame_mid = clicked_bin_frame_mid2
         else:
-            act_cent_frame = st.session_state['act_cent_frame']
-        frame_start, frame_stop = show_frame_details(KE_pairs, act_cent_frame, col8, col9, col10)
+            clicked_bin_frame_mid = None
+        if clicked_bin_frame_mid:
+            if st.session_state.get('prev_clicked_frame', None) != clicked_bin_frame_mid:
+                # A new selection recentres the viewer; Prev/Next then page from there
+                st.session_state['prev_clicked_frame'] = clicked_bin_frame_mid
+                st.session_state['act_cent_frame'] = clicked_bin_frame_mid
+            render_structure_fragment(KE_pairs, reference_category, comparison_category, reference_run, comparison_run, step_res, int(norm_reference_data.columns.min()), int(norm_reference_data.columns.max()))
+
+# Structure viewer: Prev/Next and the frame mode rerun only the viewer
+@st.fragment
+def render_structure_fragment(KE_pairs, reference_category, comparison_category, reference_run, comparison_run, step_res, min_frame, max_frame):
+    def page_bins(step):
+        st.session_state['act_cent_frame'] += step
+    with fragment_run("structure viewer"):
+        col8, col9, col10 = st.columns([2,3,1])
+        # Render Pymol visualizations
+        col5 = st.columns(1)[0]
+        act_cent_frame = st.session_state['act_cent_frame']
+        with timed("frame details"):
+            frame_start, frame_stop = show_frame_details(KE_pairs, act_cent_frame, col8, col9, col10)
         with col5:
             subcol1, prev_b_place, frame_plc, next_b_place, subcol_ = st.columns([8,2,1,2,6], vertical_alignment='bottom')
             with subcol1:
-                video_sel = st.radio("Show 'real' frame or starting frame for structure", ['Starting frame (fast)', 'Real frame (loads for 5 sec)'], index=1, help='To load the middle frame of the selected bin, select the second option. This loads the entire trajectory for both simulations and will take a while. The first option shows the structural highlights on the starting frame', horizontal=True)
+                video_sel = st.radio("Show 'real' frame or starting frame for structure", ['Starting frame (fast)', 'Real frame'], index=1, help='To load the middle frame of the selected bin, select the second option. Only that frame is read from each trajectory (the first view of a trajectory indexes its frames once). The first option shows the structural highlights on the starting frame', horizontal=True)
             if video_sel == 'Starting frame (fast)':
                 molecule_2_url = molecule_1_url = "Calmod_sample.pdb"
             else:
                 molecule_1_url = f'./trajectories/pdb/{reference_category}/traj_{reference_run}.pdb'
                 molecule_2_url = f'./trajectories/pdb/{comparison_category}/traj_{comparison_run}.pdb'
-                # Place navigation buttons
-                # Define the step size and boundary conditions
-                col_len = len(norm_reference_data.columns)
-
+                # Place navigation buttons; paging is applied in their callbacks, before the viewer reruns
                 # Check bounds for "Prev Bin" button visibility
-                if clicked_bin_frame_mid - step_res >= 0:
+                if act_cent_frame - step_res >= min_frame:
                     with prev_b_place:
-                        prev_clicked = st.button("< Prev Bin")
-                else:
-                    prev_clicked = False
-                
+                        st.button("< Prev Bin", on_click=page_bins, args=(-step_res,))
+
                 with frame_plc:
                     st.write(f"{frame_start} - {frame_stop}")
                 # Check bounds for "Next Bin" button visibility
-                if clicked_bin_frame_mid + step_res <= col_len:
+                if act_cent_frame + step_res <= max_frame + 1:
                     with next_b_place:
-                        next_clicked = st.button("Next Bin >")
-                else:
-                    next_clicked = False
-
-                # Update clicked_bin_frame_mid based on button clicks
-                if prev_clicked:
-                    act_cent_frame -= step_res
-                elif next_clicked:
-                    act_cent_frame += step_res
-                st.session_state['act_cent_frame'] = act_cent_frame
-            html_code = generate_ngl_viewer_html(act_cent_frame, molecule_1_url, molecule_2_url, KE_pairs)
-            components.html(html_code, height=600)
-        
+                        st.button("Next Bin >", on_click=page_bins, args=(step_res,))
+            with timed("structure viewer"):
+                html_code = generate_ngl_viewer_html(act_cent_frame, molecule_1_url, molecule_2_url, KE_pairs)
+                record_payload('components.html', "ngl viewer", len(html_code.encode('utf-8')))
+                components.html(html_code, height=600)
+            if video_sel != 'Starting frame (fast)':
+                # Load the neighbouring bins of both runs in the background, so Prev/Next pages instead of loading
+                with timed("prefetch"):
+                    get_frame_prefetcher().prefetch([molecule_1_url, molecule_2_url], act_cent_frame, step_res, max_frame=max_frame)
 
+# Main visualization area
+def render_visualization(reference_data, comparison_data, resolution, reference_category, comparison_category, calculation_form, reordering_option, value_type, norm_reference_data, norm_comparison_data, KE_prc_threshold, reference_run, comparison_run):
+    if reference_data is None or comparison_data is None:
+        st.write("Error: Please select valid datasets for both the reference and comparison runs to visualize the results.")
+        return
+    
+    # Placeholder for visualization (to be implemented in visualization.py later)
+    st.write(f"### Visualization for Reference Run: {reference_category} vs Comparison Run: {comparison_category}")
+    st.write(f"Resolution: {resolution}")
+    st.write(f"Calculation Form: {calculation_form}, Reordering Option: {reordering_option}, Value Type: {value_type}")
 
+    # The datasets and views above come from the sidebar (a full rerun); each part below reruns on its own
+    frame_window = st.session_state.get('frame_window')
+    compute_histograms = partial(run_histograms, reference_run, comparison_run, resolution, reference_category, comparison_category, get_display_chain(value_type, calculation_form), frame_window)
+    render_heatmap_histogram_fragment(reference_data, comparison_data, value_type, compute_histograms)
+    render_KE_pairs_fragment(resolution, reference_category, comparison_category, norm_reference_data, norm_comparison_data, KE_prc_threshold, reference_run, comparison_run, frame_window)
+
+# Ensemble visualization: every run of the reference category against every run of the comparison category
+def render_ensemble_visualization(resolution, reference_category, comparison_category, calculation_form, value_type):
+    statistic_label = st.session_state['ensemble_statistic']
+    statistic = ENSEMBLE_STATISTIC_LABELS[statistic_label]
+    base_transform = 'per_frame' if value_type == 'Per Frame Distribution' else 'raw'
+    with st.spinner("Reducing the runs of both categories (only needed once per category)..."), timed("ensembles"):
+        reference_ensemble = get_cached_ensemble(resolution, reference_category, base_transform)
+        comparison_ensemble = get_cached_ensemble(resolution, comparison_category, base_transform)
+    if reference_ensemble is None or comparison_ensemble is None:
+        if max(ensemble_values(resolution, reference_category), ensemble_values(resolution, comparison_category)) > ENSEMBLE_WEB_MAX_VALUES:
+            st.write("Error: These ensembles are too large to compute in the app. Precompute them with `python ensemble.py`.")
+        else:
+            st.write("Error: Both categories need at least one run at the selected resolution for an ensemble comparison.")
+        return
+
+    st.write(f"### Ensemble {statistic_label} for Reference Category: {reference_category} ({len(reference_ensemble['runs'])} runs) vs Comparison Category: {comparison_category} ({len(comparison_ensemble['runs'])} runs)")
+    st.write(f"Resolution: {resolution}")
+    st.write(f"Calculation Form: {calculation_form}, Value Type: {value_type}")
+    reference_data = reference_ensemble[statistic]
+    comparison_data = comparison_ensemble[statistic]
+    if calculation_form == 'Logarithmic KE':
+        reference_data = apply_transform_chain(reference_data, 'log10')
+        comparison_data = apply_transform_chain(comparison_data, 'log10')
+
+    render_heatmap_histogram_fragment(reference_data, comparison_data, value_type, partial(data_histograms, reference_data, comparison_data))
 
 # Main function to run the Streamlit app
 def main():
     if 'active_ranges' not in st.session_state:
         st.session_state['active_ranges'] = []
-    reference_data, comparison_data, resolution, reference_category, comparison_category, calculation_form, reordering_option, value_type, norm_reference_data, norm_comparison_data, reference_run, comparison_run = setup_sidebar()
-    
-    # Render visualizations
-    render_visualization(reference_data, comparison_data, resolution, reference_category, comparison_category, calculation_form, reordering_option, value_type, norm_reference_data, norm_comparison_data, KE_prc_threshold=0.1,  reference_run=reference_run, comparison_run=comparison_run)
+    # Every rerun is timed stage by stage and logged under the session's ID (see instrumentation.py)
+    if 'session_id' not in st.session_state:
+        st.session_state['session_id'] = uuid.uuid4().hex
+    st.session_state['rerun_count'] = st.session_state.get('rerun_count', 0) + 1
+    start_rerun_timings(st.session_state['session_id'], st.session_state['rerun_count'])
+    try:
+        with timed("sidebar"):
+            reference_data, comparison_data, resolution, reference_category, comparison_category, calculation_form, reordering_option, value_type, norm_reference_data, norm_comparison_data, reference_run, comparison_run = setup_sidebar()
+
+        # Render visualizations
+        if st.session_state['comparison_mode'] == "Category Ensembles":
+            with timed("ensemble visualization"):
+                render_ensemble_visualization(resolution, reference_category, comparison_category, calculation_form, value_type)
+        else:
+            with timed("visualization"):
+                render_visualization(reference_data, comparison_data, resolution, reference_category, comparison_category, calculation_form, reordering_option, value_type, norm_reference_data, norm_comparison_data, KE_prc_threshold=0.1,  reference_run=reference_run, comparison_run=comparison_run)
+    finally:
+        # Also logged when the run is cut short by an error
+        record = finish_rerun_timings()
+        append_timing_log(record)
+    render_timing_panel(record)
         
 
 if __name__ == "__main__":
@@ -1,65 +1,176 @@
 import bcrypt
 import sqlite3
 import os
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 
 # Define the file to store user data
 DB_FILE = 'user_data.db'
 
-# Initialize the SQLite database
-def initialize_user_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+# Connections kept open per database file, shared by all sessions of the server process
+POOL_SIZE = 8
+# Seconds a connection waits for another writer's lock before giving up
+BUSY_TIMEOUT_S = 5.0
+# Schema migrations, in order: migration i brings a database from PRAGMA user_version i to i + 1
+MIGRATIONS = [
+    '''CREATE TABLE IF NOT EXISTS users (
                         username TEXT PRIMARY KEY,
-                        password TEXT NOT NULL)''')
-    conn.commit()
-    conn.close()
+                        password TEXT NOT NULL)''',
+]
+
+# bcrypt work factor, and the threads hashing passwords (bcrypt releases the GIL, so they hash in parallel)
+BCRYPT_ROUNDS = 12
+HASH_WORKERS = min(4, os.cpu_count() or 1)
+
+def migrate_user_db(conn):
+    """
+    Brings a database to the latest schema, running each migration it has not seen yet once.
+    The version check and the migrations share one write transaction, so concurrent processes migrate only once.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for target, statement in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {target}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+class ConnectionPool:
+    """
+    A bounded pool of SQLite connections to one database file in WAL mode, so readers never wait for a writer.
+    Connections are created on demand up to `size`; callers beyond that wait for a connection to be returned.
+    """
+
+    def __init__(self, db_file, size=POOL_SIZE):
+        self.db_file = db_file
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        with self.connection() as conn:
+            migrate_user_db(conn)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=BUSY_TIMEOUT_S, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # With WAL, syncing at checkpoints only is still safe against application crashes
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
 
+    @contextmanager
+    def connection(self):
+        """Lends a connection; its transaction is committed on success and rolled back on an error."""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            conn = self._connect() if create else self._idle.get()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._idle.put(conn)
 
-    
+    def close(self):
+        """Closes the idle connections (all of them once every lent connection has been returned)."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_connection_pool(db_file=None):
+    """The process-wide pool of a database file (DB_FILE by default), created and migrated on first use."""
+    db_file = db_file if db_file is not None else DB_FILE
+    path = os.path.abspath(db_file)
+    with _pools_lock:
+        if path not in _pools:
+            _pools[path] = ConnectionPool(path)
+        return _pools[path]
+
+def close_connection_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+_hash_executor = None
+_hash_lock = threading.Lock()
+
+def _run_bcrypt(func, *args):
+    # Runs a bcrypt call on the shared worker threads, so no more than HASH_WORKERS hashes compete for the CPU however
+    # many sessions log in at once; the calling session waits for its own hash only, while the GIL is released
+    global _hash_executor
+    with _hash_lock:
+        if _hash_executor is None:
+            _hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='bcrypt')
+    return _hash_executor.submit(func, *args).result()
+
+# Initialize the SQLite database
+def initialize_user_db():
+    get_connection_pool()
 
 # Register a new user
 def register_user(username, password):
-    initialize_user_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
+    pool = get_connection_pool()
+
     # Check if the user already exists
-    cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-    if cursor.fetchone() is not None:
-        conn.close()
+    with pool.connection() as conn:
+        if conn.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone() is not None:
+            return False, "Username already exists."
+
+    # Hash the password (without holding a connection) and store it
+    hashed_password = _run_bcrypt(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    try:
+        with pool.connection() as conn:
+            conn.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, hashed_password.decode('utf-8')))
+    except sqlite3.IntegrityError:
+        # Registered by another session while hashing
         return False, "Username already exists."
-    
-    # Hash the password and store it
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-    cursor.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, hashed_password))
-    conn.commit()
-    conn.close()
-    
+
     return True, "User registered successfully."
 
-# Verify user credentials for login
-def login_user(username, password):
-    initialize_user_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # Check if the user exists
-    cursor.execute('SELECT password FROM users WHERE username = ?', (username,))
-    result = cursor.fetchone()
-    conn.close()
-    
+def verify_credentials(username, password):
+    """
+    Checks a username and password against the database without touching the session.
+
+    Returns:
+        tuple: (success, message) as login_user returns them.
+    """
+    with get_connection_pool().connection() as conn:
+        result = conn.execute('SELECT password FROM users WHERE username = ?', (username,)).fetchone()
+
     if result is None:
         return False, "Username does not exist."
-    
-    hashed_password = result[0].encode('utf-8')
-    if bcrypt.checkpw(password.encode('utf-8'), hashed_password):
+
+    if _run_bcrypt(bcrypt.checkpw, password.encode('utf-8'), result[0].encode('utf-8')):
+        return True, "Login successful."
+    return False, "Incorrect password."
+
+# Verify user credentials for login
+def login_user(username, password):
+    success, message = verify_credentials(username, password)
+    if success:
         st.session_state['logged_in'] = True
         st.session_state['username'] = username
-        return True, "Login successful."
-    else:
-        return False, "Incorrect password."
+    return success, message
 
 # Logout the current user
 def logout_user():
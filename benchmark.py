@@ -0,0 +1,284 @@
+# benchmark.py: Timings of the analysis hot paths on synthetic pivots and of concurrent logins, written as JSON to compare revisions
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import threading
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import molvis
+import auth_handler
+from data_handler import load_dataset, normalize_per_frame
+from reorder_handler import reorder_data, construct_KE_pairs, add_residue_category
+from pivot_store import get_store_path, write_pivot_store
+from topology import Topology
+
+# Pivot shapes (rows x frames); 'shipped' is the size of the atom pivots in pivots/
+SCALES = {
+    'shipped': (2_300, 200),
+    'medium': (10_000, 1_000),
+    'large': (30_000, 3_000),
+    'xlarge': (100_000, 10_000),
+}
+DEFAULT_SCALES = ['shipped', 'medium']
+REORDERING_OPTIONS = ["Reordered by Persistence", "Reordered by Streak Length", "Reordered by Absolute Persistence"]
+# Sidebar defaults
+FRAME_MIN = 42
+THRESHOLD = 70
+STEP_RES = 5
+KE_PRC_THRESHOLD = 0.1
+ATOMS_PER_RESIDUE = 15
+# The structure viewer only ever parses a single frame; PDB numbering limits the synthetic structure's size
+PDB_MAX_ATOMS = 99_999
+PDB_MAX_RESIDUES = 9_999
+RUN_NUMBERS = ('9001', '9002')
+CATEGORY = 'effective'
+# Sessions logging in at the same time, and logins per session
+LOGIN_CONCURRENCY = [1, 8, 32]
+LOGINS_PER_SESSION = 4
+
+def make_synthetic_pivot(n_rows, n_frames, resolution='atom', seed=0):
+    """
+    A pivot shaped like the shipped ones: rows are atom (or residue) numbers, columns the integer frames, values
+    positive KE with a heavy tail and a per row baseline, so persistence and top sets are not uniform noise.
+
+    Returns:
+        pd.DataFrame: n_rows x n_frames float64 pivot.
+    """
+    rng = np.random.default_rng(seed)
+    baseline = rng.gamma(2.0, 0.5, size=(n_rows, 1))
+    values = rng.standard_gamma(2.0, size=(n_rows, n_frames)) * baseline
+    index = pd.Index(np.arange(1, n_rows + 1), name='atom' if resolution == 'atom' else 'residue')
+    columns = pd.Index(np.arange(n_frames), name='frame')
+    return pd.DataFrame(values, index=index, columns=columns)
+
+def make_synthetic_topology(n_atoms):
+    """An aa_map style atom table for atoms 1..n_atoms, ATOMS_PER_RESIDUE atoms per residue."""
+    atom_numbers = np.arange(1, n_atoms + 1)
+    return Topology(pd.DataFrame({
+        'atom_number': atom_numbers,
+        'atom_name': 'CA',
+        'residue_number': (atom_numbers - 1) // ATOMS_PER_RESIDUE + 1,
+        'residue_three_letter': 'ALA',
+        'residue_one_letter': 'A',
+    }))
+
+def write_synthetic_trajectory(path, n_atoms, n_models=2):
+    """Writes a multi-model PDB trajectory of (at most PDB_MAX_ATOMS) CA atoms on a line."""
+    n_atoms = min(n_atoms, PDB_MAX_ATOMS)
+    lines = []
+    for model in range(n_models):
+        lines.append(f"MODEL {model + 1:8d}")
+        for atom in range(n_atoms):
+            residue = min(atom // ATOMS_PER_RESIDUE + 1, PDB_MAX_RESIDUES)
+            lines.append(f"ATOM  {atom + 1:5d}  CA  ALA A{residue:4d}    {atom * 0.1 % 999:8.3f}{model:8.3f}{0.0:8.3f}  1.00  0.00           C")
+        lines.extend(["TER", "ENDMDL"])
+    Path(path).write_text("\n".join(lines) + "\n")
+
+def time_call(func, repeat, setup=None):
+    """
+    Times func() repeat times (setup() runs untimed before each call).
+
+    Returns:
+        dict: min, median and mean seconds and the number of repeats.
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {'min': min(timings), 'median': float(np.median(timings)), 'mean': float(np.mean(timings)), 'repeat': repeat}
+
+def benchmark_scale(n_rows, n_frames, repeat, workdir):
+    """
+    Times every hot path on one pivot shape. workdir becomes the working directory, since load_dataset reads
+    pivots/ relative to it.
+
+    Returns:
+        dict: Benchmark name -> timing (see time_call).
+    """
+    results = {}
+    reference = make_synthetic_pivot(n_rows, n_frames, seed=1)
+    comparison = make_synthetic_pivot(n_rows, n_frames, seed=2)
+    os.chdir(workdir)
+    for run_num, pivot in zip(RUN_NUMBERS, (reference, comparison)):
+        pickle_path = Path("pivots") / "atom" / CATEGORY / f"data_pivot_{run_num}.pckl"
+        pickle_path.parent.mkdir(parents=True, exist_ok=True)
+        pivot.to_pickle(pickle_path)
+
+    # The pickle path, then the memory-mapped store (which load_dataset prefers), read in full
+    results['load_dataset[pickle]'] = time_call(lambda: load_dataset(RUN_NUMBERS[0], 'atom', CATEGORY), repeat)
+    write_pivot_store(reference, get_store_path(RUN_NUMBERS[0], 'atom', CATEGORY))
+    results['load_dataset[store]'] = time_call(lambda: float(load_dataset(RUN_NUMBERS[0], 'atom', CATEGORY).to_numpy().sum()), repeat)
+
+    results['normalize_per_frame'] = time_call(lambda: normalize_per_frame(reference), repeat)
+    frame_max = n_frames - 1
+    for option in REORDERING_OPTIONS:
+        results[f'reorder_data[{option}]'] = time_call(lambda: reorder_data(reference, comparison, option, FRAME_MIN, frame_max, THRESHOLD), repeat)
+
+    norm_reference, norm_comparison = normalize_per_frame(reference), normalize_per_frame(comparison)
+    topology = make_synthetic_topology(n_rows)
+    construct = lambda: construct_KE_pairs(norm_reference, norm_comparison, STEP_RES, KE_PRC_THRESHOLD, 'atom', reference_topology=topology, comparison_topology=topology)
+    results['construct_KE_pairs'] = time_call(construct, repeat)
+    KE_pairs = construct()
+    results['add_residue_category'] = time_call(lambda: add_residue_category(KE_pairs.copy()), repeat)
+
+    # Cold (frame parsed and published) and warm (frame cache hit) viewer HTML
+    KE_pairs = add_residue_category(KE_pairs)
+    trajectories = [Path(workdir) / f"traj_{run_num}.pdb" for run_num in RUN_NUMBERS]
+    for trajectory in trajectories:
+        write_synthetic_trajectory(trajectory, n_rows)
+    frame_mid = int(KE_pairs['bin_frame_mid'].iloc[0])
+    viewer = lambda: molvis.generate_ngl_viewer_html(frame_mid, trajectories[0], trajectories[1], KE_pairs)
+    results['generate_ngl_viewer_html[cold]'] = time_call(viewer, repeat, setup=molvis._pdb_frame.cache_clear)
+    results['generate_ngl_viewer_html[warm]'] = time_call(viewer, repeat)
+    return results
+
+def benchmark_logins(concurrency, logins_per_session, workdir):
+    """
+    Times concurrent logins: `concurrency` threads (one per session) each check a password logins_per_session times
+    against a fresh user database in workdir, through auth_handler's connection pool and bcrypt workers.
+
+    Returns:
+        dict: Total seconds, logins per second and the median and 95th percentile latency of one login.
+    """
+    db_file = auth_handler.DB_FILE
+    auth_handler.DB_FILE = str(Path(workdir) / "user_data.db")
+    try:
+        usernames = [f"user_{session}" for session in range(concurrency)]
+        for username in usernames:
+            auth_handler.register_user(username, "password")
+        latencies = []
+        latencies_lock = threading.Lock()
+
+        def session(username):
+            for _ in range(logins_per_session):
+                start = time.perf_counter()
+                success, message = auth_handler.verify_credentials(username, "password")
+                if not success:
+                    raise RuntimeError(message)
+                with latencies_lock:
+                    latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(session, usernames))
+        total = time.perf_counter() - start
+    finally:
+        auth_handler.close_connection_pools()
+        auth_handler.DB_FILE = db_file
+    return {
+        'seconds': total,
+        'logins_per_second': len(latencies) / total,
+        'median_latency': float(np.median(latencies)),
+        'p95_latency': float(np.percentile(latencies, 95)),
+        'logins': len(latencies),
+    }
+
+def run_login_benchmarks(concurrency_levels=LOGIN_CONCURRENCY, logins_per_session=LOGINS_PER_SESSION):
+    """
+    Runs benchmark_logins for each number of concurrent sessions in a temporary directory.
+
+    Returns:
+        dict: Concurrency -> results (see benchmark_logins).
+    """
+    results = {}
+    for concurrency in concurrency_levels:
+        with tempfile.TemporaryDirectory() as workdir:
+            results[str(concurrency)] = result = benchmark_logins(concurrency, logins_per_session, workdir)
+        print(f"  logins x{concurrency:<4d} {result['logins_per_second']:8.1f} logins/s, median {result['median_latency'] * 1000:.0f} ms, p95 {result['p95_latency'] * 1000:.0f} ms")
+    return results
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=Path(__file__).resolve().parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(scales=DEFAULT_SCALES, repeat=3, login_concurrency=LOGIN_CONCURRENCY):
+    """
+    Runs benchmark_scale for each named scale in a temporary directory, and the login benchmarks for each
+    concurrency level, and collects the results with the revision and environment they were measured on.
+
+    Returns:
+        dict: JSON-serialisable results.
+    """
+    report = {
+        'revision': _git_revision(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'scales': {},
+    }
+    cwd = os.getcwd()
+    structure_dir = molvis.STRUCTURE_DIR
+    try:
+        for scale in scales:
+            if scale not in SCALES:
+                raise ValueError(f"Invalid scale. Choose one of {list(SCALES)}.")
+            n_rows, n_frames = SCALES[scale]
+            with tempfile.TemporaryDirectory() as workdir:
+                # Published structures go to the temporary directory instead of the app's static files
+                molvis.STRUCTURE_DIR = Path(workdir) / "structures"
+                print(f"{scale}: {n_rows} x {n_frames}")
+                results = benchmark_scale(n_rows, n_frames, repeat, workdir)
+                os.chdir(cwd)
+            for name, timing in results.items():
+                print(f"  {name:55s} {timing['median'] * 1000:10.1f} ms")
+            report['scales'][scale] = {'shape': [n_rows, n_frames], 'results': results}
+    finally:
+        os.chdir(cwd)
+        molvis.STRUCTURE_DIR = structure_dir
+    if login_concurrency:
+        print(f"logins: bcrypt cost {auth_handler.BCRYPT_ROUNDS}, {auth_handler.HASH_WORKERS} hash worker(s)")
+        report['logins'] = {'bcrypt_rounds': auth_handler.BCRYPT_ROUNDS, 'hash_workers': auth_handler.HASH_WORKERS, 'results': run_login_benchmarks(login_concurrency)}
+    return report
+
+def compare_reports(report, baseline):
+    """
+    Median time ratios (current / baseline) of the benchmarks both reports ran; above 1 is slower.
+
+    Returns:
+        dict: scale -> benchmark name -> ratio.
+    """
+    ratios = {}
+    for scale, current in report['scales'].items():
+        previous = baseline.get('scales', {}).get(scale)
+        if previous is None:
+            continue
+        ratios[scale] = {
+            name: timing['median'] / previous['results'][name]['median']
+            for name, timing in current['results'].items()
+            if name in previous['results'] and previous['results'][name]['median'] > 0
+        }
+    return ratios
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the analysis hot paths on synthetic pivots.")
+    parser.add_argument("--scales", nargs="+", default=DEFAULT_SCALES, choices=list(SCALES), help="Pivot sizes to run (xlarge needs about 64 GB of memory).")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed repetitions of each benchmark.")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the JSON results.")
+    parser.add_argument("--compare", default=None, help="A previous results file to compare against.")
+    parser.add_argument("--logins", nargs="*", type=int, default=LOGIN_CONCURRENCY, help="Numbers of sessions logging in at once to time (none to skip).")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.scales, args.repeat, args.logins)
+    if args.compare:
+        report['comparison'] = {'baseline': args.compare, 'ratios': compare_reports(report, json.loads(Path(args.compare).read_text()))}
+        for scale, ratios in report['comparison']['ratios'].items():
+            for name, ratio in ratios.items():
+                print(f"{scale} {name:55s} x{ratio:.2f}")
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"Results written to {args.output}")
@@ -1,7 +1,11 @@
 import os
 import glob
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from pivot_store import get_store_path, has_store, load_pivot_store, load_pivot_window, iter_pivot_chunks, DEFAULT_CHUNK_FRAMES
+from aggregation import DERIVED_RESOLUTIONS, aggregate_atoms
+from topology import get_run_topology
 
 # Function to register available datasets from the pivots directory
 def register_available_datasets():
@@ -20,22 +24,32 @@ def register_available_datasets():
             for category in ["effective", "ineffective", "neutral"]:
                 category_path = resolution_path / category
                 if category_path.exists():
-                    # Get the list of dataset files in the category path
+                    # Get the list of dataset files (pickles or memory-mapped stores) in the category path
                     dataset_files = glob.glob(f"{category_path}/data_pivot_*.pckl")
-                    available_datasets[(resolution, category)] = [
-                        Path(f).stem.split("_")[-1] for f in dataset_files
-                    ]
+                    store_dirs = [d for d in glob.glob(f"{category_path}/data_pivot_*") if has_store(d)]
+                    available_datasets[(resolution, category)] = sorted({
+                        Path(f).stem.split("_")[-1] for f in dataset_files + store_dirs
+                    })
     return available_datasets
 
 # Function to load a dataset based on resolution, category, and run number
 def load_dataset(run_num, resolution, category):
     """
     Loads the dataset for a given run number, resolution, and category.
+    A memory-mapped store (see pivot_store.py) is used when present, otherwise the pickle is read.
+    Residue level resolutions without a stored pivot are derived from the run's atom pivot (see aggregation.py).
     :param run_num: The run number to load (e.g., '0500').
-    :param resolution: The resolution type ('residue' or 'atom').
+    :param resolution: The resolution type ('residue' or 'atom', or 'backbone'/'sidechain' derived from atoms).
     :param category: The run category ('effective', 'ineffective', 'neutral').
     :return: A pandas DataFrame of the dataset if found, otherwise None.
     """
+    store_path = get_store_path(run_num, resolution, category)
+    if has_store(store_path):
+        try:
+            return load_pivot_store(store_path)
+        except Exception as e:
+            print(f"Error opening pivot store {store_path}, falling back to pickle: {e}")
+
     file_path = Path(f"pivots/{resolution}/{category}/data_pivot_{run_num}.pckl")
     
     if file_path.exists():
@@ -45,12 +59,80 @@ def load_dataset(run_num, resolution, category):
         except Exception as e:
             print(f"Error loading dataset {run_num}: {e}")
             return None
+    elif resolution in DERIVED_RESOLUTIONS:
+        return derive_dataset(run_num, resolution, category)
     else:
         print(f"Dataset file not found: {file_path}")
         return None
+
+def derive_dataset(run_num, resolution, category):
+    """
+    Sums the run's atom pivot into residues (or their backbone / side chain atoms) using the run's topology.
+    :return: A pandas DataFrame indexed by residue number, or None if the atom pivot is missing or does not match the topology.
+    """
+    return _derive(load_dataset(run_num, "atom", category), run_num, resolution, category)
+
+def _derive(atom_pivot, run_num, resolution, category):
+    if atom_pivot is None:
+        return None
+    try:
+        return aggregate_atoms(atom_pivot, get_run_topology(run_num, category), resolution)
+    except ValueError as e:
+        print(f"Error deriving {resolution} dataset {run_num} from its atom pivot: {e}")
+        return None
     
+def load_dataset_window(run_num, resolution, category, frame_min=None, frame_max=None):
+    """
+    Loads frames frame_min..frame_max (inclusive) of a dataset. From a store only the frame chunks overlapping
+    the window are read (see pivot_store.load_pivot_window); a pickle is read whole and then sliced.
+    :return: A pandas DataFrame of the window, or None if the dataset could not be loaded.
+    """
+    store_path = get_store_path(run_num, resolution, category)
+    if has_store(store_path):
+        try:
+            return load_pivot_window(store_path, frame_min, frame_max)
+        except Exception as e:
+            print(f"Error opening pivot store {store_path}, falling back to pickle: {e}")
+    if resolution in DERIVED_RESOLUTIONS and not Path(f"pivots/{resolution}/{category}/data_pivot_{run_num}.pckl").exists():
+        atom_window = load_dataset_window(run_num, "atom", category, frame_min, frame_max)
+        return _derive(atom_window, run_num, resolution, category)
+    dataset = load_dataset(run_num, resolution, category)
+    if dataset is None:
+        return None
+    frames = dataset.columns
+    in_window = np.ones(len(frames), dtype=bool)
+    if frame_min is not None:
+        in_window &= frames >= frame_min
+    if frame_max is not None:
+        in_window &= frames <= frame_max
+    return dataset.loc[:, in_window]
+
+def iter_dataset_chunks(run_num, resolution, category, frame_min=None, frame_max=None, chunk_frames=None):
+    """
+    Yields frames frame_min..frame_max of a dataset as consecutive blocks of frames (see pivot_store.iter_pivot_chunks),
+    so window computations never hold more than one block of a store in memory. Derived resolutions are aggregated
+    block by block from the atom pivot. Yields nothing if the dataset could not be loaded.
+    """
+    store_path = get_store_path(run_num, resolution, category)
+    if has_store(store_path):
+        yield from iter_pivot_chunks(store_path, frame_min, frame_max, chunk_frames)
+        return
+    if resolution in DERIVED_RESOLUTIONS and not Path(f"pivots/{resolution}/{category}/data_pivot_{run_num}.pckl").exists():
+        for atom_block in iter_dataset_chunks(run_num, "atom", category, frame_min, frame_max, chunk_frames):
+            block = _derive(atom_block, run_num, resolution, category)
+            if block is None:
+                return
+            yield block
+        return
+    dataset = load_dataset_window(run_num, resolution, category, frame_min, frame_max)
+    if dataset is None:
+        return
+    chunk_frames = chunk_frames or DEFAULT_CHUNK_FRAMES
+    for start in range(0, max(dataset.shape[1], 1), chunk_frames):
+        yield dataset.iloc[:, start:start + chunk_frames]
+
 # Normalize by frame to get relative distribution
 def normalize_per_frame(data):
     data = data.div(data.sum(axis=1), axis=0)
     data *= 100
-    return data
\ No newline at end of file
+    return data
@@ -0,0 +1,305 @@
+# ensemble.py: Category-level ensemble statistics of the KE pivots, reduced run by run over a process pool
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pivot_store import PivotStoreWriter, write_pivot_store, load_pivot_store, load_pivot_window, iter_pivot_chunks, has_store
+from out_of_core import row_sums
+from manifest_handler import RESOLUTIONS, CATEGORIES, load_manifest, refresh_manifest, get_dataset_source
+
+ENSEMBLE_CACHE_DIR = Path("analysis_cache") / "ensemble"
+ENSEMBLE_META_FILE = "meta.json"
+# Bumped whenever a statistic's definition changes, so cached ensembles are recomputed instead of used
+ENSEMBLE_FORMAT_VERSION = 1
+# Ensembles are built on the linear views; the app applies the log view to the statistics
+ENSEMBLE_TRANSFORMS = ('raw', 'per_frame')
+# Per cell value histogram bins for the approximate median and quantiles (counts are uint16: at most 65535 runs)
+ENSEMBLE_HISTOGRAM_BINS = 128
+ENSEMBLE_QUANTILES = {'q05': 0.05, 'q25': 0.25, 'median': 0.5, 'q75': 0.75, 'q95': 0.95}
+ENSEMBLE_STATISTICS = ['mean', 'std', 'median', 'q05', 'q25', 'q75', 'q95', 'count']
+# Rows of the cell histograms turned into quantiles at a time, to bound the cumulative count buffers
+QUANTILE_CHUNK_CELLS = 2 ** 16
+# Cells (rows x frames) reduced at a time: the runs are reduced one block of frames after the other, so a state's
+# histograms (ENSEMBLE_HISTOGRAM_BINS uint16 counts per cell, 32 MB) do not grow with the trajectory length
+ENSEMBLE_BLOCK_CELLS = 2 ** 17
+# Ensembles reducing more values (cells summed over the runs) are only computed by the command line
+# (python ensemble.py), never in the app's web process
+ENSEMBLE_WEB_MAX_VALUES = 2 ** 26
+
+# Scratch directory of an ensemble under construction: pickled runs converted to frame-chunked stores
+ENSEMBLE_SCRATCH_DIR = "runs.tmp"
+
+def _prepare_run(source, transform, scratch_path, block_frames):
+    """
+    Worker: makes one run readable block of frames by block of frames. A pickled run is loaded once and converted to a
+    store chunked by block_frames in the scratch directory; a store is used as is. For the per frame view the run's
+    row totals are summed (and the view's value range found) streaming its chunks, so no block needs the whole run.
+
+    :return: (store path, row totals or None, value range or None).
+    """
+    source = Path(source)
+    if not source.is_dir():
+        source = write_pivot_store(pd.read_pickle(source), Path(scratch_path) / source.stem, chunk_frames=block_frames)
+    if transform != 'per_frame':
+        return str(source), None, None
+    chunks = partial(iter_pivot_chunks, source, chunk_frames=block_frames)
+    totals = row_sums(chunks)
+    value_min, value_max = np.inf, -np.inf
+    for block in chunks():
+        values = _normalized(block, totals)
+        finite = values[np.isfinite(values)]
+        if finite.size:
+            value_min, value_max = min(value_min, finite.min()), max(value_max, finite.max())
+    return str(source), totals, ((float(value_min), float(value_max)) if value_min <= value_max else None)
+
+def _normalized(block, totals):
+    # A block of frames as its share of the run's row totals (the per frame view of the whole run, see transforms.py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return block.to_numpy(dtype=np.float64) / totals.reindex(block.index).to_numpy()[:, np.newaxis] * 100
+
+def _load_block(source, totals, index, frames):
+    # One run's frames of a block as float64 cells on the ensemble's grid; rows or frames a run lacks are NaN and not
+    # counted. Only the store chunks of frames[0]..frames[-1] are read.
+    block = load_pivot_window(source, frames[0], frames[-1])
+    if totals is not None:
+        block = pd.DataFrame(_normalized(block, totals), index=block.index, columns=block.columns)
+    return block.reindex(index=index, columns=frames).to_numpy(dtype=np.float64)
+
+def histogram_edges(value_min, value_max, n_bins=ENSEMBLE_HISTOGRAM_BINS):
+    """
+    Bin edges of the per cell histograms: geometric for positive values, whose KE spans orders of magnitude,
+    linear otherwise.
+    """
+    if value_max <= value_min:
+        value_max = value_min + 1.0
+    if value_min > 0:
+        return np.geomspace(value_min, value_max, n_bins + 1)
+    return np.linspace(value_min, value_max, n_bins + 1)
+
+class EnsembleState:
+    """
+    Mergeable running statistics of a stream of equally shaped pivots: per cell count, mean and sum of squared
+    deviations (Welford, merged with Chan et al.'s formula) and a value histogram for quantiles.
+    Memory is independent of the number of runs.
+    """
+
+    def __init__(self, shape, edges):
+        self.shape = tuple(shape)
+        self.edges = np.asarray(edges, dtype=np.float64)
+        n_cells = int(np.prod(self.shape))
+        self.count = np.zeros(n_cells, dtype=np.int64)
+        self.mean = np.zeros(n_cells, dtype=np.float64)
+        self.m2 = np.zeros(n_cells, dtype=np.float64)
+        self.histogram = np.zeros((n_cells, len(self.edges) - 1), dtype=np.uint16)
+
+    def add(self, values):
+        """Adds one run (an array of self.shape); NaN cells are skipped."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        cells = np.flatnonzero(~np.isnan(values))
+        x = values[cells]
+        self.count[cells] += 1
+        delta = x - self.mean[cells]
+        self.mean[cells] += delta / self.count[cells]
+        self.m2[cells] += delta * (x - self.mean[cells])
+        # Every cell gets at most one value per run, so the fancy-indexed increment has no repeated targets
+        bins = np.clip(np.searchsorted(self.edges, x, side='right') - 1, 0, self.histogram.shape[1] - 1)
+        self.histogram[cells, bins] += 1
+
+    def merge(self, other):
+        """Folds another state over the same grid into this one."""
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(count > 0, other.count / count, 0.0)
+        self.mean += delta * weight
+        self.m2 += other.m2 + delta ** 2 * self.count * weight
+        self.count = count
+        self.histogram += other.histogram
+        return self
+
+    def quantiles(self, qs):
+        """
+        Approximate per cell quantiles, interpolated linearly inside the histogram bin where each falls.
+
+        :param qs: A dict of name -> quantile in [0, 1].
+        :return: A dict of name -> array of self.shape.
+        """
+        n_bins = self.histogram.shape[1]
+        results = {name: np.full(len(self.count), np.nan) for name in qs}
+        for start in range(0, len(self.count), QUANTILE_CHUNK_CELLS):
+            stop = start + QUANTILE_CHUNK_CELLS
+            histogram = self.histogram[start:stop].astype(np.int32)
+            cumulative = np.cumsum(histogram, axis=1, dtype=np.int32)
+            count = self.count[start:stop]
+            rows = np.arange(len(count))
+            for name, q in qs.items():
+                target = q * count
+                # First bin whose cumulative count reaches the target rank
+                bins = np.minimum((cumulative < target[:, None]).sum(axis=1), n_bins - 1)
+                below = np.where(bins > 0, cumulative[rows, np.maximum(bins - 1, 0)], 0)
+                in_bin = histogram[rows, bins]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    fraction = np.where(in_bin > 0, (target - below) / in_bin, 0.5)
+                values = self.edges[bins] + np.clip(fraction, 0, 1) * (self.edges[bins + 1] - self.edges[bins])
+                results[name][start:stop] = np.where(count > 0, values, np.nan)
+        return {name: values.reshape(self.shape) for name, values in results.items()}
+
+    def statistics(self):
+        """Returns a dict of statistic name -> array of self.shape (see ENSEMBLE_STATISTICS)."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(self.count > 0, self.mean, np.nan)
+            std = np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+        stats = {'mean': mean.reshape(self.shape), 'std': std.reshape(self.shape), 'count': self.count.reshape(self.shape).astype(np.float64)}
+        stats.update(self.quantiles(ENSEMBLE_QUANTILES))
+        return stats
+
+def _reduce_runs(prepared, index, frames, edges):
+    # Worker: streams its share of the runs through one state over a block of frames, holding a single run's block at a time
+    state = EnsembleState((len(index), len(frames)), edges)
+    for source, totals in prepared:
+        state.add(_load_block(source, totals, index, frames))
+    return state
+
+def get_ensemble_path(resolution, category, transform, cache_dir=ENSEMBLE_CACHE_DIR):
+    return Path(cache_dir) / resolution / category / transform
+
+def _ensemble_runs(resolution, category, base_path):
+    # Run number -> manifest entry of every dataset of the category
+    manifest = load_manifest(base_path) or refresh_manifest(base_path)
+    return {
+        entry['run_num']: entry
+        for entry in manifest['datasets'].values()
+        if entry['resolution'] == resolution and entry['category'] == category
+    }
+
+def ensemble_values(resolution, category, base_path="pivots"):
+    """Number of values reducing a category's runs takes (the cells of all its runs), from the manifest."""
+    return sum(int(np.prod(entry['shape'])) for entry in _ensemble_runs(resolution, category, base_path).values())
+
+def load_ensemble(resolution, category, transform='raw', base_path="pivots", cache_dir=ENSEMBLE_CACHE_DIR):
+    """
+    Loads cached ensemble statistics, or returns None if they are missing or the category's runs changed since.
+
+    Returns:
+        dict: Statistic name -> pd.DataFrame (rows x frames, memory-mapped), plus 'runs' (list of run numbers).
+    """
+    ensemble_path = get_ensemble_path(resolution, category, transform, cache_dir)
+    try:
+        meta = json.loads((ensemble_path / ENSEMBLE_META_FILE).read_text())
+    except (OSError, ValueError):
+        return None
+    runs = _ensemble_runs(resolution, category, base_path)
+    if meta.get('format_version') != ENSEMBLE_FORMAT_VERSION or meta.get('runs') != {run: entry['sha256'] for run, entry in runs.items()}:
+        return None
+    if not all(has_store(ensemble_path / name) for name in ENSEMBLE_STATISTICS):
+        return None
+    ensemble = {name: load_pivot_store(ensemble_path / name) for name in ENSEMBLE_STATISTICS}
+    ensemble['runs'] = sorted(meta['runs'])
+    return ensemble
+
+def compute_ensemble(resolution, category, transform='raw', base_path="pivots", cache_dir=ENSEMBLE_CACHE_DIR, workers=None, overwrite=False):
+    """
+    Reduces every run of a category into per cell mean, std, approximate median and quantiles, and the number of
+    runs per cell, and caches them under analysis_cache/ensemble/<resolution>/<category>/<transform>/.
+
+    A first pass over the runs converts pickled runs to frame-chunked stores in a scratch directory and, for the per
+    frame view, sums each run's row totals chunk by chunk (see _prepare_run). The frames are then reduced in blocks
+    of about ENSEMBLE_BLOCK_CELLS cells, one after the other, every run reading only the block's frames. For each block the
+    runs are split into one chunk per worker process; each worker streams its chunk through an EnsembleState of the
+    block and the parent merges the partial states as they arrive and writes the block's statistics, so memory stays
+    at one block state per worker whatever the number of runs and frames. The grid (rows x frames) is that of the
+    first run. Large ensembles (see ENSEMBLE_WEB_MAX_VALUES) are meant to be computed with python ensemble.py.
+
+    Args:
+        resolution (str): 'residue' or 'atom'.
+        category (str): 'effective', 'ineffective' or 'neutral'.
+        transform (str): 'raw' or 'per_frame' (see ENSEMBLE_TRANSFORMS).
+        workers (int): Number of worker processes (default: CPU count).
+        overwrite (bool): Recompute even when the cached ensemble is current.
+
+    Returns:
+        dict: As load_ensemble, or None if the category has no runs.
+    """
+    if transform not in ENSEMBLE_TRANSFORMS:
+        raise ValueError(f"Invalid ensemble transform. Choose one of {ENSEMBLE_TRANSFORMS}.")
+    if not overwrite:
+        cached = load_ensemble(resolution, category, transform, base_path, cache_dir)
+        if cached is not None:
+            return cached
+    runs = _ensemble_runs(resolution, category, base_path)
+    sources = {run: get_dataset_source(run, resolution, category, base_path) for run in sorted(runs)}
+    sources = {run: str(source) for run, source in sources.items() if source is not None}
+    if not sources:
+        return None
+
+    # Blocks hold about ENSEMBLE_BLOCK_CELLS cells of the first run's grid
+    block_frames = max(1, ENSEMBLE_BLOCK_CELLS // max(runs[next(iter(sources))]['shape'][0], 1))
+    workers = min(workers or os.cpu_count() or 1, len(sources))
+
+    ensemble_path = get_ensemble_path(resolution, category, transform, cache_dir)
+    if ensemble_path.exists():
+        shutil.rmtree(ensemble_path)
+    scratch_path = ensemble_path / ENSEMBLE_SCRATCH_DIR
+    scratch_path.mkdir(parents=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # One pass over every run: pickles become chunked stores, and the per frame view gets its row totals
+        prepared = list(executor.map(_prepare_run, sources.values(), [transform] * len(sources), [scratch_path] * len(sources), [block_frames] * len(sources)))
+        # Histogram ranges: the manifest's value ranges for the raw view, those of the preparing pass otherwise
+        if transform == 'raw':
+            ranges = [(runs[run]['value_min'], runs[run]['value_max']) for run in sources if runs[run]['value_min'] is not None]
+        else:
+            ranges = [value_range for _, _, value_range in prepared if value_range is not None]
+        value_min = min((r[0] for r in ranges), default=0.0)
+        value_max = max((r[1] for r in ranges), default=1.0)
+        edges = histogram_edges(value_min, value_max)
+
+        first = load_pivot_store(prepared[0][0])
+        index, frames = first.index, first.columns
+        del first
+        writers = {name: PivotStoreWriter(ensemble_path / name, index, frames, index.name, frames.name) for name in ENSEMBLE_STATISTICS}
+        chunks = [[(source, totals) for source, totals, _ in prepared[i::workers]] for i in range(workers)]
+        for start in range(0, len(frames), block_frames):
+            block = frames[start:start + block_frames]
+            state = None
+            futures = [executor.submit(_reduce_runs, chunk, index, block, edges) for chunk in chunks]
+            for future in as_completed(futures):
+                block_state = future.result()
+                state = block_state if state is None else state.merge(block_state)
+            for name, values in state.statistics().items():
+                writers[name].write_frames(start, values)
+            del state
+    for writer in writers.values():
+        writer.close()
+    shutil.rmtree(scratch_path)
+    meta = {
+        'format_version': ENSEMBLE_FORMAT_VERSION,
+        'runs': {run: runs[run]['sha256'] for run in runs},
+        'value_min': value_min,
+        'value_max': value_max,
+        'histogram_bins': len(edges) - 1,
+    }
+    # Written last: the statistics are only used once their meta.json exists
+    tmp_meta = ensemble_path / (ENSEMBLE_META_FILE + ".tmp")
+    tmp_meta.write_text(json.dumps(meta))
+    os.replace(tmp_meta, ensemble_path / ENSEMBLE_META_FILE)
+    return load_ensemble(resolution, category, transform, base_path, cache_dir)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compute the ensemble statistics of every run category.")
+    parser.add_argument("--base-path", default="pivots", help="Root of the pivots directory tree.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPU count).")
+    parser.add_argument("--overwrite", action="store_true", help="Recompute ensembles that are already current.")
+    args = parser.parse_args()
+
+    refresh_manifest(args.base_path)
+    for resolution in RESOLUTIONS:
+        for category in CATEGORIES:
+            for transform in ENSEMBLE_TRANSFORMS:
+                ensemble = compute_ensemble(resolution, category, transform, args.base_path, workers=args.workers, overwrite=args.overwrite)
+                if ensemble is not None:
+                    print(f"{resolution}/{category}/{transform}: {len(ensemble['runs'])} run(s)")
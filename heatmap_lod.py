@@ -0,0 +1,87 @@
+# heatmap_lod.py: Level-of-detail reduction of heatmap matrices to a bounded number of cells
+import numpy as np
+
+POOLING_METHODS = ('max', 'mean')
+# Upper bound of cells sent per heatmap along each axis, about the pixel size of a heatmap panel
+DEFAULT_MAX_ROWS = 600
+DEFAULT_MAX_COLS = 600
+
+def block_starts(length, max_blocks):
+    """
+    Start offsets of at most max_blocks contiguous, near-equal blocks covering range(length).
+    Every block holds at least one element, so with length <= max_blocks each element is its own block.
+    """
+    n_blocks = max(1, min(length, max_blocks))
+    return np.arange(n_blocks, dtype=np.int64) * length // n_blocks
+
+def block_centers(starts, length):
+    """Position of the middle of each block, in the coordinates of the unpooled axis."""
+    stops = np.append(starts[1:], length)
+    return (starts + stops - 1) / 2
+
+def pool_matrix(values, row_starts, col_starts, method='max'):
+    """
+    Pools a 2D array over the blocks given by row_starts x col_starts.
+
+    Args:
+        values (np.ndarray): The matrix to reduce (rows x frames).
+        row_starts (np.ndarray): Block start offsets along the rows (see block_starts).
+        col_starts (np.ndarray): Block start offsets along the columns.
+        method (str): 'max' keeps the peak of every block (narrow KE spikes stay visible), 'mean' averages it.
+            NaNs are ignored; all-NaN blocks stay NaN.
+
+    Returns:
+        np.ndarray: The pooled matrix of shape (len(row_starts), len(col_starts)).
+    """
+    if method not in POOLING_METHODS:
+        raise ValueError(f"Invalid pooling method. Choose one of {POOLING_METHODS}.")
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return values
+    if method == 'max':
+        return np.fmax.reduceat(np.fmax.reduceat(values, row_starts, axis=0), col_starts, axis=1)
+    finite = ~np.isnan(values)
+    sums = np.add.reduceat(np.add.reduceat(np.where(finite, values, 0.0), row_starts, axis=0), col_starts, axis=1)
+    counts = np.add.reduceat(np.add.reduceat(finite.astype(np.int64), row_starts, axis=0), col_starts, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+def reduce_heatmap(values, row_window=None, col_window=None, max_rows=DEFAULT_MAX_ROWS, max_cols=DEFAULT_MAX_COLS, method='max', window_transform=None):
+    """
+    Cuts the visible window out of a heatmap matrix and pools it to at most max_rows x max_cols cells, so the payload
+    is bounded by the screen rather than by atoms x frames. Only the window is read, which keeps memory-mapped
+    pivots mostly on disk.
+
+    :param values: The full matrix (rows x frames), e.g. pivot.values.
+    :param row_window: (start, stop) row positions to show, or None for all rows.
+    :param col_window: (start, stop) column positions to show, or None for all columns.
+    :param window_transform: Optional function applied to the window array before pooling (e.g. a colour band map).
+    :return: (pooled matrix, row block centers, column block centers, row block starts); centers and starts are
+        positions in the full matrix, so a zoomed view keeps the coordinates of the overview.
+    """
+    n_rows, n_cols = values.shape
+    row_start, row_stop = row_window if row_window is not None else (0, n_rows)
+    col_start, col_stop = col_window if col_window is not None else (0, n_cols)
+    window = np.asarray(values[row_start:row_stop, col_start:col_stop], dtype=np.float64)
+    if window_transform is not None:
+        window = window_transform(window)
+
+    row_starts = block_starts(window.shape[0], max_rows)
+    col_starts = block_starts(window.shape[1], max_cols)
+    pooled = pool_matrix(window, row_starts, col_starts, method)
+    return (
+        pooled,
+        block_centers(row_starts, window.shape[0]) + row_start,
+        block_centers(col_starts, window.shape[1]) + col_start,
+        row_starts + row_start,
+    )
+
+def window_from_box(box_range, length):
+    """
+    Converts a selected axis range [a, b] (in the position coordinates of the heatmap, cell i spanning i +/- 0.5)
+    into the (start, stop) positions of every cell it touches, or None if it misses the matrix.
+    """
+    low, high = sorted(float(bound) for bound in box_range)
+    start = max(0, int(np.floor(low + 0.5)))
+    stop = min(length, int(np.floor(high + 0.5)) + 1)
+    return (start, stop) if stop > start else None
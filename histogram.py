@@ -0,0 +1,71 @@
+# histogram.py: Fine base histograms of KE pivots, re-binned to any bin count and plot range
+import numpy as np
+
+# Upper bound on the bins of a base histogram. Base bins lie on a decimal grid (their width is a power of ten), so
+# plot ranges and bin widths on that grid re-bin exactly; any other edge falls inside one base bin and is
+# interpolated.
+MAX_BASE_HISTOGRAM_BINS = 2 ** 18
+
+def compute_base_histogram(pivot, max_bins=MAX_BASE_HISTOGRAM_BINS):
+    """
+    Counts all finite values of a pivot into the finest decimal grid of about max_bins bins spanning its values.
+
+    Args:
+        pivot (pd.DataFrame or np.ndarray): The pivot table (rows x frames).
+        max_bins (int): Upper bound on the number of base bins.
+
+    Returns:
+        tuple: (counts, edges) as from np.histogram; both empty when the pivot holds no finite values.
+    """
+    values = _finite_values(pivot)
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    counts, edges = np.histogram(values, bins=_base_edges(values.min(), values.max(), max_bins))
+    return counts.astype(np.int64), edges
+
+def compute_base_histogram_chunked(chunks, max_bins=MAX_BASE_HISTOGRAM_BINS):
+    """
+    compute_base_histogram of the pivot the frame blocks of chunks cover, in two passes over the blocks (value range,
+    then counts), so a run too large to load whole is never in memory at once.
+
+    :param chunks: Callable returning an iterator over the frame blocks.
+    :return: (counts, edges) as compute_base_histogram.
+    """
+    low, high = np.inf, -np.inf
+    for block in chunks():
+        values = _finite_values(block)
+        if len(values):
+            low, high = min(low, values.min()), max(high, values.max())
+    if low > high:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    edges = _base_edges(low, high, max_bins)
+    counts = np.zeros(len(edges) - 1, dtype=np.int64)
+    for block in chunks():
+        counts += np.histogram(_finite_values(block), bins=edges)[0]
+    return counts, edges
+
+def _finite_values(pivot):
+    values = np.asarray(pivot, dtype=np.float64).ravel()
+    return values[np.isfinite(values)]
+
+def _base_edges(low, high, max_bins):
+    # The finest decimal grid of at most max_bins bins covering [low, high]; a constant pivot still gets a bin of
+    # non-zero width
+    width = 10.0 ** np.ceil(np.log10(max(high - low, 1e-12) / (max_bins - 1)))
+    start = np.floor(low / width) * width
+    n_bins = int(np.floor((high - start) / width)) + 1
+    return start + width * np.arange(n_bins + 1)
+
+def rebin_histogram(counts, edges, bin_number, range_min, range_max):
+    """
+    Re-bins a base histogram into bin_number equal bins over [range_min, range_max], interpolating the cumulative
+    counts linearly within base bins. Values outside the plot range are left out, as in the plot.
+
+    Returns:
+        tuple: (counts, edges) of the re-binned histogram; counts are floats.
+    """
+    target_edges = np.linspace(range_min, range_max, int(bin_number) + 1)
+    if len(counts) == 0:
+        return np.zeros(int(bin_number)), target_edges
+    cumulative = np.concatenate([[0], np.cumsum(counts)]).astype(np.float64)
+    return np.diff(np.interp(target_edges, edges, cumulative)), target_edges
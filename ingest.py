@@ -0,0 +1,236 @@
+# ingest.py: Streaming ingestion of GROMACS .gro velocity trajectories into atom and residue KE pivot stores
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pivot_store import PivotStoreWriter, get_store_path, write_store_frames
+from manifest_handler import CATEGORIES, refresh_manifest
+from convert_pdb import parse_pdb_to_dataframe
+
+DEFAULT_CHUNK_FRAMES = 100
+# Bytes read at a time while indexing the frames of a trajectory
+INDEX_BLOCK_SIZE = 1 << 24
+# Atom lines: residue number, residue name, atom name, atom number (5 characters each), then coordinates
+GRO_COORDINATES_START = 20
+
+# Atomic masses (u) by element; with velocities in nm/ps, 0.5 * m * v^2 is in kJ/mol
+ELEMENT_MASSES = {
+    'H': 1.008, 'C': 12.011, 'N': 14.007, 'O': 15.999, 'S': 32.06, 'P': 30.974,
+    'NA': 22.990, 'K': 39.098, 'MG': 24.305, 'CA': 40.078, 'ZN': 65.38, 'CL': 35.45, 'FE': 55.845,
+}
+# Ions are named by their residue, as their atom names clash with protein atoms (CA is also the alpha carbon)
+ION_RESIDUES = {
+    'NA': 'NA', 'SOD': 'NA', 'K': 'K', 'POT': 'K', 'MG': 'MG', 'CA': 'CA', 'CAL': 'CA',
+    'ZN': 'ZN', 'CL': 'CL', 'CLA': 'CL', 'FE': 'FE',
+}
+
+def atom_masses(atom_names, residue_names):
+    """
+    Masses of atoms from their names, e.g. 'CA' -> carbon, 'HG21' -> hydrogen, '1HB' -> hydrogen, and ions from
+    their residue names.
+
+    Raises:
+        ValueError: If an atom's element is not in ELEMENT_MASSES.
+    """
+    masses = np.empty(len(atom_names), dtype=np.float64)
+    unknown = set()
+    for i, (atom_name, residue_name) in enumerate(zip(atom_names, residue_names)):
+        atom_name, residue_name = str(atom_name).strip().upper(), str(residue_name).strip().upper()
+        element = ION_RESIDUES.get(residue_name, atom_name.lstrip("0123456789")[:1])
+        if element not in ELEMENT_MASSES:
+            unknown.add(f"{residue_name}:{atom_name}")
+            continue
+        masses[i] = ELEMENT_MASSES[element]
+    if unknown:
+        raise ValueError(f"No mass known for atoms {sorted(unknown)[:10]}; extend ELEMENT_MASSES or pass a topology.")
+    return masses
+
+def read_gro_header(gro_path):
+    """
+    Reads the first frame's atom table of a .gro file.
+
+    Returns:
+        tuple: (n_atoms, field_width, atom_table) where field_width is the width of each coordinate and velocity
+        field and atom_table has residue_number, residue_three_letter and atom_name columns in file order.
+    """
+    with open(gro_path, 'rb') as f:
+        f.readline()
+        n_atoms = int(f.readline())
+        lines = [f.readline() for _ in range(n_atoms)]
+    if n_atoms == 0 or not lines[-1]:
+        raise ValueError(f"{gro_path} ends inside its first frame.")
+    # Field widths follow the precision: the distance between the first two decimal points
+    coordinates = lines[0][GRO_COORDINATES_START:]
+    first_point = coordinates.index(b'.')
+    field_width = coordinates.index(b'.', first_point + 1) - first_point
+    if len(lines[0].rstrip()) < GRO_COORDINATES_START + 6 * field_width:
+        raise ValueError(f"{gro_path} has no velocities; write the trajectory with velocities (e.g. gmx trjconv -vel).")
+    atom_table = pd.DataFrame({
+        'residue_number': [int(line[0:5]) for line in lines],
+        'residue_three_letter': [line[5:10].decode().strip() for line in lines],
+        'atom_name': [line[10:15].decode().strip() for line in lines],
+    })
+    return n_atoms, field_width, atom_table
+
+def index_gro_chunks(gro_path, n_atoms, chunk_frames=DEFAULT_CHUNK_FRAMES, block_size=INDEX_BLOCK_SIZE):
+    """
+    Finds the byte offset of every chunk_frames-th frame in one streaming pass over the newlines of the file
+    (every frame is a title, an atom count, n_atoms atom lines and a box line).
+
+    Returns:
+        tuple: (n_frames, chunks) with chunks a list of (start byte, end byte, first frame, frame count).
+        An incomplete last frame is left out.
+    """
+    lines_per_chunk = (n_atoms + 3) * chunk_frames
+    offsets = [0]
+    line_count = position = 0
+    last_byte = b'\n'
+    with open(gro_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            completed = line_count + np.arange(1, len(newlines) + 1)
+            offsets.extend((position + newlines[completed % lines_per_chunk == 0] + 1).tolist())
+            line_count += len(newlines)
+            position += len(block)
+            last_byte = block[-1:]
+    if last_byte != b'\n':
+        line_count += 1
+    n_frames = line_count // (n_atoms + 3)
+    chunks = []
+    for i, first_frame in enumerate(range(0, n_frames, chunk_frames)):
+        end = offsets[i + 1] if i + 1 < len(offsets) else position
+        chunks.append((offsets[i], end, first_frame, min(chunk_frames, n_frames - first_frame)))
+    return n_frames, chunks
+
+def parse_gro_velocities(data, n_atoms, n_frames, field_width):
+    """
+    Parses the velocities of n_frames consecutive frames from raw .gro bytes.
+
+    Returns:
+        np.ndarray: (n_frames, n_atoms, 3) velocities.
+    """
+    lines = data.split(b'\n')
+    lines_per_frame = n_atoms + 3
+    atom_lines = []
+    for frame in range(n_frames):
+        first = frame * lines_per_frame
+        if int(lines[first + 1]) != n_atoms:
+            raise ValueError(f"Frame with {int(lines[first + 1])} atoms in a trajectory of {n_atoms} atoms.")
+        atom_lines.extend(lines[first + 2:first + 2 + n_atoms])
+    # Fixed width fields: cut the velocity columns out of all lines at once and convert them in one go
+    line_width = GRO_COORDINATES_START + 6 * field_width
+    table = np.array(atom_lines, dtype=f'S{line_width}').view(np.uint8).reshape(len(atom_lines), line_width)
+    velocity_bytes = np.ascontiguousarray(table[:, GRO_COORDINATES_START + 3 * field_width:])
+    velocities = velocity_bytes.view(f'S{field_width}').astype(np.float64)
+    return velocities.reshape(n_frames, n_atoms, 3)
+
+def _ingest_chunk(gro_path, start, end, first_frame, n_frames, n_atoms, field_width, masses, residue_starts, atom_values_path, residue_values_path, store_chunk_frames):
+    # Worker: reads one chunk's bytes, computes the per atom and per residue KE of its frames and writes them into
+    # the stores' memory-mapped values, so only one chunk per worker is ever in memory
+    with open(gro_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    velocities = parse_gro_velocities(data, n_atoms, n_frames, field_width)
+    atom_ke = 0.5 * masses * np.einsum('fai,fai->fa', velocities, velocities)
+    if atom_values_path is not None:
+        values = np.load(atom_values_path, mmap_mode='r+')
+        write_store_frames(values, first_frame, atom_ke.T, store_chunk_frames)
+        values.flush()
+    if residue_values_path is not None:
+        values = np.load(residue_values_path, mmap_mode='r+')
+        write_store_frames(values, first_frame, np.add.reduceat(atom_ke, residue_starts, axis=1).T, store_chunk_frames)
+        values.flush()
+    return first_frame, n_frames
+
+def _topology_table(topology_path):
+    if Path(topology_path).suffix.lower() == ".csv":
+        return pd.read_csv(topology_path)
+    return parse_pdb_to_dataframe(topology_path)
+
+def ingest_gro(gro_path, run_num, category, base_path="pivots", topology_path=None, chunk_frames=DEFAULT_CHUNK_FRAMES, workers=None, resolutions=("atom", "residue"), dtype=np.float64, store_chunk_frames=None):
+    """
+    Builds the atom and residue KE pivots of a run from a .gro trajectory with velocities, written directly as
+    pivot stores: <base_path>/<resolution>/<category>/data_pivot_<run>/.
+
+    The file is streamed twice: once to find the byte range of every chunk of chunk_frames frames, then the chunks
+    are parsed in parallel, each worker reading its own byte range and writing its frames into the memory-mapped
+    stores. Memory stays at about one chunk per worker whatever the trajectory length.
+
+    Per atom KE is 0.5 * m * |v|^2 with masses by element; residue KE is the sum over the residue's atoms.
+    Atoms are indexed 0..n-1 in file order (as in the shipped atom pivots), residues by residue number.
+
+    Args:
+        gro_path (str): The .gro trajectory, written with velocities.
+        run_num (str): The run number of the new pivots (e.g. '0600').
+        category (str): 'effective', 'ineffective' or 'neutral'.
+        topology_path (str): An aa_map style CSV or a PDB with the same atoms in the same order; its atom and
+            residue names give the masses and residues. Default: the names in the .gro file.
+        chunk_frames (int): Frames parsed per task.
+        workers (int): Number of worker processes (default: CPU count).
+        resolutions (tuple): Which pivots to write, 'atom' and/or 'residue'.
+        store_chunk_frames (int): Write frame-chunked stores with this many frames per chunk (see
+            pivot_store.write_pivot_store), for trajectories too long to load whole.
+
+    Returns:
+        dict: Resolution -> store path.
+    """
+    if category not in CATEGORIES:
+        raise ValueError(f"Invalid category. Choose one of {CATEGORIES}.")
+    if not set(resolutions) <= {"atom", "residue"} or not resolutions:
+        raise ValueError("Invalid resolutions. Choose 'atom' and/or 'residue'.")
+    n_atoms, field_width, atom_table = read_gro_header(gro_path)
+    if topology_path is not None:
+        atom_table = _topology_table(topology_path).drop_duplicates(subset='atom_number', keep='first')
+        if len(atom_table) != n_atoms:
+            raise ValueError(f"The topology has {len(atom_table)} atoms, the trajectory {n_atoms}.")
+    masses = atom_masses(atom_table['atom_name'], atom_table['residue_three_letter'])
+    residue_numbers = atom_table['residue_number'].to_numpy(dtype=np.int64)
+    # Atoms of a residue are consecutive in .gro files: each residue starts where the residue number changes
+    residue_starts = np.flatnonzero(np.r_[True, residue_numbers[1:] != residue_numbers[:-1]])
+    if len(np.unique(residue_numbers)) != len(residue_starts):
+        raise ValueError("The atoms of each residue must be consecutive.")
+
+    n_frames, chunks = index_gro_chunks(gro_path, n_atoms, chunk_frames)
+    if n_frames == 0:
+        raise ValueError(f"{gro_path} holds no complete frame.")
+    frames = np.arange(n_frames)
+    writers = {}
+    if "atom" in resolutions:
+        writers["atom"] = PivotStoreWriter(get_store_path(run_num, "atom", category, base_path), np.arange(n_atoms), frames, index_name="atom", dtype=dtype, chunk_frames=store_chunk_frames)
+    if "residue" in resolutions:
+        writers["residue"] = PivotStoreWriter(get_store_path(run_num, "residue", category, base_path), residue_numbers[residue_starts], frames, index_name="residue", dtype=dtype, chunk_frames=store_chunk_frames)
+    atom_values_path = writers["atom"].values_tmp_path if "atom" in writers else None
+    residue_values_path = writers["residue"].values_tmp_path if "residue" in writers else None
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        futures = [
+            executor.submit(_ingest_chunk, str(gro_path), start, end, first_frame, count, n_atoms, field_width, masses, residue_starts, atom_values_path, residue_values_path, store_chunk_frames)
+            for start, end, first_frame, count in chunks
+        ]
+        for future in as_completed(futures):
+            future.result()
+    return {resolution: writer.close() for resolution, writer in writers.items()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the KE pivots of a run from a .gro trajectory with velocities.")
+    parser.add_argument("gro_path", help="The .gro trajectory (with velocities).")
+    parser.add_argument("--run", required=True, help="Run number of the new pivots, e.g. 0600.")
+    parser.add_argument("--category", required=True, choices=CATEGORIES, help="Run category.")
+    parser.add_argument("--base-path", default="pivots", help="Root of the pivots directory tree.")
+    parser.add_argument("--topology", default=None, help="aa_map style CSV or PDB naming the atoms (default: names in the .gro file).")
+    parser.add_argument("--chunk-frames", type=int, default=DEFAULT_CHUNK_FRAMES, help="Frames parsed per task.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPU count).")
+    parser.add_argument("--resolutions", nargs="+", default=["atom", "residue"], choices=["atom", "residue"], help="Pivots to write.")
+    parser.add_argument("--float32", action="store_true", help="Store values as float32 to halve disk use.")
+    parser.add_argument("--store-chunk-frames", type=int, default=None, help="Write frame-chunked stores with this many frames per chunk, for trajectories too long to load whole.")
+    args = parser.parse_args()
+
+    stores = ingest_gro(args.gro_path, args.run, args.category, args.base_path, args.topology, args.chunk_frames, args.workers, tuple(args.resolutions), np.float32 if args.float32 else np.float64, args.store_chunk_frames)
+    for resolution, store_path in stores.items():
+        print(f"{resolution}: {store_path}")
+    refresh_manifest(args.base_path)
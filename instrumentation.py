@@ -0,0 +1,161 @@
+# instrumentation.py: Per rerun timing spans and payload sizes, appended to a JSON-lines log
+import os
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+TIMING_LOG_PATH = Path("logs") / "timings.jsonl"
+# Serializing a figure once more to measure it costs about as much as Streamlit's own serialization of it
+MEASURE_PAYLOADS = True
+TIMING_PERCENTILES = (50, 90, 99)
+
+# Every script run (and fragment run) executes on its own thread, so the active timings are thread-local
+_local = threading.local()
+_log_lock = threading.Lock()
+
+class RerunTimings:
+    """
+    The timing spans of one script run of one session. Spans nest: a span opened inside another is named
+    '<outer>/<inner>'. Payloads (bytes sent to the browser) are attributed to the span they are sent from.
+    """
+
+    def __init__(self, session_id, rerun, scope='script'):
+        self.session_id = session_id
+        self.rerun = rerun
+        self.scope = scope
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.spans = []
+        self.payloads = []
+        self._stack = []
+        self._start = time.perf_counter()
+        self.total_ms = None
+
+    @contextmanager
+    def span(self, name):
+        path = "/".join(self._stack + [name])
+        self._stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            self.spans.append({'name': path, 'ms': (time.perf_counter() - start) * 1000})
+
+    def add_payload(self, kind, name, nbytes):
+        self.payloads.append({'kind': kind, 'name': name, 'span': "/".join(self._stack), 'bytes': int(nbytes) if nbytes is not None else None})
+
+    def finish(self):
+        self.total_ms = (time.perf_counter() - self._start) * 1000
+        return self.to_record()
+
+    def to_record(self):
+        return {
+            'session_id': self.session_id,
+            'rerun': self.rerun,
+            'scope': self.scope,
+            'started_at': self.started_at,
+            'total_ms': self.total_ms,
+            'spans': self.spans,
+            'payloads': self.payloads,
+        }
+
+def start_rerun_timings(session_id, rerun, scope='script'):
+    """Starts collecting the spans of the current script (or fragment) run on this thread."""
+    _local.timings = RerunTimings(session_id, rerun, scope)
+    return _local.timings
+
+def current_rerun_timings():
+    return getattr(_local, 'timings', None)
+
+def finish_rerun_timings():
+    """Ends the current run's timings and returns them as a log record, or None if none were started."""
+    timings = current_rerun_timings()
+    if timings is None:
+        return None
+    _local.timings = None
+    return timings.finish()
+
+@contextmanager
+def timed(name):
+    """Times the enclosed block as a span of the current run; does nothing outside an instrumented run."""
+    timings = current_rerun_timings()
+    if timings is None:
+        yield
+        return
+    with timings.span(name):
+        yield
+
+def record_payload(kind, name, nbytes):
+    timings = current_rerun_timings()
+    if timings is not None:
+        timings.add_payload(kind, name, nbytes)
+
+def plotly_payload_bytes(fig):
+    """Size of a figure as Streamlit sends it (plotly JSON), or None when payload measuring is off."""
+    if not MEASURE_PAYLOADS:
+        return None
+    return len(pio.to_json(fig, validate=False))
+
+def append_timing_log(record, path=TIMING_LOG_PATH):
+    """Appends one record as a JSON line; errors are printed, never raised into the app."""
+    if record is None:
+        return
+    try:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        line = json.dumps(record) + "\n"
+        with _log_lock, open(path, 'a') as f:
+            f.write(line)
+    except OSError as e:
+        print(f"Error writing timing log {path}: {e}")
+
+def load_timing_log(path=TIMING_LOG_PATH):
+    """
+    Reads a timing log into one row per span (plus a 'total' row per run).
+
+    Returns:
+        pd.DataFrame: session_id, rerun, scope, name and ms columns.
+    """
+    rows = []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            base = {'session_id': record['session_id'], 'rerun': record['rerun'], 'scope': record.get('scope', 'script')}
+            rows.append(dict(base, name='total', ms=record['total_ms']))
+            rows.extend(dict(base, name=span['name'], ms=span['ms']) for span in record['spans'])
+    return pd.DataFrame(rows, columns=['session_id', 'rerun', 'scope', 'name', 'ms'])
+
+def summarize_timing_log(path=TIMING_LOG_PATH, percentiles=TIMING_PERCENTILES):
+    """
+    Latency percentiles of every span over all logged runs.
+
+    Returns:
+        pd.DataFrame: Indexed by (scope, name), with count, sessions and one p<q> column (ms) per percentile.
+    """
+    spans = load_timing_log(path)
+    grouped = spans.groupby(['scope', 'name'])['ms']
+    summary = pd.DataFrame({'count': grouped.size(), 'sessions': spans.groupby(['scope', 'name'])['session_id'].nunique()})
+    for q in percentiles:
+        summary[f'p{q}'] = grouped.agg(lambda values: np.percentile(values, q))
+    return summary.sort_values(f'p{percentiles[-1]}', ascending=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarize the latency percentiles of the app's timing log.")
+    parser.add_argument("--log", default=str(TIMING_LOG_PATH), help="The JSON-lines timing log.")
+    args = parser.parse_args()
+    if not os.path.exists(args.log):
+        print(f"Timing log not found: {args.log}")
+    else:
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(summarize_timing_log(args.log).round(1))
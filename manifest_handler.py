@@ -0,0 +1,293 @@
+# manifest_handler.py: Persistent manifest of the pivot datasets and their metadata
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from functools import partial
+from pivot_store import VALUES_FILE, INDEX_FILE, FRAMES_FILE, has_store, load_pivot_store, read_store_meta, iter_pivot_chunks
+from out_of_core import window_percentiles
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+RESOLUTIONS = ["residue", "atom"]
+CATEGORIES = ["effective", "ineffective", "neutral"]
+PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+
+# Serializes manifest refreshes between the app thread and the file watcher
+_manifest_lock = threading.Lock()
+# Parsed manifests by path, with the version (see get_manifest_version) they were read at
+_parsed_manifests = {}
+
+def get_manifest_path(base_path="pivots"):
+    return Path(base_path) / MANIFEST_FILE
+
+def load_manifest(base_path="pivots"):
+    """
+    Reads the manifest, or returns None if it has not been built yet.
+    """
+    manifest_path = get_manifest_path(base_path)
+    if not manifest_path.exists():
+        return None
+    try:
+        manifest = json.loads(manifest_path.read_text())
+    except (OSError, ValueError) as e:
+        print(f"Error reading manifest {manifest_path}: {e}")
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def save_manifest(manifest, base_path="pivots"):
+    manifest_path = get_manifest_path(base_path)
+    tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(tmp_path, manifest_path)
+
+def get_manifest_version(base_path="pivots"):
+    """
+    Returns a token that changes whenever the manifest is rewritten (its mtime), or None if there is no manifest.
+    Used to invalidate cached registrations without reading the manifest itself.
+    """
+    try:
+        return os.stat(get_manifest_path(base_path)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _scan_dataset_sources(base_path):
+    """
+    Lists the file each dataset is loaded from, keyed by 'resolution/category/run'.
+    Stores win over pickles, matching data_handler.load_dataset. Only directory entries are stat-ed, nothing is read.
+    """
+    sources = {}
+    for resolution in RESOLUTIONS:
+        for category in CATEGORIES:
+            category_path = Path(base_path) / resolution / category
+            if not category_path.is_dir():
+                continue
+            with os.scandir(category_path) as entries:
+                for entry in entries:
+                    if not entry.name.startswith("data_pivot_"):
+                        continue
+                    if entry.is_file() and entry.name.endswith(".pckl"):
+                        run_num = entry.name[len("data_pivot_"):-len(".pckl")]
+                        sources.setdefault(f"{resolution}/{category}/{run_num}", Path(entry.path))
+                    elif entry.is_dir() and has_store(entry.path):
+                        run_num = entry.name[len("data_pivot_"):]
+                        sources[f"{resolution}/{category}/{run_num}"] = Path(entry.path)
+    return sources
+
+def _source_files(source):
+    # A store is described by its three arrays, a pickle by itself
+    if source.is_dir():
+        return [source / VALUES_FILE, source / INDEX_FILE, source / FRAMES_FILE]
+    return [source]
+
+def get_dataset_source(run_num, resolution, category, base_path="pivots"):
+    """
+    Returns the path a dataset is loaded from (store directory or pickle), or None if neither exists.
+    """
+    store_path = Path(base_path) / resolution / category / f"data_pivot_{run_num}"
+    if has_store(store_path):
+        return store_path
+    pickle_path = store_path.with_suffix(".pckl")
+    return pickle_path if pickle_path.exists() else None
+
+def source_signature(source):
+    """Returns (latest mtime in ns, total size) of the files a dataset is loaded from."""
+    stats = [os.stat(f) for f in _source_files(source)]
+    return max(s.st_mtime_ns for s in stats), sum(s.st_size for s in stats)
+
+def _content_hash(source):
+    digest = hashlib.sha256()
+    for file_path in _source_files(source):
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def _load_source(source):
+    return load_pivot_store(source) if source.is_dir() else pd.read_pickle(source)
+
+def describe_pivot(pivot):
+    """
+    Computes the metadata kept in the manifest for a pivot table (rows x frames).
+    """
+    values = np.asarray(pivot.values, dtype=np.float64)
+    finite = values[np.isfinite(values)]
+    frames = pivot.columns
+    return {
+        'shape': list(pivot.shape),
+        'index_name': pivot.index.name,
+        'index_min': int(pivot.index.min()),
+        'index_max': int(pivot.index.max()),
+        'frame_min': int(frames.min()),
+        'frame_max': int(frames.max()),
+        'n_frames': int(len(frames)),
+        'value_min': float(finite.min()) if finite.size else None,
+        'value_max': float(finite.max()) if finite.size else None,
+        'percentiles': dict(zip(map(str, PERCENTILES), np.percentile(finite, PERCENTILES).tolist())) if finite.size else {},
+    }
+
+def describe_chunked_store(store_path):
+    """
+    describe_pivot for a frame-chunked store, read one chunk at a time (percentiles in two passes, see
+    out_of_core.window_percentiles), so runs too large to load whole can be registered.
+    """
+    chunks = partial(iter_pivot_chunks, store_path)
+    index, frames = None, []
+    value_min, value_max = np.inf, -np.inf
+    for block in chunks():
+        values = np.asarray(block.values, dtype=np.float64)
+        finite = values[np.isfinite(values)]
+        if finite.size:
+            value_min, value_max = min(value_min, finite.min()), max(value_max, finite.max())
+        index = block.index
+        frames.append(block.columns.to_numpy())
+    frames = np.concatenate(frames)
+    has_values = value_min <= value_max
+    return {
+        'shape': [len(index), len(frames)],
+        'index_name': index.name,
+        'index_min': int(index.min()),
+        'index_max': int(index.max()),
+        'frame_min': int(frames.min()),
+        'frame_max': int(frames.max()),
+        'n_frames': int(len(frames)),
+        'value_min': float(value_min) if has_values else None,
+        'value_max': float(value_max) if has_values else None,
+        'percentiles': dict(zip(map(str, PERCENTILES), window_percentiles(chunks, PERCENTILES).tolist())) if has_values else {},
+    }
+
+def _build_entry(key, source, base_path):
+    mtime_ns, size = source_signature(source)
+    resolution, category, run_num = key.split("/")
+    entry = {
+        'resolution': resolution,
+        'category': category,
+        'run_num': run_num,
+        'path': str(source.relative_to(base_path)),
+        'mtime_ns': mtime_ns,
+        'size': size,
+        'sha256': _content_hash(source),
+    }
+    if source.is_dir() and read_store_meta(source).get('chunk_frames'):
+        entry.update(describe_chunked_store(source))
+    else:
+        entry.update(describe_pivot(_load_source(source)))
+    return entry
+
+def refresh_manifest(base_path="pivots"):
+    """
+    Brings the manifest up to date with the pivots tree and returns it.
+    Unchanged datasets are recognised by mtime and size alone; a changed signature is re-hashed, and only datasets
+    whose content actually changed are reloaded to recompute their metadata.
+    """
+    base_path = Path(base_path)
+    with _manifest_lock:
+        manifest = load_manifest(base_path) or {'version': MANIFEST_VERSION, 'datasets': {}}
+        datasets = manifest['datasets']
+        changed = False
+
+        sources = _scan_dataset_sources(base_path)
+        for key in set(datasets) - set(sources):
+            del datasets[key]
+            changed = True
+
+        for key, source in sources.items():
+            entry = datasets.get(key)
+            try:
+                mtime_ns, size = source_signature(source)
+                relative_path = str(source.relative_to(base_path))
+                if entry is not None and entry['path'] == relative_path and (entry['mtime_ns'], entry['size']) == (mtime_ns, size):
+                    continue
+                if entry is not None and entry['path'] == relative_path and entry['sha256'] == _content_hash(source):
+                    # Touched but not modified
+                    entry['mtime_ns'], entry['size'] = mtime_ns, size
+                else:
+                    datasets[key] = _build_entry(key, source, base_path)
+                changed = True
+            except Exception as e:
+                # A file that is still being written is picked up by the next refresh
+                print(f"Error describing dataset {source}: {e}")
+
+        if changed or not get_manifest_path(base_path).exists():
+            save_manifest(manifest, base_path)
+        return manifest
+
+def register_datasets_from_manifest(base_path="pivots"):
+    """
+    Same result as data_handler.register_available_datasets, read from the manifest instead of the file system.
+    Builds the manifest on first use.
+    """
+    manifest = load_manifest(base_path) or refresh_manifest(base_path)
+    available_datasets = {}
+    for entry in manifest['datasets'].values():
+        available_datasets.setdefault((entry['resolution'], entry['category']), []).append(entry['run_num'])
+    for runs in available_datasets.values():
+        runs.sort()
+    return available_datasets
+
+def get_cached_manifest(base_path="pivots"):
+    """
+    Returns the parsed manifest, read again only when its version changes, so a lookup costs one stat instead of
+    parsing the whole file. The result is shared between callers and must not be modified.
+    """
+    version = get_manifest_version(base_path)
+    if version is None:
+        return None
+    key = os.path.abspath(get_manifest_path(base_path))
+    cached = _parsed_manifests.get(key)
+    if cached is None or cached[0] != version:
+        cached = _parsed_manifests[key] = (version, load_manifest(base_path))
+    return cached[1]
+
+def get_dataset_metadata(run_num, resolution, category, base_path="pivots"):
+    """
+    Returns the manifest entry for a dataset, or None if it is not in the manifest.
+    """
+    manifest = get_cached_manifest(base_path)
+    if manifest is None:
+        return None
+    return manifest['datasets'].get(f"{resolution}/{category}/{run_num}")
+
+def start_manifest_watcher(base_path="pivots", debounce_seconds=2.0):
+    """
+    Watches the pivots tree with watchdog and refreshes the manifest shortly after pivot files are added, changed
+    or removed. Bursts of events (e.g. a converter writing many files) are folded into one refresh.
+
+    Returns:
+        watchdog.observers.Observer: The running observer; call stop() on it to end watching.
+    """
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+
+    class PivotEventHandler(FileSystemEventHandler):
+        def __init__(self):
+            self._timer = None
+            self._timer_lock = threading.Lock()
+
+        def on_any_event(self, event):
+            paths = [event.src_path, getattr(event, 'dest_path', '')]
+            # Ignore our own manifest writes and anything that is not pivot data
+            if not any("data_pivot_" in os.fsdecode(p) for p in paths):
+                return
+            with self._timer_lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._timer = threading.Timer(debounce_seconds, refresh_manifest, kwargs={'base_path': base_path})
+                self._timer.daemon = True
+                self._timer.start()
+
+    Path(base_path).mkdir(parents=True, exist_ok=True)
+    observer = Observer()
+    observer.schedule(PivotEventHandler(), str(base_path), recursive=True)
+    observer.daemon = True
+    observer.start()
+    return observer
+
+if __name__ == '__main__':
+    manifest = refresh_manifest()
+    print(f"Manifest lists {len(manifest['datasets'])} dataset(s).")
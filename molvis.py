@@ -1,93 +1,136 @@
 # molvis.py: Molecule visualization module
+import os
+import gzip
+import json
 import base64
+import hashlib
+import threading
+from pathlib import Path
+from functools import lru_cache
 from Bio import PDB  # Biopython's PDB module
 from io import StringIO
-import streamlit as st
 import numpy as np
+from trajectory_store import read_frame_block, open_trajectory_store
 
 def pdb_to_base64(pdb_content):
     """Convert PDB content to base64."""
     return base64.b64encode(pdb_content.encode('utf-8')).decode('utf-8')
 
-def generate_pdb_base64_frame(pdb_file_path, frame_number=0):
-    """
-    Read a local PDB file, extract a specific frame (MODEL), 
-    and return it as a base64-encoded string along with the geometric center.
-    """
-    if st.session_state.get(pdb_file_path, None):
-        model = st.session_state[pdb_file_path]
-    else:
-        parser = PDB.PDBParser(QUIET=True)
-        structure = parser.get_structure("molecule", pdb_file_path)
-
-        try:
-            model = structure[frame_number]
-        except KeyError:
-            model = structure[0]
-        st.session_state[pdb_file_path] = model
+# Structures are served by Streamlit's static file serving (server.enableStaticServing in .streamlit/config.toml)
+# from static/structures/<content hash>.pdb.gz, so the browser fetches and caches each structure once
+STATIC_DIR = Path(__file__).resolve().parent / "static"
+STRUCTURE_DIR = STATIC_DIR / "structures"
+STATIC_URL_PREFIX = "app/static"
+
+# Colour of the highlighted residues of each category
+CATEGORY_COLORS = {"common": "skyblue", "neighbour": "blue", "reference only": "pink", "comparison only": "red"}
+
+@lru_cache(maxsize=64)
+def _pdb_frame(pdb_file_path, mtime_ns, frame_number):
+    # mtime_ns only keys the cache, so a rewritten trajectory is read again
+    store = open_trajectory_store(pdb_file_path)
+    if store is not None:
+        # Converted trajectory (see trajectory_store.py): fill the frame's coordinates into the template
+        return store.frame_pdb(frame_number), store.frame_center(frame_number).tolist()
+
+    parser = PDB.PDBParser(QUIET=True)
+    structure = parser.get_structure("molecule", StringIO(read_frame_block(pdb_file_path, frame_number)))
+    model = structure[0]
 
     # Calculate geometric center
-    atom_coords = [atom.coord for atom in model.get_atoms()]
-    center_of_mass = np.mean(atom_coords, axis=0)  # Compute geometric center
+    atom_coords = np.array([atom.coord for atom in model.get_atoms()])
+    center_of_mass = atom_coords.mean(axis=0)  # Compute geometric center
     
-    # Convert the frame to base64
+    # Convert the frame to PDB text
     frame_content = StringIO()
     io = PDB.PDBIO()
     io.set_structure(model)
     io.save(frame_content)
-    pdb_content = frame_content.getvalue()
-    
-    return pdb_to_base64(pdb_content), center_of_mass.tolist()
+    return frame_content.getvalue(), center_of_mass.tolist()
+
+def _frame_key(pdb_file_path, frame_number):
+    pdb_file_path = str(pdb_file_path)
+    return pdb_file_path, os.stat(pdb_file_path).st_mtime_ns, int(frame_number)
+
+def generate_pdb_base64_frame(pdb_file_path, frame_number=0):
+    """
+    Read a local PDB file, extract a specific frame (MODEL), 
+    and return it as a base64-encoded string along with the geometric center.
+    Only the requested MODEL block is read and parsed; results are cached per (file, frame) for all sessions.
+    """
+    pdb_content, center = _pdb_frame(*_frame_key(pdb_file_path, frame_number))
+    return pdb_to_base64(pdb_content), center
+
+def publish_structure(pdb_content):
+    """
+    Writes PDB text gzip-compressed under its content hash into the static structure directory (once) and returns
+    its URL relative to the app, e.g. app/static/structures/<hash>.pdb.gz.
+    """
+    data = pdb_content.encode('utf-8')
+    file_name = f"{hashlib.sha256(data).hexdigest()[:32]}.pdb.gz"
+    path = STRUCTURE_DIR / file_name
+    if not path.exists():
+        STRUCTURE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{file_name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        # mtime=0 keeps the compressed bytes a function of the content alone
+        tmp_path.write_bytes(gzip.compress(data, mtime=0))
+        os.replace(tmp_path, path)
+    return f"{STATIC_URL_PREFIX}/structures/{file_name}"
+
+def generate_structure_url(pdb_file_path, frame_number=0):
+    """
+    Returns the static URL of one frame of a PDB file and its geometric center, publishing the frame on first use.
+    The frame itself is cached per (file, frame) for all sessions.
+    """
+    pdb_content, center = _pdb_frame(*_frame_key(pdb_file_path, frame_number))
+    return publish_structure(pdb_content), center
+
+def residue_selections(residues, residue_column, category_column):
+    """
+    Groups highlighted residues by category into one NGL selection string each, e.g. {"common": ":A and (12 or 15)"}.
+    Categories are in CATEGORY_COLORS order, unknown categories last.
+    """
+    residues = residues.dropna()
+    numbers = residues[residue_column].astype(int)
+    selections = {}
+    for category, group in numbers.groupby(residues[category_column].to_numpy()):
+        selections[category] = ":A and (" + " or ".join(str(number) for number in sorted(set(group))) + ")"
+    order = list(CATEGORY_COLORS)
+    return dict(sorted(selections.items(), key=lambda item: order.index(item[0]) if item[0] in order else len(order)))
+
+def _highlight_script(selections):
+    # One ball+stick representation per category
+    return "".join(
+        f"""
+                o.addRepresentation("ball+stick", {{ sele: {json.dumps(selection)}, color: "{CATEGORY_COLORS.get(category, "gray")}" }});"""
+        for category, selection in selections.items()
+    )
 
 def generate_ngl_viewer_html(frame_number, molecule_1_path, molecule_2_path, result_df):
     # Filter result_df for the selected frame
     selected_df = result_df[result_df['bin_frame_mid'] == frame_number]
 
-    # Get the unique residues and their categories for each molecule
-    molecule_1_residues = selected_df[['residue_number_reference', 'category_ref']].dropna()
-    molecule_2_residues = selected_df[['residue_number_comparison', 'category_comp']].dropna()
-
-    # Get base64 PDB content and centers
-    pdb_base64_1, molecule_1_center = generate_pdb_base64_frame(molecule_1_path, frame_number)
-    pdb_base64_2, molecule_2_center = generate_pdb_base64_frame(molecule_2_path, frame_number)
-
-
-    # Function to create NGL selection scripts for residues
-    def create_selection_script(residues, molecule_name1, molecule_name2):
-        selection_script = ""
-        color_map = {"common": "skyblue", "neighbour": "blue", "reference only": "pink", "comparison only": "red"}
-        
-        for _, row in residues.iterrows():
-            residue_number = int(row[f'residue_number_{molecule_name1}'])
-            category = row[f'category_{molecule_name2}']
-            color = color_map.get(category, "gray")
-            selection_script += f"""
-                o.addRepresentation("ball+stick", {{
-                    sele: ":A and {residue_number}",
-                    color: "{color}"
-                }});\n
-            """
-        return selection_script
-
-    # Generate selection scripts for each molecule
-    selection_script_1 = create_selection_script(molecule_1_residues, "reference", "ref")
-    selection_script_2 = create_selection_script(molecule_2_residues, "comparison", "comp")
-
-    # Load molecules into NGL as Blobs from base64
+    # Highlighted residues of each molecule, grouped into one selection per category
+    selections_1 = residue_selections(selected_df[['residue_number_reference', 'category_ref']], 'residue_number_reference', 'category_ref')
+    selections_2 = residue_selections(selected_df[['residue_number_comparison', 'category_comp']], 'residue_number_comparison', 'category_comp')
+
+    # Static URLs of the two structures: the HTML stays a few kilobytes and the browser caches the files
+    molecule_1_url, molecule_1_center = generate_structure_url(molecule_1_path, frame_number)
+    molecule_2_url, molecule_2_center = generate_structure_url(molecule_2_path, frame_number)
+
+    # Load molecules into NGL from the static URLs, resolved against the app's address
     load_molecule_1 = f"""
-        const pdbBlob1 = new Blob([atob("{pdb_base64_1}")], {{ type: "text/plain" }});
-        stage1.loadFile(pdbBlob1, {{ ext: "pdb" }}).then(o => {{
+        stage1.loadFile(new URL("{molecule_1_url}", document.baseURI).href, {{ ext: "pdb", compressed: "gz" }}).then(o => {{
             o.addRepresentation("cartoon", {{ color: "#6A5ACD" }});
             stage1.autoView();
-            {selection_script_1}
+            {_highlight_script(selections_1)}
         }});
     """
     load_molecule_2 = f"""
-        const pdbBlob2 = new Blob([atob("{pdb_base64_2}")], {{ type: "text/plain" }});
-        stage2.loadFile(pdbBlob2, {{ ext: "pdb" }}).then(o => {{
+        stage2.loadFile(new URL("{molecule_2_url}", document.baseURI).href, {{ ext: "pdb", compressed: "gz" }}).then(o => {{
             o.addRepresentation("cartoon", {{ color: "#F08080" }});
             stage2.autoView();
-            {selection_script_2}
+            {_highlight_script(selections_2)}
         }});
     """
 
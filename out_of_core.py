@@ -0,0 +1,224 @@
+# out_of_core.py: Chunk by chunk persistence, streak, KE bin and exact percentile computations over frame windows
+import os
+import numpy as np
+import pandas as pd
+from reorder_handler import PERCENTILE_THRESHOLDS, MAX_MASK_CELLS, top_KE_bins, threshold_levels, threshold_level_counts, frames_at_or_above
+
+# Runs whose pivot would take more memory than this are opened as a frame window (overridable through the environment)
+OUT_OF_CORE_BUDGET_MB = int(os.environ.get("KE_OUT_OF_CORE_MB", 2048))
+# Frames shown at once for such runs by default
+DEFAULT_WINDOW_FRAMES = 2000
+# Exact percentiles: values are first counted by the leading bits of their sortable bit pattern (sign, exponent and
+# the top mantissa bits), then only the values in the buckets holding the wanted ranks are collected and sorted
+PREFIX_BITS = 20
+_PREFIX_SHIFT = np.uint64(64 - PREFIX_BITS)
+_SIGN_BIT = np.uint64(1 << 63)
+
+# All functions take `chunks`, a callable returning a fresh iterator over the consecutive frame blocks (rows x frames
+# DataFrames, same rows in every block) of the window, e.g. functools.partial(data_handler.iter_dataset_chunks, ...).
+# Blocks are read one at a time, so memory depends on the block size, not on the window length.
+
+def is_out_of_core(metadata, budget_mb=OUT_OF_CORE_BUDGET_MB):
+    """Whether a dataset (described by its manifest entry) is too large to load whole."""
+    if not metadata:
+        return False
+    n_rows, n_frames = metadata['shape']
+    return n_rows * n_frames * np.dtype(np.float64).itemsize > budget_mb * 1024 ** 2
+
+def _block_values(block):
+    return block.to_numpy(dtype=np.float64)
+
+def sortable_keys(values):
+    """Unsigned integers that sort like the floats: every bit of negatives flipped, only the sign bit of the rest."""
+    bits = np.ascontiguousarray(values, dtype=np.float64).view(np.uint64)
+    return np.where(bits & _SIGN_BIT, ~bits, bits | _SIGN_BIT)
+
+def _prefixes(values):
+    return (sortable_keys(values) >> _PREFIX_SHIFT).astype(np.int64)
+
+def percentile_lerp(a, b, t):
+    """The linear interpolation between order statistics np.percentile uses, so results match it exactly."""
+    diff = b - a
+    return np.where(t >= 0.5, b - diff * (1 - t), a + diff * t)
+
+def window_percentiles(chunks, percentiles):
+    """
+    Exact percentiles (as np.percentile with linear interpolation) of all non-NaN values of a window, in two passes
+    over its blocks: a count per bucket of leading bits, then the values of the buckets holding the wanted ranks.
+
+    :param chunks: Callable returning an iterator over the frame blocks of the window.
+    :param percentiles: Percentiles in [0, 100].
+    :return: An array of one value per percentile (NaN for an empty window).
+    """
+    percentiles = np.asarray(percentiles, dtype=np.float64)
+    counts = np.zeros(1 << PREFIX_BITS, dtype=np.int64)
+    for block in chunks():
+        values = _block_values(block).ravel()
+        counts += np.bincount(_prefixes(values[~np.isnan(values)]), minlength=len(counts))
+    n_values = int(counts.sum())
+    if n_values == 0:
+        return np.full(len(percentiles), np.nan)
+
+    positions = percentiles / 100 * (n_values - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, n_values - 1)
+    ranks = np.unique(np.concatenate([lower, upper]))
+    cumulative = np.cumsum(counts)
+    needed = np.zeros(len(counts), dtype=bool)
+    needed[np.searchsorted(cumulative, ranks, side='right')] = True
+
+    collected = []
+    for block in chunks():
+        values = _block_values(block).ravel()
+        values = values[~np.isnan(values)]
+        collected.append(values[needed[_prefixes(values)]])
+    collected = np.sort(np.concatenate(collected))
+
+    # Position of a rank among the collected values: its rank minus the values of the buckets that were skipped
+    needed_buckets = np.flatnonzero(needed)
+    skipped_before = (cumulative[needed_buckets] - counts[needed_buckets]) - np.r_[0, np.cumsum(counts[needed_buckets])[:-1]]
+
+    def order_statistic(rank):
+        bucket = np.searchsorted(needed_buckets, np.searchsorted(cumulative, rank, side='right'))
+        return collected[rank - skipped_before[bucket]]
+
+    return percentile_lerp(order_statistic(lower), order_statistic(upper), positions - lower)
+
+def _sorted_thresholds(chunks, thresholds):
+    thresholds = list(thresholds)
+    threshold_values = window_percentiles(chunks, thresholds)
+    # Percentiles grow with the percentile, so the values are sorted for any ascending list of thresholds
+    if np.any(np.diff(thresholds) < 0):
+        raise ValueError("Thresholds must be in ascending order.")
+    return thresholds, threshold_values
+
+def persistence_scores_all_thresholds(chunks, thresholds=PERCENTILE_THRESHOLDS):
+    """
+    Same result as reorder_handler.calculate_persistence_scores_all_thresholds for the window the blocks cover:
+    the fraction of frames each row is at or above every percentile of the window.
+
+    :return: A DataFrame of persistence scores, rows x thresholds.
+    """
+    thresholds, threshold_values = _sorted_thresholds(chunks, thresholds)
+    index, reached, n_frames = None, None, 0
+    for block in chunks():
+        values = _block_values(block)
+        if index is None:
+            index = block.index
+            reached = np.zeros((len(index), len(thresholds) + 1), dtype=np.int64)
+        reached += threshold_level_counts(values, threshold_values)
+        n_frames += values.shape[1]
+    if index is None:
+        return None
+    columns = pd.Index(thresholds, name='threshold')
+    if n_frames == 0:
+        return pd.DataFrame(np.nan, index=index, columns=columns)
+    return pd.DataFrame(frames_at_or_above(reached) / n_frames, index=index, columns=columns)
+
+def _carried_streaks(mask, carried):
+    # Longest run of True along the last axis when the run ending just before the block has length `carried`:
+    # those frames act as True frames in front of the block. Returns (longest run, run still open at the end).
+    # int32 halves the memory traffic of the accumulate (run lengths are frame counts)
+    positions = np.arange(mask.shape[-1], dtype=np.int32)
+    last_break = np.maximum.accumulate(np.where(mask, (-1 - carried[..., np.newaxis]).astype(np.int32), positions), axis=-1)
+    runs = positions - last_break
+    return runs.max(axis=-1), runs[..., -1]
+
+def longest_streaks_all_thresholds(chunks, thresholds=PERCENTILE_THRESHOLDS):
+    """
+    Same result as reorder_handler.detect_longest_streaks_all_thresholds for the window the blocks cover. The open
+    streak of every row and threshold is carried from one block into the next.
+
+    :return: A DataFrame of longest streak lengths, rows x thresholds.
+    """
+    thresholds, threshold_values = _sorted_thresholds(chunks, thresholds)
+    index, longest, current = None, None, None
+    for block in chunks():
+        values = _block_values(block)
+        if index is None:
+            index = block.index
+            longest = np.zeros((len(thresholds), len(index)), dtype=np.int64)
+            current = np.zeros_like(longest)
+        if values.shape[1] == 0:
+            continue
+        levels = threshold_levels(values, threshold_values)
+        batch_size = max(1, MAX_MASK_CELLS // values.size)
+        for start in range(0, len(thresholds), batch_size):
+            batch = slice(start, min(start + batch_size, len(thresholds)))
+            masks = levels[np.newaxis, :, :] > np.arange(batch.start, batch.stop)[:, np.newaxis, np.newaxis]
+            block_longest, current[batch] = _carried_streaks(masks, current[batch])
+            np.maximum(longest[batch], block_longest, out=longest[batch])
+    if index is None:
+        return None
+    return pd.DataFrame(longest.T, index=index, columns=pd.Index(thresholds, name='threshold'))
+
+def absolute_persistence_scores(chunks):
+    """Same result as reorder_handler.calculate_absolute_persistence_score: the mean of each row over the window."""
+    index, sums, counts = None, None, None
+    for block in chunks():
+        values = _block_values(block)
+        if index is None:
+            index, sums, counts = block.index, np.zeros(len(block)), np.zeros(len(block))
+        sums += np.nansum(values, axis=1)
+        counts += (~np.isnan(values)).sum(axis=1)
+    if index is None:
+        return None
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return pd.Series(sums / counts, index=index)
+
+def row_sums(chunks):
+    """Sum of each row over the window (NaN skipped), e.g. the totals the per frame distribution divides by."""
+    index, sums = None, None
+    for block in chunks():
+        if index is None:
+            index, sums = block.index, np.zeros(len(block))
+        sums += np.nansum(_block_values(block), axis=1)
+    return pd.Series(sums, index=index) if index is not None else None
+
+def KE_bin_starts(frame_min, frame_max, step_res):
+    """
+    The starts of the KE bins inside frames frame_min..frame_max: the multiples of step_res a bin of the whole run
+    starts at (see reorder_handler.compute_KE_bins), so bins line up whatever the window.
+    """
+    first = -(-frame_min // step_res) * step_res
+    return np.arange(first, frame_max + 1 - step_res + 1, step_res, dtype=np.int64)
+
+def compute_KE_bins_chunked(chunks, starts, step_res, KE_prc_threshold):
+    """
+    Same result as reorder_handler.compute_KE_bins for the bins starting at `starts` (frame labels): the window sums
+    and counts of every bin are accumulated block by block from each block's running sums.
+
+    :param chunks: Callable returning an iterator over the frame blocks (of the per frame distribution) covering the bins.
+    :param starts: Bin starts, see KE_bin_starts.
+    :return: A DataFrame with bin_frame_start, bin_frame_stop, bin_frame_mid and top_index columns.
+    """
+    if step_res < 1:
+        raise ValueError("The bin width (step_res) must be at least one frame.")
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = starts + step_res
+    index, sums, counts = None, None, None
+    for block in chunks():
+        values = _block_values(block)
+        if index is None:
+            index = block.index
+            sums = np.zeros((len(index), len(starts)))
+            counts = np.zeros((len(index), len(starts)))
+        if values.shape[1] == 0:
+            continue
+        valid = ~np.isnan(values)
+        block_sums = np.zeros((values.shape[0], values.shape[1] + 1))
+        block_counts = np.zeros((values.shape[0], values.shape[1] + 1))
+        np.cumsum(np.where(valid, values, 0.0), axis=1, out=block_sums[:, 1:])
+        np.cumsum(valid, axis=1, out=block_counts[:, 1:])
+        # The part of every bin [start, stop] (labels, inclusive) that falls into this block
+        frames = block.columns.to_numpy()
+        window_start = np.searchsorted(frames, starts, side='left')
+        window_stop = np.searchsorted(frames, stops, side='right')
+        sums += block_sums[:, window_stop] - block_sums[:, window_start]
+        counts += block_counts[:, window_stop] - block_counts[:, window_start]
+    if index is None or len(index) == 0 or len(starts) == 0:
+        return pd.DataFrame(columns=['bin_frame_start', 'bin_frame_stop', 'bin_frame_mid', 'top_index'])
+    top_num = min(max(int(np.floor(len(index) * KE_prc_threshold)), 1), len(index))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+    return top_KE_bins(means, index, starts, step_res, top_num)
@@ -0,0 +1,45 @@
+# run_similarity.py: Clustered heatmap of the top KE set overlap between every pair of runs
+import numpy as np
+import streamlit as st
+from similarity import compute_run_similarity, load_similarity, cluster_order
+from precompute import DEFAULT_STEP_RES, DEFAULT_KE_PRC_THRESHOLD
+from visualization import plot_similarity_heatmap
+
+st.set_page_config(page_title="Run Similarity", layout="wide", page_icon="favicon.ico")
+
+@st.cache_data(show_spinner=False)
+def cached_cluster_order(scores):
+    return cluster_order(scores)
+
+def main():
+    st.title("Run Similarity")
+    st.write("Pairs of runs are scored by how much their top KE residues/atoms overlap: per frame bin the Jaccard index of the two top sets, and for the whole run its mean over the bins. Runs are ordered by average linkage clustering of the whole run scores.")
+
+    resolution = st.sidebar.selectbox("Select Resolution", ["residue", "atom"], help='Compare the top residues or the top atoms of the runs.')
+    step_res = st.sidebar.number_input("Bin Width (frames)", min_value=1, value=DEFAULT_STEP_RES, step=1, help='Number of frames averaged into one bin when picking the most excited residues/atoms.')
+    KE_prc_threshold = st.sidebar.number_input("Top Fraction", min_value=0.01, max_value=1.0, value=DEFAULT_KE_PRC_THRESHOLD, step=0.01, help='Fraction of the residues/atoms in the top set of each bin.')
+
+    similarity = load_similarity(resolution, step_res, KE_prc_threshold)
+    if similarity is None:
+        st.info("The similarity of these settings has not been computed for the current runs yet (or is unfinished). "
+                "It can be computed here or ahead of time with `python similarity.py --workers 8`; pairs that are already scored are kept.")
+        if not st.button("Compute Similarity"):
+            return
+        with st.spinner("Scoring every pair of runs..."):
+            similarity = compute_run_similarity(resolution, step_res, KE_prc_threshold)
+        if similarity is None:
+            st.write("Error: At least two runs are needed for a similarity matrix.")
+            return
+
+    labels = similarity['runs']
+    order = cached_cluster_order(similarity['summary'])
+    bin_starts = similarity['bin_starts']
+    score_options = ["Whole Run"] + [f"Bin {start} - {start + step_res}" for start in bin_starts]
+    score_option = st.select_slider("Score", score_options, help='The whole run score, or the scores of a single frame bin (in the same run order).')
+    if score_option == "Whole Run":
+        scores = similarity['summary']
+    else:
+        scores = np.asarray(similarity['jaccard'][:, :, score_options.index(score_option) - 1])
+    plot_similarity_heatmap(scores, labels, order, f"Top {KE_prc_threshold * 100:g}% {resolution} overlap ({score_option})", key="similarity_heatmap")
+
+main()
@@ -0,0 +1,413 @@
+# pivot_cache.py: Process-wide bounded LRU cache for loaded and derived pivots
+import os
+import sys
+import threading
+import numpy as np
+import pandas as pd
+from cachetools import LRUCache
+from functools import partial
+from data_handler import load_dataset, load_dataset_window, iter_dataset_chunks
+from transforms import as_chain, chain_name, apply_stage
+from reorder_handler import calculate_reordering_scores, calculate_absolute_persistence_from_cumsum, compute_KE_bins, calculate_persistence_scores_all_thresholds, detect_longest_streaks_all_thresholds, PERCENTILE_THRESHOLDS
+from precompute import load_derived, persistence_table_name, streak_table_name, ke_bins_name, histogram_name, quantile_index_name
+from histogram import compute_base_histogram, rebin_histogram
+from ensemble import compute_ensemble, load_ensemble, ensemble_values, ENSEMBLE_WEB_MAX_VALUES
+from manifest_handler import get_manifest_version, get_dataset_source, source_signature
+from aggregation import DERIVED_RESOLUTIONS
+from quantile_index import QuantileIndex, quantile_tables
+from out_of_core import row_sums, persistence_scores_all_thresholds, longest_streaks_all_thresholds, absolute_persistence_scores, KE_bin_starts, compute_KE_bins_chunked
+
+# Memory budget of the shared cache, overridable through the environment
+DEFAULT_BUDGET_MB = int(os.environ.get("KE_CACHE_BUDGET_MB", 1024))
+
+def _is_memory_mapped(array):
+    # Walk the view chain: a memory-mapped pivot lives in the page cache, not on the heap
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+def estimate_nbytes(value):
+    """
+    Estimates the heap memory held by a cached value, in bytes.
+    Memory-mapped values only count their labels, since their data is paged in from disk on demand.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, pd.DataFrame):
+        labels = value.index.memory_usage() + value.columns.memory_usage()
+        if all(_is_memory_mapped(block.values) for block in value._mgr.blocks):
+            return int(labels)
+        return int(value.memory_usage(index=True, deep=False).sum() + value.columns.memory_usage())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=False))
+    if isinstance(value, pd.Index):
+        return int(value.memory_usage())
+    if isinstance(value, np.ndarray):
+        return 0 if _is_memory_mapped(value) else int(value.nbytes)
+    if isinstance(value, (tuple, list)):
+        return sum(estimate_nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(item) for item in value.values())
+    return sys.getsizeof(value)
+
+class _CountingLRUCache(LRUCache):
+    """LRUCache that counts the entries it evicts to stay within its budget."""
+
+    def __init__(self, maxsize, getsizeof=None):
+        super().__init__(maxsize, getsizeof=getsizeof)
+        self.evictions = 0
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+class PivotCache:
+    """
+    A size-aware LRU cache shared by every session of the app process.
+
+    Keys are (run_num, resolution, category, transform) tuples. Values are computed at most once per key,
+    even when several sessions ask for the same key at the same time.
+    """
+
+    def __init__(self, max_bytes):
+        self._cache = _CountingLRUCache(maxsize=max_bytes, getsizeof=estimate_nbytes)
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_bytes(self):
+        return self._cache.maxsize
+
+    def _get_key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for key, calling compute() to produce it on a miss.
+        None results are returned but not cached, so a missing dataset is looked up again next time.
+        """
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                return self._cache[key]
+
+        # Only one caller computes a given key, the others wait and then read the cached copy
+        with self._get_key_lock(key):
+            with self._lock:
+                if key in self._cache:
+                    self.hits += 1
+                    return self._cache[key]
+                self.misses += 1
+            value = compute()
+            if value is not None:
+                with self._lock:
+                    try:
+                        self._cache[key] = value
+                    except ValueError:
+                        # Larger than the whole budget: hand it back without caching
+                        pass
+        with self._lock:
+            self._key_locks.pop(key, None)
+        return value
+
+    def resize(self, max_bytes):
+        """Changes the memory budget, keeping the most recently used entries that still fit."""
+        with self._lock:
+            resized = _CountingLRUCache(maxsize=max_bytes, getsizeof=estimate_nbytes)
+            resized.evictions = self._cache.evictions
+            # Re-insert from least to most recently used so the LRU order is preserved
+            for key in list(self._cache.keys()):
+                try:
+                    resized[key] = self._cache[key]
+                except ValueError:
+                    continue
+            self._cache = resized
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+            self._cache.evictions = 0
+
+    def stats(self):
+        """Returns the hit/miss counters and memory use of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self._cache.evictions,
+                'entries': len(self._cache),
+                'current_bytes': self._cache.currsize,
+                'max_bytes': self._cache.maxsize,
+            }
+
+# The process-wide instance used by the app
+_pivot_cache = PivotCache(DEFAULT_BUDGET_MB * 1024 ** 2)
+
+def get_pivot_cache():
+    return _pivot_cache
+
+def configure_pivot_cache(max_mb):
+    """Sets the memory budget of the shared cache in megabytes."""
+    _pivot_cache.resize(int(max_mb * 1024 ** 2))
+
+def _dataset_key(run_num, resolution, category, spec):
+    # Keys carry the signature of the files a run is loaded from (its atom pivot for a derived resolution), so a pivot
+    # rewritten in place (e.g. by ingest.py or a converter the manifest watcher picks up) is loaded again instead of
+    # served from the cache
+    source = get_dataset_source(run_num, resolution, category)
+    if source is None and resolution in DERIVED_RESOLUTIONS:
+        source = get_dataset_source(run_num, 'atom', category)
+    try:
+        signature = source_signature(source) if source is not None else None
+    except FileNotFoundError:
+        # Removed while being looked at
+        signature = None
+    return (run_num, resolution, category, signature, spec)
+
+def get_cached_dataset(run_num, resolution, category, transform='raw', window=None):
+    """
+    Loads a dataset through the shared cache, memoized per (dataset, transform chain).
+    A chain is read from the artifacts of precompute.py when current; otherwise its last stage is applied to the
+    cached result of the rest of the chain, so chains sharing a prefix share the work.
+
+    Args:
+        run_num (str): The run number (e.g., '0500').
+        resolution (str): 'residue' or 'atom'.
+        category (str): 'effective', 'ineffective' or 'neutral'.
+        transform (str or tuple): A named transform ('raw', 'per_frame', 'log10', 'per_frame_log10')
+            or a chain of stages from transforms.py.
+        window (tuple): (frame_min, frame_max) to load only that frame window of a run too large to load whole
+            (see data_handler.load_dataset_window); None for the whole run.
+
+    Returns:
+        pd.DataFrame: The (transformed) pivot, or None if the dataset could not be loaded.
+    """
+    chain = as_chain(transform)
+    if window is not None:
+        window = (int(window[0]), int(window[1]))
+        key = _dataset_key(run_num, resolution, category, ('window', window, chain))
+        if not chain:
+            return _pivot_cache.get_or_compute(key, lambda: load_dataset_window(run_num, resolution, category, *window))
+
+        def compute_window():
+            data = get_cached_dataset(run_num, resolution, category, (), window)
+            return _window_view(data, run_num, resolution, category, chain) if data is not None else None
+        return _pivot_cache.get_or_compute(key, compute_window)
+
+    key = _dataset_key(run_num, resolution, category, chain)
+    if not chain:
+        return _pivot_cache.get_or_compute(key, lambda: load_dataset(run_num, resolution, category))
+
+    def compute():
+        name = chain_name(chain)
+        if name is not None:
+            precomputed = load_derived(run_num, resolution, category, name)
+            if precomputed is not None:
+                return precomputed
+        data = get_cached_dataset(run_num, resolution, category, chain[:-1])
+        return apply_stage(data, chain[-1]) if data is not None else None
+    return _pivot_cache.get_or_compute(key, compute)
+
+def get_cached_row_sums(run_num, resolution, category):
+    """Each row's total over the whole run, summed block by block (the totals the per frame distribution divides by)."""
+    key = _dataset_key(run_num, resolution, category, ('row_sums',))
+    return _pivot_cache.get_or_compute(key, lambda: row_sums(partial(iter_dataset_chunks, run_num, resolution, category)))
+
+def _window_view(pivot, run_num, resolution, category, chain):
+    # Applies a chain to frames of a run. The per frame distribution divides by the totals over the whole run, as it
+    # does for a whole pivot, so a window (or block) shows the same values as the same frames of the whole run.
+    for position, stage in enumerate(chain):
+        if stage[0] != 'normalize':
+            pivot = apply_stage(pivot, stage)
+            continue
+        if position > 0:
+            raise ValueError("Frame windows only support normalizing as the first transform stage.")
+        totals = get_cached_row_sums(run_num, resolution, category).reindex(pivot.index).to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = pivot.to_numpy(dtype=np.float64) / totals[:, np.newaxis] * 100
+        pivot = pd.DataFrame(values, index=pivot.index, columns=pivot.columns)
+    return pivot
+
+def _window_chunks(run_num, resolution, category, chain, frame_min, frame_max):
+    # The frame blocks of a window of a view, for the chunk by chunk computations of out_of_core.py
+    def chunks():
+        for block in iter_dataset_chunks(run_num, resolution, category, frame_min, frame_max):
+            yield _window_view(block, run_num, resolution, category, chain)
+    return chunks
+
+def get_cached_quantile_index(run_num, resolution, category, base_transform):
+    """
+    Returns the quantile_index.QuantileIndex of a run's view, which answers the percentiles of any frame window
+    without sorting it. Its arrays are read from precompute.py's artifact when current, built otherwise, and kept
+    in the shared cache.
+
+    Returns:
+        QuantileIndex: The index, or None if the dataset could not be loaded.
+    """
+    base_chain = as_chain(base_transform)
+    data = get_cached_dataset(run_num, resolution, category, base_chain)
+    if data is None:
+        return None
+    key = _dataset_key(run_num, resolution, category, ('quantile_tables', base_chain))
+
+    def compute():
+        base_name = chain_name(base_chain)
+        if base_name in ('raw', 'per_frame'):
+            tables = load_derived(run_num, resolution, category, quantile_index_name(base_name))
+            if tables is not None:
+                return tables
+        return quantile_tables(data)
+    return QuantileIndex(data, _pivot_cache.get_or_compute(key, compute))
+
+def get_cached_threshold_table(run_num, resolution, category, base_transform, reordering_option, frame_min, frame_max, out_of_core=False):
+    """
+    Returns the persistence or streak scores of a run for every percentile threshold (residues x thresholds)
+    through the shared cache, from the precomputed tables when they cover the frame window.
+    With out_of_core, the run is never loaded whole: the window is processed block by block (see out_of_core.py).
+    """
+    base_chain = as_chain(base_transform)
+    key = _dataset_key(run_num, resolution, category, ('threshold_table', base_chain, reordering_option, frame_min, frame_max))
+
+    def compute():
+        base_name = chain_name(base_chain)
+        # Precomputed tables exist for the raw and per frame views only
+        if base_name in ('raw', 'per_frame'):
+            table_name = (persistence_table_name if reordering_option == "Reordered by Persistence" else streak_table_name)(base_name, frame_min, frame_max)
+            table = load_derived(run_num, resolution, category, table_name)
+            if table is not None:
+                return table
+        if out_of_core:
+            chunks = _window_chunks(run_num, resolution, category, base_chain, frame_min, frame_max)
+            if reordering_option == "Reordered by Persistence":
+                return persistence_scores_all_thresholds(chunks)
+            return longest_streaks_all_thresholds(chunks)
+        quantile_index = get_cached_quantile_index(run_num, resolution, category, base_chain)
+        if quantile_index is None:
+            return None
+        # Threshold values of the window from the quantile index instead of a sort of the window
+        data = quantile_index.pivot
+        threshold_values = quantile_index.percentiles(frame_min, frame_max, PERCENTILE_THRESHOLDS)
+        if reordering_option == "Reordered by Persistence":
+            return calculate_persistence_scores_all_thresholds(data, frame_min, frame_max, PERCENTILE_THRESHOLDS, threshold_values)
+        return detect_longest_streaks_all_thresholds(data, frame_min, frame_max, PERCENTILE_THRESHOLDS, threshold_values)
+    return _pivot_cache.get_or_compute(key, compute)
+
+def get_cached_reordering_scores(run_num, resolution, category, base_transform, reordering_option, frame_min, frame_max, threshold, out_of_core=False):
+    """
+    Returns the reordering scores of a run (see reorder_handler.calculate_reordering_scores) through the shared cache.
+    Persistence and streak scores are a column of the all-threshold table, so moving the threshold slider is a lookup
+    (other thresholds read their value from the run's quantile index);
+    absolute persistence is read from the precomputed cumulative sums when available.
+    With out_of_core, scores are computed block by block over the frame window instead of from the whole run.
+    """
+    base_chain = as_chain(base_transform)
+    if reordering_option in ("Reordered by Persistence", "Reordered by Streak Length"):
+        table = get_cached_threshold_table(run_num, resolution, category, base_chain, reordering_option, frame_min, frame_max, out_of_core)
+        if table is not None and threshold in table.columns:
+            return table[threshold]
+
+    if reordering_option == "Reordered by Absolute Persistence":
+        threshold = None
+    key = _dataset_key(run_num, resolution, category, ('scores', base_chain, reordering_option, frame_min, frame_max, threshold))
+
+    def compute():
+        base_name = chain_name(base_chain)
+        if reordering_option == "Reordered by Absolute Persistence" and base_name in ('raw', 'per_frame'):
+            cumsum = load_derived(run_num, resolution, category, 'cumsum' if base_name == 'raw' else 'per_frame_cumsum')
+            if cumsum is not None:
+                return calculate_absolute_persistence_from_cumsum(cumsum, frame_min, frame_max)
+        if out_of_core and reordering_option == "Reordered by Absolute Persistence":
+            return absolute_persistence_scores(_window_chunks(run_num, resolution, category, base_chain, frame_min, frame_max))
+        if threshold is not None:
+            quantile_index = get_cached_quantile_index(run_num, resolution, category, base_chain)
+            if quantile_index is None:
+                return None
+            threshold_value = quantile_index.percentiles(frame_min, frame_max, [threshold])[0]
+            return calculate_reordering_scores(quantile_index.pivot, reordering_option, frame_min, frame_max, threshold, threshold_value)
+        data = get_cached_dataset(run_num, resolution, category, base_chain)
+        if data is None:
+            return None
+        return calculate_reordering_scores(data, reordering_option, frame_min, frame_max, threshold)
+    return _pivot_cache.get_or_compute(key, compute)
+
+def get_cached_KE_bins(run_num, resolution, category, step_res, KE_prc_threshold, window=None):
+    """
+    Returns the per run KE bins (see reorder_handler.compute_KE_bins) of the per frame distribution through the shared cache.
+    With a (frame_min, frame_max) window, only the bins inside it are computed, block by block (see out_of_core.py).
+    """
+    if window is not None:
+        starts = KE_bin_starts(int(window[0]), int(window[1]), step_res)
+        key = _dataset_key(run_num, resolution, category, ('ke_bins', step_res, KE_prc_threshold, tuple(window)))
+        # Bins include their stop frame, so the blocks run up to the stop of the last bin
+        chunks = _window_chunks(run_num, resolution, category, as_chain('per_frame'), int(window[0]), int(starts[-1]) + step_res if len(starts) else int(window[1]))
+        return _pivot_cache.get_or_compute(key, lambda: compute_KE_bins_chunked(chunks, starts, step_res, KE_prc_threshold))
+
+    key = _dataset_key(run_num, resolution, category, ('ke_bins', step_res, KE_prc_threshold))
+
+    def compute():
+        precomputed = load_derived(run_num, resolution, category, ke_bins_name(step_res, KE_prc_threshold))
+        if precomputed is not None:
+            return precomputed
+        data = get_cached_dataset(run_num, resolution, category, 'per_frame')
+        return compute_KE_bins(data, step_res, KE_prc_threshold) if data is not None else None
+    return _pivot_cache.get_or_compute(key, compute)
+
+def get_cached_base_histogram(run_num, resolution, category, transform='raw', window=None):
+    """
+    Returns the fine base histogram (counts, edges) of a dataset view (see histogram.compute_base_histogram)
+    through the shared cache, from the precomputed artifact for the named views (of the whole run only).
+    """
+    chain = as_chain(transform)
+    key = _dataset_key(run_num, resolution, category, ('base_histogram', chain, window))
+
+    def compute():
+        if window is not None:
+            data = get_cached_dataset(run_num, resolution, category, chain, window)
+            return compute_base_histogram(data) if data is not None else None
+        name = chain_name(chain)
+        if name is not None:
+            precomputed = load_derived(run_num, resolution, category, histogram_name(name))
+            if precomputed is not None:
+                return precomputed
+        data = get_cached_dataset(run_num, resolution, category, chain)
+        return compute_base_histogram(data) if data is not None else None
+    return _pivot_cache.get_or_compute(key, compute)
+
+def get_cached_histogram(run_num, resolution, category, transform, bin_number, range_min, range_max, window=None):
+    """
+    Returns the histogram (counts, edges) of a dataset view for one #Bins / plot range setting, re-binned from the
+    base histogram, so the raw values are not read again when the setting changes.
+    """
+    chain = as_chain(transform)
+    key = _dataset_key(run_num, resolution, category, ('histogram', chain, int(bin_number), float(range_min), float(range_max), window))
+
+    def compute():
+        base = get_cached_base_histogram(run_num, resolution, category, chain, window)
+        return rebin_histogram(*base, bin_number, range_min, range_max) if base is not None else None
+    return _pivot_cache.get_or_compute(key, compute)
+
+def get_cached_ensemble(resolution, category, transform='raw'):
+    """
+    Returns the ensemble statistics of a run category (see ensemble.compute_ensemble) through the shared cache,
+    computing and persisting them first when the cached ones are missing or stale. Categories of more than
+    ENSEMBLE_WEB_MAX_VALUES values are not reduced here: only their statistics precomputed with python ensemble.py
+    are returned, None while those are missing or stale.
+    """
+    # Keyed by the manifest's version, so runs added or changed since (see the manifest watcher) are reduced again
+    key = (None, resolution, category, ('ensemble', transform, get_manifest_version()))
+
+    def compute():
+        if ensemble_values(resolution, category) > ENSEMBLE_WEB_MAX_VALUES:
+            return load_ensemble(resolution, category, transform)
+        return compute_ensemble(resolution, category, transform)
+    return _pivot_cache.get_or_compute(key, compute)
@@ -0,0 +1,269 @@
+# pivot_store.py: Memory-mapped columnar storage for the KE pivot tables
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+# File names inside a store directory (pivots/<resolution>/<category>/data_pivot_<run>/)
+VALUES_FILE = "values.npy"
+INDEX_FILE = "index.npy"
+FRAMES_FILE = "frames.npy"
+META_FILE = "meta.json"
+# Frames per block of a frame-chunked store, and per block when iterating over any store
+DEFAULT_CHUNK_FRAMES = 1024
+
+def get_store_path(run_num, resolution, category, base_path="pivots"):
+    """
+    Returns the directory holding the memory-mapped store for a run.
+    The store sits next to the pickle it was converted from: data_pivot_<run>.pckl -> data_pivot_<run>/
+    """
+    return Path(base_path) / resolution / category / f"data_pivot_{run_num}"
+
+def has_store(store_path):
+    """
+    A store is only complete once its values file exists, since that file is always written last.
+    """
+    return (Path(store_path) / VALUES_FILE).exists()
+
+def _save_array(path, array):
+    # Write to a temporary file first so a reader never maps a half written array
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as file:
+        np.save(file, array, allow_pickle=False)
+    os.replace(tmp_path, path)
+
+def _chunked_shape(n_rows, n_frames, chunk_frames):
+    return (max(-(-n_frames // chunk_frames), 1), n_rows, chunk_frames)
+
+def _store_meta(index_name, frames_name, shape, dtype, chunk_frames):
+    meta = {
+        'index_name': index_name,
+        'frames_name': frames_name,
+        'shape': list(shape),
+        'dtype': np.dtype(dtype).name,
+    }
+    if chunk_frames:
+        meta['chunk_frames'] = int(chunk_frames)
+    return meta
+
+def write_store_frames(values, start, block, chunk_frames=None):
+    """
+    Writes a rows x k block into frames start..start + k - 1 (positions) of a store's values array, which is
+    rows x frames, or chunks x rows x chunk_frames for a frame-chunked store.
+    """
+    if not chunk_frames:
+        values[:, start:start + block.shape[1]] = block
+        return
+    position = 0
+    while position < block.shape[1]:
+        chunk, offset = divmod(start + position, chunk_frames)
+        width = min(chunk_frames - offset, block.shape[1] - position)
+        values[chunk, :, offset:offset + width] = block[:, position:position + width]
+        position += width
+
+def write_pivot_store(pivot, store_path, dtype=np.float64, chunk_frames=None):
+    """
+    Writes a pivot table (rows x frames) as a float array plus index and frame-axis sidecars.
+
+    With chunk_frames, the values are laid out frame-chunked (chunks x rows x chunk_frames, the last chunk padded
+    with NaN), so every block of chunk_frames frames is contiguous on disk and a frame window (see
+    load_pivot_window) only reads the chunks it overlaps.
+
+    Args:
+        pivot (pd.DataFrame): The pivot table to store.
+        store_path (str or Path): The store directory to write.
+        dtype (np.dtype): The float type of the stored values.
+        chunk_frames (int): Frames per chunk of a frame-chunked store; None for the plain rows x frames layout.
+
+    Returns:
+        Path: The store directory.
+    """
+    store_path = Path(store_path)
+    store_path.mkdir(parents=True, exist_ok=True)
+
+    index = pivot.index.to_numpy()
+    frames = pivot.columns.to_numpy()
+    if index.dtype == object or frames.dtype == object:
+        raise ValueError("Only numeric row and frame labels can be stored in a pivot store.")
+
+    meta = _store_meta(pivot.index.name, pivot.columns.name, pivot.shape, dtype, chunk_frames)
+    _save_array(store_path / INDEX_FILE, index)
+    _save_array(store_path / FRAMES_FILE, frames)
+    tmp_meta = store_path / (META_FILE + ".tmp")
+    tmp_meta.write_text(json.dumps(meta))
+    os.replace(tmp_meta, store_path / META_FILE)
+    # Values go last: their presence marks the store as complete
+    if chunk_frames:
+        values = np.full(_chunked_shape(*pivot.shape, chunk_frames), np.nan, dtype=dtype)
+        write_store_frames(values, 0, pivot.to_numpy(dtype=dtype), chunk_frames)
+    else:
+        values = np.ascontiguousarray(pivot.to_numpy(dtype=dtype))
+    _save_array(store_path / VALUES_FILE, values)
+    return store_path
+
+class PivotStoreWriter:
+    """
+    Writes a pivot store block of frames by block of frames, for pivots built from a stream (see ingest.py) that
+    never exist in memory as a whole. The values are filled into a memory-mapped temporary file, which other
+    processes may open by values_tmp_path to write their own frames, and only become the store's values file on
+    close, so a reader never sees a half written store.
+    """
+
+    def __init__(self, store_path, index, frames, index_name=None, frames_name='frame', dtype=np.float64, chunk_frames=None):
+        self.store_path = Path(store_path)
+        self.store_path.mkdir(parents=True, exist_ok=True)
+        index, frames = np.asarray(index), np.asarray(frames)
+        if index.dtype == object or frames.dtype == object:
+            raise ValueError("Only numeric row and frame labels can be stored in a pivot store.")
+        # An older store at the same place is replaced as a whole
+        if has_store(self.store_path):
+            os.remove(self.store_path / VALUES_FILE)
+        meta = _store_meta(index_name, frames_name, (len(index), len(frames)), dtype, chunk_frames)
+        _save_array(self.store_path / INDEX_FILE, index)
+        _save_array(self.store_path / FRAMES_FILE, frames)
+        tmp_meta = self.store_path / (META_FILE + ".tmp")
+        tmp_meta.write_text(json.dumps(meta))
+        os.replace(tmp_meta, self.store_path / META_FILE)
+        self.chunk_frames = chunk_frames
+        self.values_tmp_path = self.store_path / (VALUES_FILE + ".tmp")
+        shape = _chunked_shape(len(index), len(frames), chunk_frames) if chunk_frames else (len(index), len(frames))
+        self._values = np.lib.format.open_memmap(self.values_tmp_path, mode='w+', dtype=dtype, shape=shape)
+        if chunk_frames:
+            # Padding of the last chunk
+            self._values[-1] = np.nan
+
+    def write_frames(self, start, block):
+        """Writes a rows x k block of values into frames start..start + k - 1 (positions, not labels)."""
+        write_store_frames(self._values, start, block, self.chunk_frames)
+
+    def close(self):
+        """Completes the store; returns its path."""
+        self._values.flush()
+        del self._values
+        # Values go last: their presence marks the store as complete
+        os.replace(self.values_tmp_path, self.store_path / VALUES_FILE)
+        return self.store_path
+
+def load_pivot_store(store_path, mmap_mode='r'):
+    """
+    Opens a pivot store as a DataFrame backed directly by the memory-mapped values (no copy is made).
+    A frame-chunked store is read into memory as a whole; use load_pivot_window or iter_pivot_chunks for those.
+
+    Args:
+        store_path (str or Path): The store directory.
+        mmap_mode (str): Passed to np.load; 'r' keeps the values read-only.
+
+    Returns:
+        pd.DataFrame: The pivot table, rows x frames.
+    """
+    store_path = Path(store_path)
+    meta = read_store_meta(store_path)
+    if meta.get('chunk_frames'):
+        return load_pivot_window(store_path)
+    values = np.load(store_path / VALUES_FILE, mmap_mode=mmap_mode)
+    index = pd.Index(np.load(store_path / INDEX_FILE), name=meta['index_name'])
+    frames = pd.Index(np.load(store_path / FRAMES_FILE), name=meta['frames_name'])
+    return pd.DataFrame(values, index=index, columns=frames, copy=False)
+
+def read_store_meta(store_path):
+    return json.loads((Path(store_path) / META_FILE).read_text())
+
+def _window_positions(frames, frame_min, frame_max):
+    # Frame labels are sorted: the window frame_min..frame_max (inclusive, None for open) as positions start:stop
+    start = 0 if frame_min is None else int(np.searchsorted(frames, frame_min, side='left'))
+    stop = len(frames) if frame_max is None else int(np.searchsorted(frames, frame_max, side='right'))
+    return start, max(start, stop)
+
+def _read_frames(values, start, stop, chunk_frames):
+    # Positions start:stop of the values, touching only the chunks they overlap
+    if not chunk_frames:
+        return values[:, start:stop]
+    if stop <= start:
+        return np.empty((values.shape[1], 0), dtype=values.dtype)
+    first, last = start // chunk_frames, (stop - 1) // chunk_frames
+    block = np.concatenate(list(values[first:last + 1]), axis=1)
+    return block[:, start - first * chunk_frames:stop - first * chunk_frames]
+
+def load_pivot_window(store_path, frame_min=None, frame_max=None):
+    """
+    Loads frames frame_min..frame_max (labels, inclusive) of a pivot store. For a frame-chunked store only the
+    chunks overlapping the window are read and copied; for a plain store the result is a view of the memory map.
+
+    Returns:
+        pd.DataFrame: The pivot table of the window, rows x window frames.
+    """
+    store_path = Path(store_path)
+    meta = read_store_meta(store_path)
+    values = np.load(store_path / VALUES_FILE, mmap_mode='r')
+    frames = np.load(store_path / FRAMES_FILE)
+    start, stop = _window_positions(frames, frame_min, frame_max)
+    index = pd.Index(np.load(store_path / INDEX_FILE), name=meta['index_name'])
+    columns = pd.Index(frames[start:stop], name=meta['frames_name'])
+    return pd.DataFrame(_read_frames(values, start, stop, meta.get('chunk_frames')), index=index, columns=columns, copy=False)
+
+def iter_pivot_chunks(store_path, frame_min=None, frame_max=None, chunk_frames=None):
+    """
+    Yields the frames frame_min..frame_max of a pivot store as consecutive blocks of at most chunk_frames frames
+    (default: the store's own chunks, or DEFAULT_CHUNK_FRAMES for a plain store), each read on its own, so a window
+    of any length is processed with one block in memory at a time.
+
+    Yields:
+        pd.DataFrame: rows x block frames.
+    """
+    store_path = Path(store_path)
+    meta = read_store_meta(store_path)
+    store_chunk_frames = meta.get('chunk_frames')
+    chunk_frames = chunk_frames or store_chunk_frames or DEFAULT_CHUNK_FRAMES
+    values = np.load(store_path / VALUES_FILE, mmap_mode='r')
+    frames = np.load(store_path / FRAMES_FILE)
+    index = pd.Index(np.load(store_path / INDEX_FILE), name=meta['index_name'])
+    start, stop = _window_positions(frames, frame_min, frame_max)
+    if stop <= start:
+        # An empty window is still one (frameless) block, so the rows are known
+        yield pd.DataFrame(_read_frames(values, start, stop, store_chunk_frames), index=index, columns=pd.Index(frames[start:stop], name=meta['frames_name']), copy=False)
+        return
+    # Blocks are aligned to the chunk grid, so each one reads a single chunk of a chunked store
+    block_start = start
+    while block_start < stop:
+        block_stop = min((block_start // chunk_frames + 1) * chunk_frames, stop)
+        columns = pd.Index(frames[block_start:block_stop], name=meta['frames_name'])
+        yield pd.DataFrame(_read_frames(values, block_start, block_stop, store_chunk_frames), index=index, columns=columns, copy=False)
+        block_start = block_stop
+
+def convert_pickle_to_store(pickle_path, overwrite=False, dtype=np.float64, chunk_frames=None):
+    """
+    Converts a single data_pivot_<run>.pckl file into a store directory next to it.
+    Returns the store path, or None if the store already existed and overwrite is False.
+    """
+    pickle_path = Path(pickle_path)
+    store_path = pickle_path.with_suffix("")
+    if has_store(store_path) and not overwrite:
+        return None
+    pivot = pd.read_pickle(pickle_path)
+    return write_pivot_store(pivot, store_path, dtype=dtype, chunk_frames=chunk_frames)
+
+def convert_all_pickles(base_path="pivots", overwrite=False, dtype=np.float64, chunk_frames=None):
+    """
+    Converts every pickled pivot found under base_path/<resolution>/<category>/.
+    Returns the list of store directories that were written.
+    """
+    converted = []
+    for pickle_path in sorted(Path(base_path).glob("*/*/data_pivot_*.pckl")):
+        store_path = convert_pickle_to_store(pickle_path, overwrite=overwrite, dtype=dtype, chunk_frames=chunk_frames)
+        if store_path is not None:
+            print(f"Converted {pickle_path} -> {store_path}")
+            converted.append(store_path)
+    return converted
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert pickled KE pivots into memory-mapped stores.")
+    parser.add_argument("--base-path", default="pivots", help="Root of the pivots directory tree.")
+    parser.add_argument("--overwrite", action="store_true", help="Rewrite stores that already exist.")
+    parser.add_argument("--float32", action="store_true", help="Store values as float32 to halve disk use.")
+    parser.add_argument("--chunk-frames", type=int, default=None, help=f"Write frame-chunked stores with this many frames per chunk (e.g. {DEFAULT_CHUNK_FRAMES}) for runs too long to load whole.")
+    args = parser.parse_args()
+
+    converted = convert_all_pickles(args.base_path, overwrite=args.overwrite, dtype=np.float32 if args.float32 else np.float64, chunk_frames=args.chunk_frames)
+    print(f"Converted {len(converted)} pivot(s).")
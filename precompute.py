@@ -0,0 +1,266 @@
+# precompute.py: Offline batch precompute of the derived artifacts the app would otherwise build on first view
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from data_handler import normalize_per_frame
+from transforms import apply_transform_chain
+from reorder_handler import calculate_persistence_scores_all_thresholds, detect_longest_streaks_all_thresholds, compute_KE_bins, PERCENTILE_THRESHOLDS
+from histogram import compute_base_histogram, compute_base_histogram_chunked
+from quantile_index import quantile_tables
+from pivot_store import get_store_path, write_pivot_store, load_pivot_store, has_store, read_store_meta, iter_pivot_chunks, PivotStoreWriter, INDEX_FILE, FRAMES_FILE
+from out_of_core import row_sums, persistence_scores_all_thresholds, longest_streaks_all_thresholds, KE_bin_starts, compute_KE_bins_chunked
+from manifest_handler import get_dataset_source, source_signature, register_datasets_from_manifest, refresh_manifest
+
+DERIVED_DIR = "derived"
+DERIVED_META_FILE = "meta.json"
+# Bumped whenever an artifact's definition changes, so older artifacts are recomputed instead of used
+DERIVED_FORMAT_VERSION = 4
+
+# Defaults matching the sidebar, so a first view finds its artifacts ready
+DEFAULT_FRAME_MIN = 42
+DEFAULT_STEP_RES = 5
+DEFAULT_KE_PRC_THRESHOLD = 0.1
+
+def get_derived_path(run_num, resolution, category, base_path="pivots"):
+    """Derived artifacts live inside the run's store directory: data_pivot_<run>/derived/."""
+    return get_store_path(run_num, resolution, category, base_path) / DERIVED_DIR
+
+def persistence_table_name(base_transform, frame_min, frame_max):
+    return f"persistence_{base_transform}_{frame_min}_{frame_max}"
+
+def streak_table_name(base_transform, frame_min, frame_max):
+    return f"streak_{base_transform}_{frame_min}_{frame_max}"
+
+def ke_bins_name(step_res, KE_prc_threshold):
+    return f"ke_bins_{step_res}_{KE_prc_threshold}"
+
+def quantile_index_name(base_transform):
+    return f"quantile_index_{base_transform}"
+
+def histogram_name(transform):
+    return f"histogram_{transform}"
+
+def _is_current(derived_path, run_num, resolution, category, base_path):
+    # Artifacts are only valid for the exact pivot file they were computed from
+    meta_path = derived_path / DERIVED_META_FILE
+    source = get_dataset_source(run_num, resolution, category, base_path)
+    if source is None or not meta_path.exists():
+        return False
+    try:
+        meta = json.loads(meta_path.read_text())
+    except (OSError, ValueError):
+        return False
+    if meta.get('format_version') != DERIVED_FORMAT_VERSION:
+        return False
+    return [meta.get('source_mtime_ns'), meta.get('source_size')] == list(source_signature(source))
+
+def load_derived(run_num, resolution, category, name, base_path="pivots"):
+    """
+    Loads a precomputed artifact, or returns None if it is missing or older than the pivot it was derived from.
+
+    Args:
+        run_num (str): The run number (e.g., '0500').
+        resolution (str): 'residue' or 'atom'.
+        category (str): 'effective', 'ineffective' or 'neutral'.
+        name (str): The artifact name (e.g. 'per_frame', 'log10', or one made by the *_name helpers).
+
+    Returns:
+        pd.DataFrame: The artifact (memory-mapped for table artifacts), or None.
+    """
+    derived_path = get_derived_path(run_num, resolution, category, base_path)
+    if not _is_current(derived_path, run_num, resolution, category, base_path):
+        return None
+    try:
+        if has_store(derived_path / name):
+            return load_pivot_store(derived_path / name)
+        pickle_path = derived_path / f"{name}.pckl"
+        if pickle_path.exists():
+            return pd.read_pickle(pickle_path)
+    except Exception as e:
+        print(f"Error loading derived artifact {name} of run {run_num}: {e}")
+    return None
+
+def _precompute_in_memory(raw, derived_path, frame_min, frame_max, step_res, KE_prc_threshold):
+    # Every artifact of a run loaded whole; returns the names written
+    per_frame = normalize_per_frame(raw)
+    window_max = int(raw.columns.max()) if frame_max is None else frame_max
+    written = []
+    for base_transform, data in [('raw', raw), ('per_frame', per_frame)]:
+        prefix = '' if base_transform == 'raw' else 'per_frame_'
+        tables = {
+            f"{prefix}log10": apply_transform_chain(data, 'log10'),
+            # Absolute persistence of any frame window is a difference of two cumsum columns
+            f"{prefix}cumsum": data.cumsum(axis=1),
+            persistence_table_name(base_transform, frame_min, window_max): calculate_persistence_scores_all_thresholds(data, frame_min, window_max, PERCENTILE_THRESHOLDS),
+            streak_table_name(base_transform, frame_min, window_max): detect_longest_streaks_all_thresholds(data, frame_min, window_max, PERCENTILE_THRESHOLDS),
+        }
+        if base_transform == 'per_frame':
+            tables['per_frame'] = per_frame
+        for name, table in tables.items():
+            write_pivot_store(table, derived_path / name)
+            written.append(name)
+        # Percentiles of any frame window, for persistence and streak tables of windows not precomputed here
+        pd.to_pickle(quantile_tables(data), derived_path / f"{quantile_index_name(base_transform)}.pckl")
+        written.append(quantile_index_name(base_transform))
+        # Base histograms of the linear and log10 views, re-binned by the app for any #Bins / plot range
+        for name, view in [(base_transform, data), (f"{prefix}log10", tables[f"{prefix}log10"])]:
+            pd.to_pickle(compute_base_histogram(view), derived_path / f"{histogram_name(name)}.pckl")
+            written.append(histogram_name(name))
+
+    # KE pairs are always built from the per frame distribution
+    ke_bins = compute_KE_bins(per_frame, step_res, KE_prc_threshold)
+    ke_bins.to_pickle(derived_path / f"{ke_bins_name(step_res, KE_prc_threshold)}.pckl")
+    written.append(ke_bins_name(step_res, KE_prc_threshold))
+    return written
+
+def _precompute_chunked(source, derived_path, frame_min, frame_max, step_res, KE_prc_threshold):
+    """
+    The artifacts of a frame-chunked store, a run too large to load whole, built chunk by chunk as
+    manifest_handler.describe_chunked_store reads it: the views and cumulative sums are written as frame-chunked
+    stores one block at a time and the tables come from out_of_core.py. The quantile index needs one sort of the whole
+    run and is skipped; the app's out-of-core path computes window percentiles from the chunks instead.
+
+    Returns:
+        list: The names of the artifacts written.
+    """
+    meta = read_store_meta(source)
+    chunk_frames = meta['chunk_frames']
+    index = np.load(source / INDEX_FILE)
+    frames = np.load(source / FRAMES_FILE)
+    totals = row_sums(partial(iter_pivot_chunks, source))
+
+    def raw_chunks(window_min=None, window_max=None):
+        return iter_pivot_chunks(source, window_min, window_max)
+
+    def per_frame_chunks(window_min=None, window_max=None):
+        # As normalize_per_frame: each block divided by the row totals over the whole run
+        for block in iter_pivot_chunks(source, window_min, window_max):
+            yield block.div(totals, axis=0) * 100
+
+    def log10_chunks(view_chunks):
+        return lambda: (apply_transform_chain(block, 'log10') for block in view_chunks())
+
+    window_max = int(frames.max()) if frame_max is None else frame_max
+    written = []
+    for base_transform, view_chunks in [('raw', raw_chunks), ('per_frame', per_frame_chunks)]:
+        prefix = '' if base_transform == 'raw' else 'per_frame_'
+        names = [f"{prefix}log10", f"{prefix}cumsum"] + (['per_frame'] if base_transform == 'per_frame' else [])
+        writers = {name: PivotStoreWriter(derived_path / name, index, frames, meta['index_name'], meta['frames_name'], chunk_frames=chunk_frames) for name in names}
+        # Absolute persistence of any frame window is a difference of two cumsum columns; the sum of the earlier
+        # blocks is carried into each block
+        carried = np.zeros(len(index))
+        position = 0
+        for block in view_chunks():
+            writers[f"{prefix}log10"].write_frames(position, apply_transform_chain(block, 'log10').to_numpy(dtype=np.float64))
+            writers[f"{prefix}cumsum"].write_frames(position, block.cumsum(axis=1).to_numpy(dtype=np.float64) + carried[:, np.newaxis])
+            carried += np.nansum(block.to_numpy(dtype=np.float64), axis=1)
+            if base_transform == 'per_frame':
+                writers['per_frame'].write_frames(position, block.to_numpy(dtype=np.float64))
+            position += block.shape[1]
+        for name, writer in writers.items():
+            writer.close()
+            written.append(name)
+
+        window_chunks = partial(view_chunks, frame_min, window_max)
+        tables = {
+            persistence_table_name(base_transform, frame_min, window_max): persistence_scores_all_thresholds(window_chunks, PERCENTILE_THRESHOLDS),
+            streak_table_name(base_transform, frame_min, window_max): longest_streaks_all_thresholds(window_chunks, PERCENTILE_THRESHOLDS),
+        }
+        for name, table in tables.items():
+            write_pivot_store(table, derived_path / name)
+            written.append(name)
+        print(f"Skipping {quantile_index_name(base_transform)} of {source}: it needs the whole run in memory.")
+        for name, chunks in [(base_transform, view_chunks), (f"{prefix}log10", log10_chunks(view_chunks))]:
+            pd.to_pickle(compute_base_histogram_chunked(chunks), derived_path / f"{histogram_name(name)}.pckl")
+            written.append(histogram_name(name))
+
+    # KE pairs are always built from the per frame distribution; bins as compute_KE_bins makes them for the whole run
+    starts = KE_bin_starts(0, len(frames) - 1, step_res)
+    ke_bins = compute_KE_bins_chunked(partial(per_frame_chunks, None, int(starts[-1]) + step_res if len(starts) else None), starts, step_res, KE_prc_threshold)
+    ke_bins.to_pickle(derived_path / f"{ke_bins_name(step_res, KE_prc_threshold)}.pckl")
+    written.append(ke_bins_name(step_res, KE_prc_threshold))
+    return written
+
+def precompute_run(run_num, resolution, category, base_path="pivots", frame_min=DEFAULT_FRAME_MIN, frame_max=None, step_res=DEFAULT_STEP_RES, KE_prc_threshold=DEFAULT_KE_PRC_THRESHOLD, overwrite=False):
+    """
+    Computes and writes every derived artifact of one run. Runs whose artifacts are current are skipped
+    unless overwrite is set.
+
+    Returns:
+        tuple: (run key, list of artifact names written).
+    """
+    key = f"{resolution}/{category}/{run_num}"
+    derived_path = get_derived_path(run_num, resolution, category, base_path)
+    if not overwrite and _is_current(derived_path, run_num, resolution, category, base_path):
+        return key, []
+    source = get_dataset_source(run_num, resolution, category, base_path)
+    if source is None:
+        return key, []
+    # Taken before loading: a pivot replaced mid-run then reads as stale instead of current
+    signature = source_signature(source)
+
+    derived_path.mkdir(parents=True, exist_ok=True)
+    # Drop the stamp first so readers never pair old artifacts with a new pivot
+    (derived_path / DERIVED_META_FILE).unlink(missing_ok=True)
+
+    if source.is_dir() and read_store_meta(source).get('chunk_frames'):
+        written = _precompute_chunked(source, derived_path, frame_min, frame_max, step_res, KE_prc_threshold)
+    else:
+        raw = load_pivot_store(source) if source.is_dir() else pd.read_pickle(source)
+        written = _precompute_in_memory(raw, derived_path, frame_min, frame_max, step_res, KE_prc_threshold)
+
+    meta_tmp = derived_path / (DERIVED_META_FILE + ".tmp")
+    meta_tmp.write_text(json.dumps({'format_version': DERIVED_FORMAT_VERSION, 'source_mtime_ns': signature[0], 'source_size': signature[1], 'artifacts': written}))
+    os.replace(meta_tmp, derived_path / DERIVED_META_FILE)
+    return key, written
+
+def precompute_all(base_path="pivots", workers=None, overwrite=False, **kwargs):
+    """
+    Precomputes the artifacts of every run in the pivots tree, one run per worker process.
+
+    Returns:
+        dict: Artifact names written, keyed by 'resolution/category/run'.
+    """
+    refresh_manifest(base_path)
+    runs = [
+        (run_num, resolution, category)
+        for (resolution, category), run_nums in register_datasets_from_manifest(base_path).items()
+        for run_num in run_nums
+    ]
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(precompute_run, run_num, resolution, category, base_path, overwrite=overwrite, **kwargs): (run_num, resolution, category)
+            for run_num, resolution, category in runs
+        }
+        for future in as_completed(futures):
+            run_num, resolution, category = futures[future]
+            try:
+                key, written = future.result()
+            except Exception as e:
+                print(f"Error precomputing {resolution}/{category}/{run_num}: {e}")
+                continue
+            results[key] = written
+            print(f"{key}: {len(written)} artifact(s) written" if written else f"{key}: up to date")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute derived KE artifacts for every run in the pivots tree.")
+    parser.add_argument("--base-path", default="pivots", help="Root of the pivots directory tree.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPU count).")
+    parser.add_argument("--overwrite", action="store_true", help="Recompute artifacts that are already current.")
+    parser.add_argument("--frame-min", type=int, default=DEFAULT_FRAME_MIN, help="First frame of the persistence/streak window.")
+    parser.add_argument("--frame-max", type=int, default=None, help="Last frame of the persistence/streak window (default: last frame).")
+    parser.add_argument("--step-res", type=int, default=DEFAULT_STEP_RES, help="KE pair bin width in frames.")
+    parser.add_argument("--ke-prc-threshold", type=float, default=DEFAULT_KE_PRC_THRESHOLD, help="Fraction of residues/atoms kept per KE pair bin.")
+    args = parser.parse_args()
+
+    results = precompute_all(
+        args.base_path, workers=args.workers, overwrite=args.overwrite,
+        frame_min=args.frame_min, frame_max=args.frame_max, step_res=args.step_res, KE_prc_threshold=args.ke_prc_threshold,
+    )
+    print(f"Precomputed {sum(1 for written in results.values() if written)} of {len(results)} run(s).")
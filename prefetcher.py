@@ -0,0 +1,101 @@
+# prefetcher.py: Background warming of the structures of neighbouring KE bins
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from molvis import generate_structure_url
+
+DEFAULT_WORKERS = 2
+# At most this many frame loads are queued or running; further requests of a selection are dropped
+DEFAULT_MAX_PENDING = 8
+# Bins warmed on each side of the selected bin
+DEFAULT_PREFETCH_BINS = 2
+
+def neighbour_frames(center_frame, step_res, n_bins=DEFAULT_PREFETCH_BINS, max_frame=None):
+    """
+    Bin centers around center_frame, nearest first and the next bin before the previous one at each distance,
+    i.e. in the order Next/Prev paging is most likely to reach them.
+    """
+    frames = []
+    for distance in range(1, n_bins + 1):
+        for frame in (center_frame + distance * step_res, center_frame - distance * step_res):
+            if frame >= 0 and (max_frame is None or frame <= max_frame):
+                frames.append(frame)
+    return frames
+
+class FramePrefetcher:
+    """
+    Loads trajectory frames on a small thread pool ahead of the user, so Prev/Next finds them in the frame cache
+    of molvis (which is shared by every session of the process) and already published as static files.
+
+    Every prefetch call starts a new generation: work queued for an older selection is cancelled, and a job that
+    was already picked up checks its generation before loading, so a jump in the selection never waits behind
+    stale frames.
+    """
+
+    def __init__(self, load_frame=generate_structure_url, workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING):
+        self._load_frame = load_frame
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="frame-prefetch")
+        self._max_pending = max_pending
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.loaded = 0
+        self.cancelled = 0
+
+    def _run(self, generation, pdb_file_path, frame_number):
+        if generation != self._generation:
+            with self._lock:
+                self.cancelled += 1
+            return
+        try:
+            self._load_frame(pdb_file_path, frame_number)
+        except Exception as e:
+            print(f"Error prefetching frame {frame_number} of {pdb_file_path}: {e}")
+            return
+        with self._lock:
+            self.loaded += 1
+
+    def cancel(self):
+        """Drops all queued work and marks running work as stale."""
+        with self._lock:
+            self._generation += 1
+            while self._pending:
+                if self._pending.popleft().cancel():
+                    self.cancelled += 1
+
+    def prefetch(self, pdb_file_paths, center_frame, step_res, n_bins=DEFAULT_PREFETCH_BINS, max_frame=None):
+        """
+        Replaces any queued work with loading the neighbouring bins of center_frame for every trajectory.
+
+        Args:
+            pdb_file_paths (list): Trajectories to warm (e.g. the reference and comparison runs).
+            center_frame (int): The bin center currently shown.
+            step_res (int): Bin width in frames, the Prev/Next step.
+            n_bins (int): Bins to warm on each side.
+            max_frame (int): Last frame that exists, or None.
+
+        Returns:
+            int: The number of frame loads queued.
+        """
+        self.cancel()
+        paths = [str(path) for path in dict.fromkeys(pdb_file_paths) if os.path.exists(path)]
+        queued = 0
+        with self._lock:
+            generation = self._generation
+            for frame in neighbour_frames(center_frame, step_res, n_bins, max_frame):
+                for path in paths:
+                    if len(self._pending) >= self._max_pending:
+                        return queued
+                    self._pending.append(self._executor.submit(self._run, generation, path, frame))
+                    queued += 1
+        return queued
+
+    def shutdown(self, wait=True):
+        """Stops the pool after the queued work is done (call cancel first to drop it)."""
+        self._executor.shutdown(wait=wait)
+
+_frame_prefetcher = FramePrefetcher()
+
+def get_frame_prefetcher():
+    return _frame_prefetcher
@@ -0,0 +1,131 @@
+# quantile_index.py: Per frame block sorted-rank index answering exact percentiles of any frame window without a full sort
+import numpy as np
+from out_of_core import percentile_lerp
+
+# Frames per block of the index: windows are covered by whole blocks plus at most two partial blocks at the edges,
+# whose values are ranked on the fly
+QUANTILE_BLOCK_FRAMES = 128
+
+def quantile_tables(pivot, block_frames=QUANTILE_BLOCK_FRAMES):
+    """
+    Builds the arrays of a QuantileIndex with one sort of the whole pivot.
+
+    Every non-NaN value gets its rank among all values of the pivot (the position of its first equal value), and the
+    ranks of every block of frames are sorted and stored as block * n_values + rank, so one searchsorted counts the
+    values below any rank in all blocks at once.
+
+    :param pivot: The pivot table (rows x frames).
+    :param block_frames: Frames per block.
+    :return: A dict of arrays: sorted_values, keys, block_starts (offsets into keys), nan_counts (per block) and block_frames.
+    """
+    if block_frames < 1:
+        raise ValueError("Blocks must hold at least one frame.")
+    values = pivot.to_numpy(dtype=np.float64)
+    n_blocks = -(-values.shape[1] // block_frames)
+    nan_counts = np.zeros(n_blocks, dtype=np.int64)
+    if n_blocks:
+        nan_counts[:] = np.add.reduceat(np.isnan(values).sum(axis=0), np.arange(0, values.shape[1], block_frames))
+    # Block-major order of the cells, so every block is one contiguous slice
+    padded = np.full((values.shape[0], n_blocks * block_frames), np.nan)
+    padded[:, :values.shape[1]] = values
+    cells = padded.reshape(values.shape[0], n_blocks, block_frames).transpose(1, 0, 2).ravel()
+    valid = ~np.isnan(cells)
+    block_starts = np.zeros(n_blocks + 1, dtype=np.int64)
+    np.cumsum(valid.reshape(n_blocks, -1).sum(axis=1), out=block_starts[1:])
+    cells = cells[valid]
+
+    # Rank of every value: its position in the sorted values, shared by equal values (that of the first one)
+    order = np.argsort(cells)
+    sorted_values = cells[order]
+    n_values = len(sorted_values)
+    first_equal = np.arange(n_values, dtype=np.int64)
+    first_equal[1:][sorted_values[1:] == sorted_values[:-1]] = 0
+    np.maximum.accumulate(first_equal, out=first_equal)
+    ranks = np.empty(n_values, dtype=np.int64)
+    ranks[order] = first_equal
+    del order, first_equal
+
+    # Keys of block b lie in [b * n_values, (b + 1) * n_values), so one sort orders every block's ranks
+    keys = np.repeat(np.arange(n_blocks, dtype=np.int64) * n_values, np.diff(block_starts)) + ranks
+    del ranks
+    keys.sort()
+    return {'sorted_values': sorted_values, 'keys': keys, 'block_starts': block_starts, 'nan_counts': nan_counts, 'block_frames': block_frames}
+
+class QuantileIndex:
+    """
+    Exact percentiles (as np.nanpercentile with linear interpolation) of any frame window of a pivot.
+
+    The order statistics a percentile needs are found by bisecting over the ranks of the pivot's values: each step
+    counts the values of the window at or below a rank with one searchsorted per step over the sorted ranks of the
+    whole blocks (see quantile_tables), plus the few edge frames, so a query costs O(blocks * log n) instead of a sort
+    of the window.
+    """
+
+    def __init__(self, pivot, tables=None, block_frames=QUANTILE_BLOCK_FRAMES):
+        """
+        :param pivot: The pivot table the index was built from (its edge frames are read at query time).
+        :param tables: The arrays from quantile_tables (e.g. precomputed); built from the pivot when None.
+        """
+        self.pivot = pivot
+        self.tables = tables if tables is not None else quantile_tables(pivot, block_frames)
+        self.block_frames = int(self.tables['block_frames'])
+
+    def _window_counts(self, frame_min, frame_max):
+        # Whole blocks and sorted edge ranks of frames frame_min..frame_max (labels, inclusive)
+        frames = self.pivot.columns.to_numpy()
+        start = np.searchsorted(frames, frame_min, side='left')
+        stop = np.searchsorted(frames, frame_max, side='right')
+        first_block = -(-start // self.block_frames)
+        last_block = max(stop // self.block_frames, first_block)
+        if first_block * self.block_frames >= stop:
+            edge_slices = [slice(start, stop)]
+        else:
+            edge_slices = [slice(start, first_block * self.block_frames), slice(last_block * self.block_frames, stop)]
+        values = self.pivot.to_numpy(dtype=np.float64)
+        edge_values = np.concatenate([values[:, edge].ravel() for edge in edge_slices])
+        blocks = np.arange(first_block, last_block)
+        # NaN values are left out, as in the tables; sorted lookups stay within the cache, and their ranks come out sorted
+        edge_ranks = np.searchsorted(self.tables['sorted_values'], np.sort(edge_values[~np.isnan(edge_values)]), side='left')
+        return blocks, edge_ranks
+
+    def percentiles(self, frame_min, frame_max, percentiles):
+        """
+        Percentiles of all values in frames frame_min..frame_max.
+
+        :param frame_min: The first frame of the window.
+        :param frame_max: The last frame of the window.
+        :param percentiles: Percentiles in [0, 100].
+        :return: An array of one value per percentile of the window's non-NaN values (as np.nanpercentile and
+            out_of_core.window_percentiles), NaN for a window without any.
+        """
+        percentiles = np.asarray(percentiles, dtype=np.float64)
+        blocks, edge_ranks = self._window_counts(frame_min, frame_max)
+        keys, block_starts = self.tables['keys'], self.tables['block_starts']
+        sorted_values = self.tables['sorted_values']
+        n_window = int((block_starts[blocks + 1] - block_starts[blocks]).sum()) + len(edge_ranks)
+        if n_window == 0:
+            return np.full(len(percentiles), np.nan)
+
+        positions = percentiles / 100 * (n_window - 1)
+        lower = np.floor(positions).astype(np.int64)
+        upper = np.minimum(lower + 1, n_window - 1)
+        ranks = np.unique(np.concatenate([lower, upper]))
+
+        # Smallest value rank at or below which the window holds more than `rank` values, for all wanted ranks at once
+        n_values = len(sorted_values)
+        block_offsets = (blocks * n_values)[:, np.newaxis]
+        low = np.zeros(len(ranks), dtype=np.int64)
+        high = np.full(len(ranks), n_values - 1, dtype=np.int64)
+        while np.any(low < high):
+            middle = (low + high) // 2
+            counts = (np.searchsorted(keys, block_offsets + middle, side='right') - block_starts[blocks][:, np.newaxis]).sum(axis=0)
+            counts += np.searchsorted(edge_ranks, middle, side='right')
+            reached = counts > ranks
+            high = np.where(reached, middle, high)
+            low = np.where(reached, low, middle + 1)
+        order_statistics = sorted_values[low]
+
+        def order_statistic(rank):
+            return order_statistics[np.searchsorted(ranks, rank)]
+
+        return percentile_lerp(order_statistic(lower), order_statistic(upper), positions - lower)
@@ -1,7 +1,8 @@
 # reorder_handler.py: Reordering Functions for Kinetic Energy Data
 import pandas as pd
 import numpy as np
-import itertools
+from topology import load_topology
+from aggregation import DERIVED_RESOLUTIONS
 
 # Function to calculate reordering statistics based on primary and secondary frame ranges
 def calculate_reordering(reference_pivot, primary_range, secondary_range):
@@ -37,13 +38,14 @@ def calculate_reordering(reference_pivot, primary_range, secondary_range):
 
 # Function to calculate persistence scores and streak lengths for reordering
 
-def calculate_persistence_score(df, frame_min, frame_max, threshold):
+def calculate_persistence_score(df, frame_min, frame_max, threshold, threshold_value=None):
     """
     Calculate the persistence score for each residue, based on the proportion of frames where KE is above a threshold.
     
     :param df: The pivot table of KE values (residues x frames).
     :param frame_min: The minimum frame to consider for persistence detection.
     :param threshold: The threshold (percentile) above which we consider values for persistence detection.
+    :param threshold_value: The value of that percentile over the window, if already known (see quantile_index.py).
     :return: A Series with the persistence score for each residue.
 
     Args:
@@ -58,7 +60,8 @@ def calculate_persistence_score(df, frame_min, frame_max, threshold):
     df_region = df.loc[:, (df.columns >= frame_min) & (df.columns <= frame_max)]
     
     # Calculate the threshold value based on the provided percentile
-    threshold_value = np.percentile(df_region.values, threshold)
+    if threshold_value is None:
+        threshold_value = np.nanpercentile(df_region.values, threshold)
     
     # Create a mask where values above the threshold are True
     above_threshold = df_region >= threshold_value
@@ -90,148 +93,356 @@ def calculate_absolute_persistence_score(df, frame_min, frame_max):
     persistence_scores = df_region.mean(axis=1)
     return persistence_scores
 
-def detect_longest_streak(df, frame_min, frame_max, threshold):
+# Upper bound on the cells of one boolean mask batch in the all-threshold functions (keeps memory to tens of MB)
+MAX_MASK_CELLS = 2 ** 24
+PERCENTILE_THRESHOLDS = list(range(0, 101))
+
+def longest_streaks(mask):
+    """
+    Longest run of True values along the last axis of a boolean array, in one vectorized pass.
+
+    :param mask: A boolean array (rows x frames, or any leading shape x frames).
+    :return: An integer array of the leading shape with the longest run per row, 0 for rows without a True value.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape[-1] == 0:
+        return np.zeros(mask.shape[:-1], dtype=np.int64)
+    positions = np.arange(mask.shape[-1], dtype=np.int32)
+    # Position of the most recent False at or before each frame (-1 if none), so a True frame's run length is
+    # its distance to that break and a False frame's is 0
+    last_break = np.maximum.accumulate(np.where(mask, np.int32(-1), positions), axis=-1)
+    return (positions - last_break).max(axis=-1).astype(np.int64)
+
+def threshold_levels(values, threshold_values):
+    """
+    Per value, how many of the (ascending) threshold values it reaches: value >= threshold_values[j] exactly when
+    its level is above j. NaN values reach none.
+    """
+    levels = np.searchsorted(threshold_values, values, side='right')
+    levels[np.isnan(values)] = 0
+    return levels
+
+def threshold_level_counts(values, threshold_values):
+    """Histogram of the threshold levels of every row (rows x frames -> rows x (thresholds + 1)), in one bincount."""
+    n_levels = len(threshold_values) + 1
+    flat = (np.arange(values.shape[0])[:, np.newaxis] * n_levels + threshold_levels(values, threshold_values)).ravel()
+    return np.bincount(flat, minlength=values.shape[0] * n_levels).reshape(values.shape[0], n_levels)
+
+def frames_at_or_above(level_counts):
+    """Frames at or above every threshold from the level histograms of threshold_level_counts: those with a level above it."""
+    return np.cumsum(level_counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+
+def _window_threshold_values(values, thresholds, threshold_values):
+    # Percentiles of the window's non-NaN values unless given (e.g. by a quantile_index.QuantileIndex)
+    if threshold_values is None:
+        return np.nanpercentile(values, thresholds)
+    threshold_values = np.asarray(threshold_values, dtype=np.float64)
+    if len(threshold_values) != len(thresholds):
+        raise ValueError("One threshold value is needed per threshold.")
+    return threshold_values
+
+def _threshold_masks(df, frame_min, frame_max, thresholds, threshold_values=None):
+    """
+    Yields (column slice, boolean masks) batches of thresholds x residues x frames for the frame window,
+    where mask[t] marks the values at or above the t-th percentile of the whole window.
+    All percentiles come from a single sort of the window, or from threshold_values when given.
+    """
+    df_region = df.loc[:, (df.columns >= frame_min) & (df.columns <= frame_max)]
+    values = df_region.to_numpy()
+    if values.size == 0:
+        return
+    threshold_values = _window_threshold_values(values, thresholds, threshold_values)
+    batch_size = max(1, MAX_MASK_CELLS // values.size)
+    for start in range(0, len(thresholds), batch_size):
+        batch = threshold_values[start:start + batch_size]
+        yield slice(start, start + len(batch)), values[np.newaxis, :, :] >= batch[:, np.newaxis, np.newaxis]
+
+def detect_longest_streaks_all_thresholds(df, frame_min, frame_max, thresholds=PERCENTILE_THRESHOLDS, threshold_values=None):
+    """
+    detect_longest_streak for many percentile thresholds at once (by default every integer percentile 0-100).
+
+    :param df: The pivot table of KE values (residues x frames).
+    :param frame_min: The minimum frame to consider for streak detection.
+    :param frame_max: The maximum frame to consider for streak detection.
+    :param thresholds: The percentile thresholds.
+    :param threshold_values: The values of those percentiles over the window, if already known.
+    :return: A DataFrame of longest streak lengths, residues x thresholds.
+    """
+    streaks = np.zeros((len(df), len(thresholds)), dtype=np.int64)
+    for columns, masks in _threshold_masks(df, frame_min, frame_max, thresholds, threshold_values):
+        streaks[:, columns] = longest_streaks(masks).T
+    return pd.DataFrame(streaks, index=df.index, columns=pd.Index(list(thresholds), name='threshold'))
+
+def calculate_persistence_scores_all_thresholds(df, frame_min, frame_max, thresholds=PERCENTILE_THRESHOLDS, threshold_values=None):
+    """
+    calculate_persistence_score for many percentile thresholds at once (by default every integer percentile 0-100):
+    the persistence vs threshold curve of every residue. Each value is placed among the sorted threshold values once,
+    so the whole table costs one pass over the window whatever the number of thresholds.
+
+    :param threshold_values: The values of the percentiles over the window, if already known.
+    :return: A DataFrame of persistence scores, residues x thresholds.
+    """
+    columns = pd.Index(list(thresholds), name='threshold')
+    values = df.loc[:, (df.columns >= frame_min) & (df.columns <= frame_max)].to_numpy(dtype=np.float64)
+    if values.size == 0:
+        return pd.DataFrame(np.nan, index=df.index, columns=columns)
+    threshold_values = _window_threshold_values(values, thresholds, threshold_values)
+    # Levels need ascending threshold values; percentiles grow with the percentile, so sort by percentile
+    order = np.argsort(np.asarray(thresholds, dtype=np.float64), kind='stable')
+    at_or_above = np.empty((len(df), len(thresholds)), dtype=np.int64)
+    at_or_above[:, order] = frames_at_or_above(threshold_level_counts(values, threshold_values[order]))
+    return pd.DataFrame(at_or_above / values.shape[1], index=df.index, columns=columns)
+
+def detect_longest_streak(df, frame_min, frame_max, threshold, threshold_value=None):
     """
     Detect the longest streak (consecutive frames) of kinetic energy above a given threshold for each residue.
     
     :param df: The pivot table of KE values (residues x frames).
     :param frame_min: The minimum frame to consider for streak detection.
     :param threshold: The threshold above which we consider values for streak detection.
-    :return: A Series with the longest streak length for each residue.
+    :param threshold_value: The value of that percentile over the window, if already known (see quantile_index.py).
+    :return: A Series with the longest streak length for each residue (0 if it never reaches the threshold).
     """
     # Focus on the region of interest (frames >= frame_min)
     df_region = df.loc[:, (df.columns >= frame_min) & (df.columns <= frame_max)]
+    if df_region.size == 0:
+        return pd.Series(0, index=df.index, dtype=np.int64)
     
     # Calculate the threshold value based on the provided percentile
-    threshold_value = np.percentile(df_region.values, threshold)
+    if threshold_value is None:
+        threshold_value = np.nanpercentile(df_region.values, threshold)
     
     # Create a mask where values above the threshold are True
-    above_threshold = df_region >= threshold_value
+    above_threshold = df_region.to_numpy() >= threshold_value
     
     # Calculate streak lengths (consecutive True values in each row)
-    streak_lengths = above_threshold.apply(lambda row: max((sum(1 for _ in group) for key, group in itertools.groupby(row) if key)), axis=1)
-    
-    return streak_lengths
+    return pd.Series(longest_streaks(above_threshold), index=df.index)
 
 def get_KE_ordered_index(pivot, frame_min, frame_max):
     index_order = calculate_absolute_persistence_score(pivot, frame_min, frame_max).rank(method='dense', ascending=False).sort_values().index
     return index_order
 
-def construct_KE_pairs(reference_pivot, comparison_pivot, step_res, KE_prc_threshold, resolution):
-    threshold_num = int(np.floor(len(reference_pivot) * KE_prc_threshold))
-    result = pd.DataFrame(columns=[
-        'bin_frame_start', 'bin_frame_stop', 'bin_frame_mid', 
-        'reference_top_index', 'comparison_top_index'
-    ])
-    col_len = len(reference_pivot.columns)
-    start_frame = 0
-    stop_frame = step_res
-    
-    while stop_frame <= col_len:
-        mid_frame = start_frame + int(np.ceil(step_res / 2))
-        
-        ref_indices = get_KE_ordered_index(reference_pivot, start_frame, stop_frame)[-threshold_num:]
-        comp_indices = get_KE_ordered_index(comparison_pivot, start_frame, stop_frame)[-threshold_num:]
-        
-        # Create a new DataFrame row
-        new_df = pd.DataFrame(columns=[
-        'bin_frame_start', 'bin_frame_stop', 'bin_frame_mid', 
-        'reference_top_index', 'comparison_top_index'
-        ])
-        new_df['reference_top_index'] = ref_indices
-        new_df['comparison_top_index'] = comp_indices
-        new_df['bin_frame_start'] = start_frame
-        new_df['bin_frame_stop'] = stop_frame
-        new_df['bin_frame_mid'] = mid_frame
-                
-        result = pd.concat([result, new_df], ignore_index=True)
-        
-        start_frame += step_res
-        stop_frame += step_res
-
-    # Load the CSV file back into a DataFrame for mapping
-    aa_map = pd.read_csv('aa_map.csv')
-    
-    if resolution == 'atom':
-        result = result.merge(aa_map, how='left', left_on='reference_top_index', right_on='atom_number',suffixes=(None, "_reference")).drop(columns=['reference_top_index'])
-        result.rename(columns={'atom_name':'atom_name_reference', 'atom_number':'atom_number_reference', 'residue_number':'residue_number_reference', 'residue_three_letter':'residue_three_letter_reference'}, inplace=True)
-        result = result.merge(aa_map, how='left', left_on='comparison_top_index', right_on='atom_number',suffixes=(None, "_comparison")).drop(columns=['comparison_top_index'])
-        result.rename(columns={'atom_name':'atom_name_comparison', 'atom_number':'atom_number_comparison', 'residue_number':'residue_number_comparison', 'residue_three_letter':'residue_three_letter_comparison'}, inplace=True)
-    elif resolution == 'residue':
-        result = result.merge(aa_map[['residue_number', 'residue_three_letter']].drop_duplicates(), how='left', left_on='reference_top_index', right_on='residue_number',suffixes=(None, "_reference")).drop(columns=['reference_top_index'])
-        result.rename(columns={'residue_number':'residue_number_reference', 'residue_three_letter':'residue_three_letter_reference'}, inplace=True)
-        result = result.merge(aa_map[['residue_number', 'residue_three_letter']].drop_duplicates(), how='left', left_on='comparison_top_index', right_on='residue_number',suffixes=(None, "_comparison")).drop(columns=['comparison_top_index'])
-        result.rename(columns={'residue_number':'residue_number_comparison', 'residue_three_letter':'residue_three_letter_comparison'}, inplace=True)
+def frame_cumsum(pivot):
+    """
+    Running sums of a pivot along its frames with a leading zero column, plus the matching running counts of
+    non-NaN values, so the mean of any frame window is two subtractions per row.
+
+    :return: (sums, counts) arrays of shape rows x (frames + 1).
+    """
+    values = pivot.to_numpy(dtype=np.float64)
+    valid = ~np.isnan(values)
+    sums = np.zeros((values.shape[0], values.shape[1] + 1))
+    counts = np.zeros((values.shape[0], values.shape[1] + 1))
+    np.cumsum(np.where(valid, values, 0.0), axis=1, out=sums[:, 1:])
+    np.cumsum(valid, axis=1, out=counts[:, 1:])
+    return sums, counts
+
+def compute_KE_bins(pivot, step_res, KE_prc_threshold):
+    """
+    The per run half of construct_KE_pairs: the top KE residues/atoms of every frame bin of one pivot.
+
+    Bins are frames start..stop (inclusive) for start = 0, step_res, 2*step_res, ... while stop does not exceed the
+    frame count. Window means come from one cumulative sum over the frames, and the top entries of all bins are picked
+    in a single argpartition, so the cost hardly depends on the bin width.
+
+    :param pivot: The per frame normalized pivot table (residues/atoms x frames).
+    :param step_res: The bin width in frames.
+    :param KE_prc_threshold: The fraction of residues/atoms kept per bin (at least one is kept).
+    :return: A DataFrame with bin_frame_start, bin_frame_stop, bin_frame_mid and top_index columns,
+        ordered by bin and then by descending mean KE within the bin.
+    """
+    columns = ['bin_frame_start', 'bin_frame_stop', 'bin_frame_mid', 'top_index']
+    n_rows, col_len = pivot.shape
+    if step_res < 1:
+        raise ValueError("The bin width (step_res) must be at least one frame.")
+    starts = np.arange(0, col_len - step_res + 1, step_res)
+    if n_rows == 0 or len(starts) == 0:
+        return pd.DataFrame(columns=columns)
+    stops = starts + step_res
+    top_num = min(max(int(np.floor(n_rows * KE_prc_threshold)), 1), n_rows)
+
+    # Window [start, stop] selects frames by label, as DataFrame.loc did
+    frames = pivot.columns.to_numpy()
+    window_start = np.searchsorted(frames, starts, side='left')
+    window_stop = np.searchsorted(frames, stops, side='right')
+    sums, counts = frame_cumsum(pivot)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = (sums[:, window_stop] - sums[:, window_start]) / (counts[:, window_stop] - counts[:, window_start])
+    return top_KE_bins(means, pivot.index, starts, step_res, top_num)
+
+def top_KE_bins(means, index, starts, step_res, top_num):
+    """
+    Picks the top_num rows of every bin from the rows x bins window means (NaN for empty windows) and lays them
+    out as compute_KE_bins returns them.
+    """
+    n_rows = means.shape[0]
+    stops = starts + step_res
+    means = np.where(np.isnan(means), -np.inf, means)
+
+    # Top entries of every bin at once (rows x bins -> top_num x bins), then ordered by descending mean
+    if top_num < n_rows:
+        top_rows = np.argpartition(-means, top_num - 1, axis=0)[:top_num]
     else:
-        raise ValueError("Invalid resolution. Choose 'atom' or 'residue'.")
+        top_rows = np.broadcast_to(np.arange(n_rows)[:, np.newaxis], means.shape)
+    top_rows = np.sort(top_rows, axis=0)
+    order = np.argsort(-np.take_along_axis(means, top_rows, axis=0), axis=0, kind='stable')
+    top_rows = np.take_along_axis(top_rows, order, axis=0)
+
+    n_bins = len(starts)
+    return pd.DataFrame({
+        'bin_frame_start': np.repeat(starts, top_num),
+        'bin_frame_stop': np.repeat(stops, top_num),
+        'bin_frame_mid': np.repeat(starts + int(np.ceil(step_res / 2)), top_num),
+        'top_index': np.asarray(index)[top_rows.T.reshape(n_bins * top_num)],
+    })
+
+def construct_KE_pairs(reference_pivot, comparison_pivot, step_res, KE_prc_threshold, resolution, reference_bins=None, comparison_bins=None, reference_topology=None, comparison_topology=None):
+    """
+    Pairs up the top KE residues/atoms of the reference and comparison runs bin by bin and annotates them.
+    Precomputed bins (see compute_KE_bins and precompute.py) can be passed in to skip the binning step.
+    Each run is annotated from its own topology (see topology.get_run_topology); the default is aa_map.csv.
+    Derived resolutions (backbone, side chain) are indexed by residue number and annotated as residues.
+    """
+    if resolution != 'atom' and resolution not in DERIVED_RESOLUTIONS:
+        raise ValueError(f"Invalid resolution. Choose 'atom' or one of {DERIVED_RESOLUTIONS}.")
+    if reference_bins is None:
+        reference_bins = compute_KE_bins(reference_pivot, step_res, KE_prc_threshold)
+    if comparison_bins is None:
+        comparison_bins = compute_KE_bins(comparison_pivot, step_res, KE_prc_threshold)
+    if reference_topology is None:
+        reference_topology = load_topology()
+    if comparison_topology is None:
+        comparison_topology = load_topology()
+
+    result = reference_bins.drop(columns=['top_index']).reset_index(drop=True)
+    for suffix, bins, topology in [('reference', reference_bins, reference_topology), ('comparison', comparison_bins, comparison_topology)]:
+        top_index = bins['top_index'].to_numpy()
+        if resolution == 'atom':
+            annotation = topology.annotate_atoms(top_index)
+        else:
+            annotation = topology.annotate_residues(top_index)
+            del annotation['residue_one_letter']
+        for column, values in annotation.items():
+            result[f"{column}_{suffix}"] = values
 
     return result
 
+# Above this many (bin, residue) cells the membership table is replaced by sorted lookups
+MAX_MEMBERSHIP_CELLS = 2 ** 26
+
+def _categorise_residues(bin_codes, own_residues, other_residues, own_only_label):
+    """
+    Labels each residue of one run against the residues of the other run in the same bin:
+    'common' if the other run has it, 'neighbour' if it has residue +/- 1, own_only_label otherwise,
+    and 'Unclassified' where the residue is missing (NaN).
+    """
+    own_valid = ~np.isnan(own_residues)
+    other_valid = ~np.isnan(other_residues)
+    labels = np.full(len(own_residues), 'Unclassified', dtype=object)
+    if not own_valid.any():
+        return labels
+
+    # Residue numbers as column offsets, with one spare column either side for the +/- 1 shifts
+    present = np.concatenate([own_residues[own_valid], other_residues[other_valid]])
+    first_residue = int(present.min()) - 1
+    span = int(present.max()) - first_residue + 2
+    own_bins, own_cols = bin_codes[own_valid], own_residues[own_valid].astype(np.int64) - first_residue
+    other_bins, other_cols = bin_codes[other_valid], other_residues[other_valid].astype(np.int64) - first_residue
+    n_bins = int(bin_codes.max()) + 1
+
+    if n_bins * span <= MAX_MEMBERSHIP_CELLS:
+        membership = np.zeros((n_bins, span), dtype=bool)
+        membership[other_bins, other_cols] = True
+        is_common = membership[own_bins, own_cols]
+        is_neighbour = membership[own_bins, own_cols - 1] | membership[own_bins, own_cols + 1]
+    else:
+        other_keys = other_bins * span + other_cols
+        own_keys = own_bins * span + own_cols
+        is_common = np.isin(own_keys, other_keys)
+        is_neighbour = np.isin(own_keys - 1, other_keys) | np.isin(own_keys + 1, other_keys)
+
+    labels[own_valid] = np.select([is_common, is_neighbour], ['common', 'neighbour'], default=own_only_label)
+    return labels
+
 def add_residue_category(result_df):
-    # Create a set of residue numbers for reference and comparison by frame
-    frame_residue_groups = (
-        result_df.groupby(['bin_frame_mid', 'residue_number_reference', 'residue_number_comparison'])
-        .apply(lambda x: set(x['residue_number_reference']).union(set(x['residue_number_comparison'])))
-        .reset_index()
-    )
-
-    # Initialize the category column
-    result_df['category_ref'] = 'Unclassified'
-    result_df['category_comp'] = 'Unclassified'
-
-    # Iterate over frames and assign categories
-    for frame, frame_data in result_df.groupby('bin_frame_mid'):
-        ref_residues = set(frame_data['residue_number_reference'].dropna())
-        comp_residues = set(frame_data['residue_number_comparison'].dropna())
-
-        # Assign categories based on conditions
-        for index, row in frame_data.iterrows():
-            residue_num_ref = row['residue_number_reference']
-            residue_num_comp = row['residue_number_comparison']
-
-            if pd.notna(residue_num_ref):
-                if residue_num_ref in comp_residues:
-                    result_df.at[index, 'category_ref'] = 'common'
-                elif residue_num_ref - 1 in comp_residues or residue_num_ref + 1 in comp_residues:
-                    result_df.at[index, 'category_ref'] = 'neighbour'
-                else:
-                    result_df.at[index, 'category_ref'] = 'reference only'
-            if pd.notna(residue_num_comp):
-                if residue_num_comp in ref_residues:
-                    result_df.at[index, 'category_comp'] = 'common'
-                elif residue_num_comp - 1 in ref_residues or residue_num_comp + 1 in ref_residues:
-                    result_df.at[index, 'category_comp'] = 'neighbour'
-                else:
-                    result_df.at[index, 'category_comp'] = 'comparison only'
+    """
+    Adds category_ref and category_comp columns to the KE pairs, comparing the reference and comparison
+    residues of each bin (common / neighbour / reference only / comparison only, 'Unclassified' for missing residues).
+    Works on whole integer arrays, so the cost grows linearly with the number of pairs.
+    """
+    bin_codes, _ = pd.factorize(result_df['bin_frame_mid'])
+    ref_residues = pd.to_numeric(result_df['residue_number_reference'], errors='coerce').to_numpy(dtype=np.float64)
+    comp_residues = pd.to_numeric(result_df['residue_number_comparison'], errors='coerce').to_numpy(dtype=np.float64)
 
+    result_df['category_ref'] = _categorise_residues(bin_codes, ref_residues, comp_residues, 'reference only')
+    result_df['category_comp'] = _categorise_residues(bin_codes, comp_residues, ref_residues, 'comparison only')
     return result_df
 
-# Function to apply reordered indices to reference and comparison datasets
-def reorder_data(reference_pivot, comparison_pivot, reordering_option, frame_min, frame_max, threshold):
+def calculate_absolute_persistence_from_cumsum(cumsum, frame_min, frame_max):
     """
-    Reorders the reference and comparison pivot tables based on the given indices.
+    Same result as calculate_absolute_persistence_score, read from a precomputed cumulative sum over frames.
+
+    :param cumsum: The running sum of KE along the frames of a pivot (residues x frames), as made by precompute.py.
+    :return: A Series with the mean KE of each residue over frames frame_min..frame_max.
+    """
+    frames = cumsum.columns.to_numpy()
+    start = np.searchsorted(frames, frame_min, side='left')
+    stop = np.searchsorted(frames, frame_max, side='right')
+    if stop <= start:
+        return pd.Series(np.nan, index=cumsum.index)
+    values = cumsum.to_numpy()
+    window_sum = values[:, stop - 1] - (values[:, start - 1] if start > 0 else 0.0)
+    return pd.Series(window_sum / (stop - start), index=cumsum.index)
+
+def calculate_reordering_scores(pivot, reordering_option, frame_min, frame_max, threshold, threshold_value=None):
+    """
+    Calculates the per residue score a reordering option sorts by (higher scores come first).
 
     Args:
-        reference_pivot (pd.DataFrame): The pivot table for the reference run.
-        comparison_pivot (pd.DataFrame): The pivot table for the comparison run.
-        reordered_indices (pd.Index): The reordered indices of the residues.
+        pivot (pd.DataFrame): The pivot table the order is derived from (normally the reference run).
+        reordering_option (str): One of the reordering options offered in the sidebar.
+        frame_min (int): The first frame of the evaluated window.
+        frame_max (int): The last frame of the evaluated window.
+        threshold (float): The percentile threshold for persistence and streak scores.
+        threshold_value (float): The value of that percentile over the window, if already known.
 
     Returns:
-        tuple: Reordered reference and comparison pivot tables.
+        pd.Series: The score of each residue.
     """
     if reordering_option == "Reordered by Persistence":
-        persistence_scores = calculate_persistence_score(reference_pivot, frame_min=frame_min, frame_max=frame_max, threshold=threshold)
-        final_rank = persistence_scores.rank(method='dense', ascending=False)
+        return calculate_persistence_score(pivot, frame_min=frame_min, frame_max=frame_max, threshold=threshold, threshold_value=threshold_value)
     elif reordering_option == "Reordered by Streak Length":
-        streak_lengths = detect_longest_streak(reference_pivot, frame_min, frame_max, threshold)
-        final_rank = streak_lengths.rank(method='dense', ascending=False)
+        return detect_longest_streak(pivot, frame_min, frame_max, threshold, threshold_value)
     elif reordering_option == "Reordered by Absolute Persistence":
-        absolute_persistence_score = calculate_absolute_persistence_score(reference_pivot, frame_min, frame_max)
-        final_rank = absolute_persistence_score.rank(method='dense', ascending=False)
+        return calculate_absolute_persistence_score(pivot, frame_min, frame_max)
     else:
         raise ValueError("Unhandled reordering option was passed")
-    
+
+def apply_reordering(reference_pivot, comparison_pivot, scores):
+    """
+    Orders both pivot tables by descending score (dense rank, as for all reordering options).
+
+    Returns:
+        tuple: Reordered reference and comparison pivot tables.
+    """
+    final_rank = scores.rank(method='dense', ascending=False)
     reordered_indices = final_rank.sort_values().index
     reordered_reference_pivot = reference_pivot.loc[reordered_indices, :]
     reordered_comparison_pivot = comparison_pivot.loc[reordered_indices, :]
     return reordered_reference_pivot, reordered_comparison_pivot
+
+# Function to apply reordered indices to reference and comparison datasets
+def reorder_data(reference_pivot, comparison_pivot, reordering_option, frame_min, frame_max, threshold):
+    """
+    Reorders the reference and comparison pivot tables based on the given indices.
+
+    Args:
+        reference_pivot (pd.DataFrame): The pivot table for the reference run.
+        comparison_pivot (pd.DataFrame): The pivot table for the comparison run.
+        reordered_indices (pd.Index): The reordered indices of the residues.
+
+    Returns:
+        tuple: Reordered reference and comparison pivot tables.
+    """
+    scores = calculate_reordering_scores(reference_pivot, reordering_option, frame_min, frame_max, threshold)
+    return apply_reordering(reference_pivot, comparison_pivot, scores)
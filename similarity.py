@@ -0,0 +1,382 @@
+# similarity.py: All-pairs run similarity from the overlap of the top KE residue/atom sets of every frame bin
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from data_handler import normalize_per_frame
+from reorder_handler import compute_KE_bins
+from precompute import load_derived, ke_bins_name, DEFAULT_STEP_RES, DEFAULT_KE_PRC_THRESHOLD
+from pivot_store import load_pivot_store
+from manifest_handler import RESOLUTIONS, load_manifest, refresh_manifest, get_dataset_source
+
+SIMILARITY_CACHE_DIR = Path("analysis_cache") / "similarity"
+SIMILARITY_META_FILE = "meta.json"
+# Bumped whenever a score's definition changes, so cached results are recomputed instead of used
+SIMILARITY_FORMAT_VERSION = 1
+BITSETS_FILE = "bitsets.npy"
+N_BINS_FILE = "n_bins.npy"
+JACCARD_FILE = "jaccard.npy"
+KNOWN_FILE = "known.npy"
+SUMMARY_FILE = "summary.npy"
+# Rows of the pair matrix handed to a worker at a time; progress is saved after each
+ROWS_PER_TASK = 8
+# Cells of the (runs, runs, bins) score array held in memory at once when it is copied or summarized
+JACCARD_BLOCK_CELLS = 2 ** 24
+
+def similarity_name(step_res, KE_prc_threshold):
+    return f"{step_res}_{KE_prc_threshold}"
+
+def get_similarity_path(resolution, step_res, KE_prc_threshold, cache_dir=SIMILARITY_CACHE_DIR):
+    return Path(cache_dir) / resolution / similarity_name(step_res, KE_prc_threshold)
+
+def _similarity_runs(resolution, base_path):
+    # 'category/run' -> manifest entry of every dataset of the resolution, in a stable order
+    manifest = load_manifest(base_path) or refresh_manifest(base_path)
+    runs = {
+        f"{entry['category']}/{entry['run_num']}": entry
+        for entry in manifest['datasets'].values()
+        if entry['resolution'] == resolution
+    }
+    return dict(sorted(runs.items()))
+
+def _run_top_k(run_num, resolution, category, base_path, step_res, KE_prc_threshold):
+    # Worker: the KE bins of one run, from the precomputed artifacts where current
+    bins = load_derived(run_num, resolution, category, ke_bins_name(step_res, KE_prc_threshold), base_path)
+    if bins is None:
+        per_frame = load_derived(run_num, resolution, category, 'per_frame', base_path)
+        if per_frame is None:
+            source = get_dataset_source(run_num, resolution, category, base_path)
+            per_frame = normalize_per_frame(load_pivot_store(source) if source.is_dir() else pd.read_pickle(source))
+        bins = compute_KE_bins(per_frame, step_res, KE_prc_threshold)
+    return bins
+
+def top_k_bitsets(bins, row_index, n_bins=None):
+    """
+    Packs the top KE membership of every frame bin into a bitset over row_index.
+
+    Args:
+        bins (pd.DataFrame): KE bins of one run (see reorder_handler.compute_KE_bins).
+        row_index (np.ndarray): Sorted residue/atom numbers all bitsets are laid out over.
+        n_bins (int): Number of bitsets to return; bins a run lacks are empty (default: the run's bin count).
+
+    Returns:
+        np.ndarray: (n_bins, words) uint64 bitsets, bit r set when row_index[r] is in the bin's top set.
+    """
+    bin_codes, _ = pd.factorize(bins['bin_frame_start'], sort=True)
+    run_bins = int(bin_codes.max()) + 1 if len(bin_codes) else 0
+    n_bins = run_bins if n_bins is None else n_bins
+    membership = np.zeros((n_bins, len(row_index)), dtype=bool)
+    rows = np.searchsorted(row_index, bins['top_index'].to_numpy())
+    keep = bin_codes < n_bins
+    membership[bin_codes[keep], rows[keep]] = True
+    packed = np.packbits(membership, axis=1)
+    # Padded to whole 64 bit words, so popcounts run on 8 bytes at a time
+    words = -(-packed.shape[1] // 8)
+    padded = np.zeros((n_bins, words * 8), dtype=np.uint8)
+    padded[:, :packed.shape[1]] = packed
+    return padded.view(np.uint64)
+
+def unpack_bitsets(bitsets, n_rows):
+    """Inverse of top_k_bitsets: (..., words) uint64 bitsets -> (..., n_rows) bool membership."""
+    return np.unpackbits(bitsets.view(np.uint8), axis=-1, count=n_rows).astype(bool)
+
+def bin_jaccard(bitsets, other_bitsets, n_bins, other_n_bins):
+    """
+    Per bin Jaccard index |A & B| / |A | B| of one run's top sets against those of several other runs.
+
+    Args:
+        bitsets (np.ndarray): (bins, words) bitsets of one run.
+        other_bitsets (np.ndarray): (runs, bins, words) bitsets of the other runs.
+        n_bins (int): Bins the run actually has.
+        other_n_bins (np.ndarray): Bins each other run actually has.
+
+    Returns:
+        np.ndarray: (runs, bins) float32 scores, NaN past the bins both runs have.
+    """
+    intersection = np.bitwise_count(bitsets & other_bitsets).sum(axis=-1, dtype=np.int64)
+    union = np.bitwise_count(bitsets | other_bitsets).sum(axis=-1, dtype=np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (intersection / union).astype(np.float32)
+    common = np.minimum(n_bins, np.asarray(other_n_bins))
+    scores[np.arange(scores.shape[1]) >= common[:, None]] = np.nan
+    return scores
+
+def _row_blocks(n_rows, row_cells):
+    # Consecutive row slices of at most JACCARD_BLOCK_CELLS cells each
+    step = max(1, JACCARD_BLOCK_CELLS // max(row_cells, 1))
+    for start in range(0, n_rows, step):
+        yield slice(start, min(start + step, n_rows))
+
+def summarize_jaccard(jaccard):
+    """
+    Whole run score of every pair: the mean per bin Jaccard index over the bins both runs have.
+    Reads the (possibly memory-mapped) scores a block of rows at a time.
+    """
+    summary = np.empty(jaccard.shape[:2], dtype=np.float32)
+    for rows in _row_blocks(jaccard.shape[0], jaccard.shape[1] * jaccard.shape[2]):
+        block = np.asarray(jaccard[rows])
+        with np.errstate(invalid='ignore'):
+            valid = ~np.isnan(block)
+            summary[rows] = np.where(valid, block, 0).sum(axis=-1) / valid.sum(axis=-1)
+    return summary
+
+def _score_rows(similarity_path, rows):
+    # Worker: fills the upper triangle pairs (i, j > i) of the given rows that are not known yet. Each pair is
+    # owned by one row, so workers never write the same cell.
+    bitsets = np.load(similarity_path / BITSETS_FILE, mmap_mode='r')
+    n_bins = np.load(similarity_path / N_BINS_FILE)
+    known = np.load(similarity_path / KNOWN_FILE)
+    jaccard = np.load(similarity_path / JACCARD_FILE, mmap_mode='r+')
+    for i in rows:
+        others = np.flatnonzero(~known[i, i + 1:]) + i + 1
+        if len(others) == 0:
+            continue
+        scores = bin_jaccard(bitsets[i], bitsets[others], n_bins[i], n_bins[others])
+        jaccard[i, others] = scores
+        jaccard[others, i] = scores
+    jaccard.flush()
+    return rows
+
+def _tmp_path(path):
+    return path.with_name(path.name + ".tmp.npy")
+
+def _save_array(path, array):
+    tmp_path = _tmp_path(path)
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+def _save_meta(similarity_path, meta):
+    tmp_meta = similarity_path / (SIMILARITY_META_FILE + ".tmp")
+    tmp_meta.write_text(json.dumps(meta))
+    os.replace(tmp_meta, similarity_path / SIMILARITY_META_FILE)
+
+def _load_meta(similarity_path):
+    try:
+        meta = json.loads((similarity_path / SIMILARITY_META_FILE).read_text())
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('format_version') == SIMILARITY_FORMAT_VERSION else None
+
+def load_similarity(resolution, step_res=DEFAULT_STEP_RES, KE_prc_threshold=DEFAULT_KE_PRC_THRESHOLD, base_path="pivots", cache_dir=SIMILARITY_CACHE_DIR):
+    """
+    Loads a finished similarity matrix, or returns None if it is missing, unfinished or the runs changed since.
+
+    Returns:
+        dict: 'runs' (list of 'category/run' labels), 'summary' ((runs, runs) whole run scores),
+        'jaccard' ((runs, runs, bins) per bin scores, memory-mapped) and 'bin_starts' (first frame of each bin).
+    """
+    similarity_path = get_similarity_path(resolution, step_res, KE_prc_threshold, cache_dir)
+    meta = _load_meta(similarity_path)
+    if meta is None or not meta.get('complete'):
+        return None
+    runs = _similarity_runs(resolution, base_path)
+    if meta['runs'] != {run: entry['sha256'] for run, entry in runs.items()}:
+        return None
+    try:
+        return {
+            'runs': list(meta['runs']),
+            'summary': np.load(similarity_path / SUMMARY_FILE),
+            'jaccard': np.load(similarity_path / JACCARD_FILE, mmap_mode='r'),
+            'bin_starts': np.arange(meta['max_bins']) * step_res,
+        }
+    except (OSError, ValueError) as e:
+        print(f"Error loading run similarity of {resolution}: {e}")
+        return None
+
+def _carry_over(similarity_path, meta, run_keys, row_index, max_bins):
+    # Bitsets and scores of runs whose content is unchanged since the last (possibly unfinished) job, laid out
+    # over the new run order, row index and bin count. The scores go to a memory-mapped file next to the old one,
+    # which replaces it once the job has set it up (see compute_run_similarity)
+    n_runs = len(run_keys)
+    words = -(-len(row_index) // 64)
+    bitsets = np.zeros((n_runs, max_bins, words), dtype=np.uint64)
+    n_bins = np.zeros(n_runs, dtype=np.int64)
+    jaccard = np.lib.format.open_memmap(_tmp_path(similarity_path / JACCARD_FILE), mode='w+', dtype=np.float32, shape=(n_runs, n_runs, max_bins))
+    for rows in _row_blocks(n_runs, n_runs * max_bins):
+        jaccard[rows] = np.nan
+    known = np.eye(n_runs, dtype=bool)
+    has_bitsets = np.zeros(n_runs, dtype=bool)
+    if meta is None:
+        return bitsets, n_bins, jaccard, known, has_bitsets
+    try:
+        old_bitsets = np.load(similarity_path / BITSETS_FILE, mmap_mode='r')
+        old_n_bins = np.load(similarity_path / N_BINS_FILE)
+        old_jaccard = np.load(similarity_path / JACCARD_FILE, mmap_mode='r')
+        old_known = np.load(similarity_path / KNOWN_FILE)
+    except (OSError, ValueError):
+        return bitsets, n_bins, jaccard, known, has_bitsets
+    old_runs = {run: (i, sha) for i, (run, sha) in enumerate(meta['runs'].items())}
+    new_positions, old_positions = [], []
+    for new_i, (run, sha) in enumerate(run_keys.items()):
+        if run in old_runs and old_runs[run][1] == sha:
+            new_positions.append(new_i)
+            old_positions.append(old_runs[run][0])
+    if not new_positions:
+        return bitsets, n_bins, jaccard, known, has_bitsets
+    new_positions, old_positions = np.array(new_positions), np.array(old_positions)
+
+    old_index = np.asarray(meta['row_index'])
+    kept_bins = min(max_bins, old_bitsets.shape[1])
+    same_rows = np.array_equal(old_index, row_index)
+    old_rows = np.searchsorted(row_index, old_index)
+    # One run at a time, straight into the packed bitsets: only a single run's bins are ever unpacked
+    for new_i, old_i in zip(new_positions, old_positions):
+        if same_rows:
+            bitsets[new_i, :kept_bins] = old_bitsets[old_i, :kept_bins]
+            continue
+        membership = np.zeros((kept_bins, len(row_index)), dtype=bool)
+        membership[:, old_rows] = unpack_bitsets(np.asarray(old_bitsets[old_i, :kept_bins]), len(old_index))
+        packed = np.packbits(membership, axis=-1)
+        bitsets[new_i, :kept_bins].view(np.uint8)[:, :packed.shape[-1]] = packed
+    n_bins[new_positions] = old_n_bins[old_positions]
+    has_bitsets[new_positions] = True
+
+    bins = slice(0, kept_bins)
+    for rows in _row_blocks(len(new_positions), len(new_positions) * kept_bins):
+        jaccard[np.ix_(new_positions[rows], new_positions) + (bins,)] = old_jaccard[np.ix_(old_positions[rows], old_positions) + (bins,)]
+    known[np.ix_(new_positions, new_positions)] = old_known[np.ix_(old_positions, old_positions)]
+    return bitsets, n_bins, jaccard, known, has_bitsets
+
+def compute_run_similarity(resolution, step_res=DEFAULT_STEP_RES, KE_prc_threshold=DEFAULT_KE_PRC_THRESHOLD, base_path="pivots", cache_dir=SIMILARITY_CACHE_DIR, workers=None, overwrite=False):
+    """
+    Scores every pair of runs of a resolution (all categories) by the overlap of their top KE residue/atom sets:
+    per frame bin the Jaccard index of the two top sets, and as a whole run score its mean over the bins.
+    This is the all-pairs form of the common/neighbour/only categories of reorder_handler.add_residue_category.
+
+    Each run's top sets become one bitset per bin, so a pair of bins costs a few popcounts of 64 bit words.
+    The pair matrix is filled row block by row block on a process pool; the scores live in a memory-mapped file
+    under analysis_cache/similarity/ and the finished pairs are saved after every block, so an interrupted job
+    resumes where it stopped, and when runs are added or changed only their pairs are scored again.
+
+    Args:
+        resolution (str): 'residue' or 'atom'.
+        step_res (int): The bin width in frames.
+        KE_prc_threshold (float): The fraction of residues/atoms in each bin's top set.
+        workers (int): Number of worker processes (default: CPU count).
+        overwrite (bool): Discard earlier results and score every pair again.
+
+    Returns:
+        dict: As load_similarity, or None if the resolution has fewer than two runs.
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Invalid resolution. Choose one of {RESOLUTIONS}.")
+    if not overwrite:
+        finished = load_similarity(resolution, step_res, KE_prc_threshold, base_path, cache_dir)
+        if finished is not None:
+            return finished
+    runs = _similarity_runs(resolution, base_path)
+    if len(runs) < 2:
+        return None
+    run_keys = {run: entry['sha256'] for run, entry in runs.items()}
+    similarity_path = get_similarity_path(resolution, step_res, KE_prc_threshold, cache_dir)
+    similarity_path.mkdir(parents=True, exist_ok=True)
+    meta = None if overwrite else _load_meta(similarity_path)
+
+    # All runs are laid out over the union of their residue/atom numbers and the largest bin count
+    row_index = np.unique(np.concatenate([np.arange(entry['index_min'], entry['index_max'] + 1) for entry in runs.values()]))
+    max_bins = max(entry['n_frames'] // step_res for entry in runs.values())
+    bitsets, n_bins, jaccard, known, has_bitsets = _carry_over(similarity_path, meta, run_keys, row_index, max_bins)
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        missing = [run for i, run in enumerate(runs) if not has_bitsets[i]]
+        futures = {
+            executor.submit(_run_top_k, runs[run]['run_num'], resolution, runs[run]['category'], base_path, step_res, KE_prc_threshold): run
+            for run in missing
+        }
+        positions = {run: i for i, run in enumerate(runs)}
+        for future in as_completed(futures):
+            i = positions[futures[future]]
+            bins = future.result()
+            n_bins[i] = bins['bin_frame_start'].nunique()
+            bitsets[i] = top_k_bitsets(bins, row_index, max_bins)
+
+        # Every run matches itself in each of its bins
+        for i in range(len(runs)):
+            jaccard[i, i, :n_bins[i]] = 1.0
+        _save_array(similarity_path / BITSETS_FILE, bitsets)
+        _save_array(similarity_path / N_BINS_FILE, n_bins)
+        jaccard.flush()
+        del jaccard
+        os.replace(_tmp_path(similarity_path / JACCARD_FILE), similarity_path / JACCARD_FILE)
+        _save_array(similarity_path / KNOWN_FILE, known)
+        meta = {
+            'format_version': SIMILARITY_FORMAT_VERSION,
+            'runs': run_keys,
+            'row_index': row_index.tolist(),
+            'max_bins': max_bins,
+            'step_res': step_res,
+            'KE_prc_threshold': KE_prc_threshold,
+            'complete': False,
+        }
+        _save_meta(similarity_path, meta)
+
+        # Rows with unscored pairs, in blocks; later rows have fewer pairs, so blocks are cut by pair count
+        pending = np.triu(~known, k=1).sum(axis=1)
+        tasks, block, block_pairs = [], [], 0
+        per_task = max(int(pending.sum()) // (workers * 4), ROWS_PER_TASK)
+        for i in np.flatnonzero(pending):
+            block.append(int(i))
+            block_pairs += pending[i]
+            if block_pairs >= per_task:
+                tasks.append(block)
+                block, block_pairs = [], 0
+        if block:
+            tasks.append(block)
+        futures = [executor.submit(_score_rows, similarity_path, rows) for rows in tasks]
+        for future in as_completed(futures):
+            # Only the pairs (i, j > i) a row owns are done: pairs (j < i, i) belong to earlier rows' blocks
+            for i in future.result():
+                known[i, i + 1:] = True
+                known[i + 1:, i] = True
+            _save_array(similarity_path / KNOWN_FILE, known)
+
+    jaccard = np.load(similarity_path / JACCARD_FILE, mmap_mode='r')
+    _save_array(similarity_path / SUMMARY_FILE, summarize_jaccard(jaccard))
+    meta['complete'] = True
+    # Written last: the scores are only used once meta.json marks them complete
+    _save_meta(similarity_path, meta)
+    return load_similarity(resolution, step_res, KE_prc_threshold, base_path, cache_dir)
+
+def cluster_order(similarity):
+    """
+    Leaf order of an average linkage clustering of the runs (distance 1 - similarity), so that similar runs end up
+    next to each other in the heatmap. Plain numpy: each of the n - 1 merges joins the closest pair of clusters
+    and updates their distances to the others as size weighted means.
+
+    :param similarity: A symmetric (runs, runs) score matrix in [0, 1]; NaN scores count as dissimilar.
+    :return: An array with the run positions in display order.
+    """
+    n = len(similarity)
+    distance = 1 - np.nan_to_num(np.asarray(similarity, dtype=np.float64), nan=0.0)
+    np.fill_diagonal(distance, np.inf)
+    sizes = np.ones(n)
+    members = {i: [i] for i in range(n)}
+    for _ in range(n - 1):
+        a, b = np.unravel_index(np.argmin(distance), distance.shape)
+        a, b = min(a, b), max(a, b)
+        merged = (distance[a] * sizes[a] + distance[b] * sizes[b]) / (sizes[a] + sizes[b])
+        distance[a], distance[:, a] = merged, merged
+        distance[a, a] = np.inf
+        distance[b], distance[:, b] = np.inf, np.inf
+        sizes[a] += sizes[b]
+        members[a] = members[a] + members.pop(b)
+    return np.array(next(iter(members.values())) if members else [], dtype=np.int64)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Score the top KE set overlap of every pair of runs.")
+    parser.add_argument("--base-path", default="pivots", help="Root of the pivots directory tree.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPU count).")
+    parser.add_argument("--step-res", type=int, default=DEFAULT_STEP_RES, help="Frame bin width in frames.")
+    parser.add_argument("--ke-prc-threshold", type=float, default=DEFAULT_KE_PRC_THRESHOLD, help="Fraction of residues/atoms in each bin's top set.")
+    parser.add_argument("--overwrite", action="store_true", help="Score every pair again.")
+    args = parser.parse_args()
+
+    refresh_manifest(args.base_path)
+    for resolution in RESOLUTIONS:
+        similarity = compute_run_similarity(resolution, args.step_res, args.ke_prc_threshold, args.base_path, workers=args.workers, overwrite=args.overwrite)
+        if similarity is not None:
+            print(f"{resolution}: {len(similarity['runs'])} runs, {len(similarity['bin_starts'])} bins")
@@ -0,0 +1,74 @@
+import unittest
+import numpy as np
+import pandas as pd
+from topology import Topology
+from aggregation import atom_aggregation, aggregate_atoms, grouping_from_labels, residue_segments, add_derived_datasets
+
+def make_topology():
+    return Topology(pd.DataFrame({
+        'atom_number': [1, 2, 3, 4, 5, 6, 7],
+        'atom_name': ['N', 'CA', 'CB', 'C', 'N', 'CA', 'OG'],
+        'residue_number': [1, 1, 1, 1, 2, 2, 2],
+        'residue_three_letter': ['ALA'] * 4 + ['SER'] * 3,
+        'residue_one_letter': ['A'] * 4 + ['S'] * 3,
+    }))
+
+def make_atom_pivot(n_frames=5):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        rng.random((7, n_frames)),
+        index=pd.Index(np.arange(7), name='atom'),
+        columns=pd.Index(np.arange(n_frames), name='frame'),
+    )
+
+class TestAggregation(unittest.TestCase):
+
+    def setUp(self):
+        self.topology = make_topology()
+        self.atom_pivot = make_atom_pivot()
+        self.values = self.atom_pivot.to_numpy()
+
+    def test_residue_sums(self):
+        residue_pivot = aggregate_atoms(self.atom_pivot, self.topology, 'residue')
+        self.assertEqual(residue_pivot.index.tolist(), [1, 2])
+        self.assertEqual(residue_pivot.index.name, 'residue')
+        np.testing.assert_allclose(residue_pivot.to_numpy(), [self.values[:4].sum(axis=0), self.values[4:].sum(axis=0)])
+        pd.testing.assert_index_equal(residue_pivot.columns, self.atom_pivot.columns)
+
+    def test_backbone_and_sidechain(self):
+        backbone = aggregate_atoms(self.atom_pivot, self.topology, 'backbone')
+        sidechain = aggregate_atoms(self.atom_pivot, self.topology, 'sidechain')
+        np.testing.assert_allclose(backbone.to_numpy(), [self.values[[0, 1, 3]].sum(axis=0), self.values[[4, 5]].sum(axis=0)])
+        np.testing.assert_allclose(sidechain.to_numpy(), [self.values[2], self.values[6]])
+        np.testing.assert_allclose(backbone.to_numpy() + sidechain.to_numpy(), aggregate_atoms(self.atom_pivot, self.topology, 'residue').to_numpy())
+
+    def test_frame_blocks(self):
+        import aggregation
+        block = aggregation.AGGREGATION_FRAME_BLOCK
+        aggregation.AGGREGATION_FRAME_BLOCK = 2
+        try:
+            residue_pivot = atom_aggregation(self.topology, 'residue').apply(self.atom_pivot)
+        finally:
+            aggregation.AGGREGATION_FRAME_BLOCK = block
+        np.testing.assert_allclose(residue_pivot.to_numpy()[0], self.values[:4].sum(axis=0))
+
+    def test_segments(self):
+        aggregation = grouping_from_labels(self.topology, residue_segments({'first': (1, 1), 'second': (2, 2)}), 'segment')
+        segments = aggregation.apply(self.atom_pivot)
+        self.assertEqual(segments.index.tolist(), ['first', 'second'])
+        np.testing.assert_allclose(segments.loc['second'].to_numpy(), self.values[4:].sum(axis=0))
+
+    def test_shape_mismatch(self):
+        with self.assertRaises(ValueError):
+            aggregate_atoms(self.atom_pivot.iloc[:5], self.topology, 'residue')
+        with self.assertRaises(ValueError):
+            atom_aggregation(self.topology, 'helix')
+
+    def test_add_derived_datasets(self):
+        available = add_derived_datasets({('atom', 'effective'): ['0500', '0600'], ('residue', 'effective'): ['0500', '0700']})
+        self.assertEqual(available[('residue', 'effective')], ['0500', '0600', '0700'])
+        self.assertEqual(available[('backbone', 'effective')], ['0500', '0600'])
+        self.assertEqual(available[('atom', 'effective')], ['0500', '0600'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,31 +2,30 @@ import unittest
 import bcrypt
 import sqlite3
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import auth_handler
 from auth_handler import initialize_user_db, register_user, login_user, logout_user
 import streamlit as st
 from unittest.mock import patch
 
-DB_FILE = ':memory:'
-
 @patch('streamlit.session_state', {})
+@patch.object(auth_handler, 'BCRYPT_ROUNDS', 4)
 class TestAuthHandler(unittest.TestCase):
-    
+
     def setUp(self):
-        # Set up the in-memory database for each test
-        self.conn = sqlite3.connect(DB_FILE)
-        cursor = self.conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                            username TEXT PRIMARY KEY,
-                            password TEXT NOT NULL)''')
-        self.conn.commit()
+        # Each test gets its own database, so the tracked user_data.db is never touched
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_patch = patch.object(auth_handler, 'DB_FILE', os.path.join(self.tmp_dir.name, 'user_data.db'))
+        self.db_patch.start()
+        initialize_user_db()
         # Reset the session state before each test
         st.session_state = {}
 
     def tearDown(self):
-        # Close the connection after each test
-        self.conn.close()
-
-    
+        auth_handler.close_connection_pools()
+        self.db_patch.stop()
+        self.tmp_dir.cleanup()
 
     def test_register_user_success(self):
         success, message = register_user('test_user', 'test_password')
@@ -66,5 +65,52 @@ class TestAuthHandler(unittest.TestCase):
         self.assertNotIn('logged_in', st.session_state)
         self.assertNotIn('username', st.session_state)
 
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.tmp_dir.name, 'users.db')
+
+    def tearDown(self):
+        auth_handler.close_connection_pools()
+        self.tmp_dir.cleanup()
+
+    def test_pool_is_shared_and_migrated(self):
+        pool = auth_handler.get_connection_pool(self.db_file)
+        self.assertIs(auth_handler.get_connection_pool(self.db_file), pool)
+        with pool.connection() as conn:
+            self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], len(auth_handler.MIGRATIONS))
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    def test_existing_database_is_migrated_once(self):
+        # A database made before versioning: the table exists, user_version is 0
+        conn = sqlite3.connect(self.db_file)
+        conn.execute(auth_handler.MIGRATIONS[0])
+        conn.execute("INSERT INTO users VALUES ('old_user', 'hash')")
+        conn.commit()
+        conn.close()
+        with auth_handler.get_connection_pool(self.db_file).connection() as conn:
+            self.assertEqual(conn.execute('SELECT username FROM users').fetchall(), [('old_user',)])
+            self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], 1)
+
+    def test_connections_are_reused(self):
+        pool = auth_handler.ConnectionPool(self.db_file, size=2)
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            self.assertIs(second, first)
+        pool.close()
+
+    @patch.object(auth_handler, 'BCRYPT_ROUNDS', 4)
+    def test_concurrent_logins(self):
+        with patch.object(auth_handler, 'DB_FILE', self.db_file):
+            usernames = [f'user_{i}' for i in range(6)]
+            for username in usernames:
+                self.assertTrue(auth_handler.register_user(username, 'password')[0])
+            with ThreadPoolExecutor(max_workers=6) as executor:
+                results = list(executor.map(lambda username: auth_handler.verify_credentials(username, 'password'), usernames))
+            self.assertEqual(results, [(True, "Login successful.")] * 6)
+            self.assertEqual(auth_handler.verify_credentials('user_0', 'wrong'), (False, "Incorrect password."))
+
 if __name__ == '__main__':
     unittest.main()
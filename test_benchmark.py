@@ -0,0 +1,31 @@
+import os
+import unittest
+from unittest.mock import patch
+import benchmark
+from benchmark import make_synthetic_pivot, run_benchmarks, compare_reports
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_synthetic_pivot_layout(self):
+        pivot = make_synthetic_pivot(50, 20)
+        self.assertEqual(pivot.shape, (50, 20))
+        self.assertEqual(pivot.index.name, 'atom')
+        self.assertEqual(list(pivot.columns[:3]), [0, 1, 2])
+        self.assertTrue((pivot.values > 0).all())
+
+    def test_report_covers_every_hot_path(self):
+        cwd = os.getcwd()
+        with patch.dict(benchmark.SCALES, {'tiny': (120, 60)}), patch.object(benchmark.auth_handler, 'BCRYPT_ROUNDS', 4):
+            report = run_benchmarks(['tiny'], repeat=1, login_concurrency=[1, 3])
+        self.assertEqual(os.getcwd(), cwd)
+        results = report['scales']['tiny']['results']
+        for name in ['load_dataset[pickle]', 'load_dataset[store]', 'normalize_per_frame', 'construct_KE_pairs', 'add_residue_category', 'generate_ngl_viewer_html[cold]']:
+            self.assertIn(name, results)
+        self.assertEqual(len([name for name in results if name.startswith('reorder_data')]), 3)
+        self.assertEqual(set(report['logins']['results']), {'1', '3'})
+        self.assertEqual(report['logins']['results']['3']['logins'], 3 * benchmark.LOGINS_PER_SESSION)
+        ratios = compare_reports(report, report)
+        self.assertTrue(all(ratio == 1.0 for ratio in ratios['tiny'].values()))
+
+if __name__ == '__main__':
+    unittest.main()
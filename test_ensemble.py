@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from unittest.mock import patch
+from ensemble import EnsembleState, compute_ensemble, load_ensemble, histogram_edges, ensemble_values, _prepare_run, _load_block
+from pivot_store import convert_pickle_to_store, load_pivot_window
+from transforms import apply_transform_chain
+
+class TestEnsembleState(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.runs = rng.gamma(2.0, 0.5, size=(9, 6, 5))
+        self.runs[2, 0, 0] = np.nan
+        self.edges = histogram_edges(np.nanmin(self.runs), np.nanmax(self.runs))
+
+    def test_merged_states_match_numpy(self):
+        left, right = EnsembleState((6, 5), self.edges), EnsembleState((6, 5), self.edges)
+        for i, values in enumerate(self.runs):
+            (left if i % 2 else right).add(values)
+        stats = left.merge(right).statistics()
+        np.testing.assert_allclose(stats['mean'], np.nanmean(self.runs, axis=0))
+        np.testing.assert_allclose(stats['std'], np.nanstd(self.runs, axis=0, ddof=1))
+        self.assertEqual(stats['count'][0, 0], 8)
+        self.assertEqual(stats['count'][1, 1], 9)
+
+    def test_quantiles_are_close_and_ordered(self):
+        state = EnsembleState((6, 5), self.edges)
+        for values in self.runs:
+            state.add(values)
+        stats = state.statistics()
+        # Quantiles fall in the histogram bin of the run value of their rank
+        ratio = self.edges[1] / self.edges[0]
+        median = np.nanquantile(self.runs, 0.5, axis=0, method='inverted_cdf')
+        self.assertTrue(np.all(np.abs(np.log(stats['median'] / median)) < np.log(ratio)))
+        self.assertTrue(np.all(stats['q05'] <= stats['q25']) and np.all(stats['q25'] <= stats['median']))
+        self.assertTrue(np.all(stats['median'] <= stats['q75']) and np.all(stats['q75'] <= stats['q95']))
+
+class TestEnsembleCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.base_path = os.path.join(self.tmpdir.name, "pivots")
+        self.cache_dir = os.path.join(self.tmpdir.name, "analysis_cache")
+        os.makedirs(os.path.join(self.base_path, "residue", "effective"))
+        rng = np.random.default_rng(4)
+        self.pivots = [pd.DataFrame(rng.gamma(2.0, 0.5, size=(4, 3)), index=pd.Index([1, 2, 3, 4], name='residue_number'), columns=[0, 1, 2]) for _ in range(3)]
+        for i, pivot in enumerate(self.pivots[:2]):
+            pivot.to_pickle(self._path(i))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _path(self, i):
+        return os.path.join(self.base_path, "residue", "effective", f"data_pivot_{i:04d}.pckl")
+
+    def test_cached_ensemble_goes_stale_with_the_runs(self):
+        self.assertIsNone(load_ensemble("residue", "effective", base_path=self.base_path, cache_dir=self.cache_dir))
+        ensemble = compute_ensemble("residue", "effective", base_path=self.base_path, cache_dir=self.cache_dir, workers=2)
+        self.assertEqual(ensemble['runs'], ["0000", "0001"])
+        np.testing.assert_allclose(ensemble['mean'].values, (self.pivots[0].values + self.pivots[1].values) / 2)
+        self.assertIsNotNone(load_ensemble("residue", "effective", base_path=self.base_path, cache_dir=self.cache_dir))
+
+        self.pivots[2].to_pickle(self._path(2))
+        from manifest_handler import refresh_manifest
+        refresh_manifest(self.base_path)
+        self.assertIsNone(load_ensemble("residue", "effective", base_path=self.base_path, cache_dir=self.cache_dir))
+        ensemble = compute_ensemble("residue", "effective", base_path=self.base_path, cache_dir=self.cache_dir, workers=2)
+        np.testing.assert_allclose(ensemble['mean'].values, np.mean([p.values for p in self.pivots], axis=0))
+
+    def test_frames_are_reduced_in_blocks(self):
+        # One frame per block, with a frame-chunked store run among the pickled ones
+        convert_pickle_to_store(self._path(0), chunk_frames=2)
+        self.assertEqual(ensemble_values("residue", "effective", base_path=self.base_path), 24)
+        with patch('ensemble.ENSEMBLE_BLOCK_CELLS', 4):
+            for transform in ('raw', 'per_frame'):
+                ensemble = compute_ensemble("residue", "effective", transform, base_path=self.base_path, cache_dir=self.cache_dir, workers=2)
+                views = np.array([apply_transform_chain(p, transform).values for p in self.pivots[:2]])
+                np.testing.assert_allclose(ensemble['mean'].values, views.mean(axis=0))
+                np.testing.assert_allclose(ensemble['std'].values, views.std(axis=0, ddof=1))
+                np.testing.assert_array_equal(ensemble['count'].values, 2)
+                self.assertTrue(np.all(ensemble['q05'].values <= ensemble['q95'].values))
+                self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "residue", "effective", transform, "runs.tmp")))
+
+    def test_blocks_of_a_prepared_run_read_only_their_frames(self):
+        pivot = self.pivots[0]
+        source, totals, value_range = _prepare_run(self._path(0), 'per_frame', os.path.join(self.tmpdir.name, "scratch"), 2)
+        view = apply_transform_chain(pivot, 'per_frame')
+        self.assertEqual(value_range, (view.values.min(), view.values.max()))
+        with patch('ensemble.load_pivot_window', wraps=load_pivot_window) as load_window:
+            block = _load_block(source, totals, pivot.index, pd.Index([1, 2]))
+        load_window.assert_called_once_with(source, 1, 2)
+        np.testing.assert_allclose(block, view.loc[:, [1, 2]].values)
+
+if __name__ == '__main__':
+    unittest.main()
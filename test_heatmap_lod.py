@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+from heatmap_lod import block_starts, pool_matrix, reduce_heatmap, window_from_box
+
+class TestHeatmapLOD(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.values = rng.random((53, 17))
+        self.values[4, 5] = np.nan
+
+    def test_pooling_matches_block_loop(self):
+        row_starts, col_starts = block_starts(53, 10), block_starts(17, 4)
+        row_stops, col_stops = np.append(row_starts[1:], 53), np.append(col_starts[1:], 17)
+        for method, reducer in [('max', np.nanmax), ('mean', np.nanmean)]:
+            pooled = pool_matrix(self.values, row_starts, col_starts, method)
+            expected = np.array([[reducer(self.values[r0:r1, c0:c1]) for c0, c1 in zip(col_starts, col_stops)] for r0, r1 in zip(row_starts, row_stops)])
+            np.testing.assert_allclose(pooled, expected)
+        with self.assertRaises(ValueError):
+            pool_matrix(self.values, row_starts, col_starts, 'median')
+
+    def test_small_matrix_is_sent_unpooled(self):
+        pooled, row_centers, col_centers, row_starts = reduce_heatmap(self.values, max_rows=100, max_cols=100)
+        np.testing.assert_array_equal(pooled, self.values)
+        np.testing.assert_array_equal(row_centers, np.arange(53))
+        np.testing.assert_array_equal(row_starts, np.arange(53))
+
+    def test_window_is_bounded_and_keeps_coordinates(self):
+        pooled, row_centers, col_centers, row_starts = reduce_heatmap(self.values, (10, 40), (2, 12), max_rows=7, max_cols=20, method='max')
+        self.assertEqual(pooled.shape, (7, 10))
+        self.assertEqual(row_starts[0], 10)
+        np.testing.assert_array_equal(col_centers, np.arange(2, 12))
+        self.assertEqual(pooled.max(), np.nanmax(self.values[10:40, 2:12]))
+
+    def test_window_from_box(self):
+        self.assertEqual(window_from_box([40.7, 10.2], 100), (10, 42))
+        self.assertEqual(window_from_box([-5, 3.4], 100), (0, 4))
+        self.assertIsNone(window_from_box([120, 130], 100))
+
+if __name__ == '__main__':
+    unittest.main()
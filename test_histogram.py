@@ -0,0 +1,45 @@
+import unittest
+import numpy as np
+import pandas as pd
+from unittest.mock import patch
+import pivot_cache
+from histogram import compute_base_histogram, rebin_histogram
+from pivot_cache import PivotCache, get_cached_histogram
+
+class TestHistogram(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        self.pivot = pd.DataFrame(rng.gamma(2.0, 0.6, size=(40, 30)))
+        self.pivot.iloc[0, 0] = np.nan
+
+    def test_rebinning_matches_direct_binning_on_the_grid(self):
+        counts, edges = compute_base_histogram(self.pivot)
+        self.assertEqual(counts.sum(), 40 * 30 - 1)
+        values = self.pivot.values.ravel()
+        for bin_number, low, high in [(50, 0.0, 1.0), (20, 0.5, 4.5), (7, 0.1, 0.8)]:
+            rebinned, target_edges = rebin_histogram(counts, edges, bin_number, low, high)
+            expected, _ = np.histogram(values[(values >= low) & (values <= high)], bins=bin_number, range=(low, high))
+            np.testing.assert_allclose(rebinned, expected, atol=1e-6)
+            self.assertEqual(len(target_edges), bin_number + 1)
+
+    def test_empty_and_constant_pivots(self):
+        counts, edges = compute_base_histogram(np.full((3, 3), np.nan))
+        self.assertEqual(rebin_histogram(counts, edges, 4, 0, 1)[0].tolist(), [0, 0, 0, 0])
+        counts, edges = compute_base_histogram(np.full((3, 3), 2.0))
+        self.assertEqual(rebin_histogram(counts, edges, 2, 1.0, 3.0)[0].sum(), 9)
+
+    def test_histograms_are_rebinned_from_one_cached_base(self):
+        loads = []
+        def load(run_num, resolution, category):
+            loads.append(run_num)
+            return self.pivot
+        with patch.object(pivot_cache, '_pivot_cache', PivotCache(10 ** 8)), patch.object(pivot_cache, 'load_dataset', load), \
+             patch.object(pivot_cache, 'load_derived', lambda *args, **kwargs: None):
+            first = get_cached_histogram('0001', 'residue', 'effective', 'raw', 10, 0.0, 2.0)
+            second = get_cached_histogram('0001', 'residue', 'effective', 'raw', 25, 0.5, 3.0)
+        self.assertEqual(loads, ['0001'])
+        self.assertEqual((len(first[0]), len(second[0])), (10, 25))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from ingest import ingest_gro, index_gro_chunks, read_gro_header, atom_masses, ELEMENT_MASSES
+from pivot_store import load_pivot_store
+from manifest_handler import register_datasets_from_manifest
+
+# (residue number, residue name, atom name)
+ATOMS = [(1, 'ALA', 'N'), (1, 'ALA', 'CA'), (1, 'ALA', 'HA'), (2, 'GLY', 'CA'), (2, 'GLY', 'O'), (3, 'CA', 'CA')]
+
+def write_gro(path, velocities, trailing_newline=True):
+    lines = []
+    for frame, frame_velocities in enumerate(velocities):
+        lines.append(f"Synthetic t= {frame * 10.0:.5f}")
+        lines.append(f"{len(ATOMS):5d}")
+        for atom, ((residue, residue_name, atom_name), v) in enumerate(zip(ATOMS, frame_velocities)):
+            lines.append(f"{residue:5d}{residue_name:<5s}{atom_name:>5s}{atom + 1:5d}{atom * 0.1:8.3f}{0.0:8.3f}{1.0:8.3f}{v[0]:8.4f}{v[1]:8.4f}{v[2]:8.4f}")
+        lines.append("   5.00000   5.00000   5.00000")
+    Path(path).write_text("\n".join(lines) + ("\n" if trailing_newline else ""))
+
+class TestIngest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.base = Path(self.tmp_dir.name)
+        rng = np.random.default_rng(0)
+        self.velocities = np.round(rng.normal(size=(7, len(ATOMS), 3)), 4)
+        self.gro_path = self.base / "traj.gro"
+        write_gro(self.gro_path, self.velocities)
+        masses = np.array([ELEMENT_MASSES[e] for e in ('N', 'C', 'H', 'C', 'O', 'CA')])
+        self.expected_KE = 0.5 * masses[:, None] * (self.velocities ** 2).sum(axis=2).T
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_header(self):
+        n_atoms, field_width, atom_table = read_gro_header(self.gro_path)
+        self.assertEqual((n_atoms, field_width), (len(ATOMS), 8))
+        self.assertEqual(atom_table['residue_number'].tolist(), [1, 1, 1, 2, 2, 3])
+
+    def test_masses(self):
+        masses = atom_masses(['CA', '1HB', 'CA'], ['ALA', 'ALA', 'CAL'])
+        np.testing.assert_allclose(masses, [ELEMENT_MASSES['C'], ELEMENT_MASSES['H'], ELEMENT_MASSES['CA']])
+        with self.assertRaises(ValueError):
+            atom_masses(['XX'], ['UNK'])
+
+    def test_chunk_index(self):
+        n_frames, chunks = index_gro_chunks(self.gro_path, len(ATOMS), chunk_frames=3, block_size=64)
+        self.assertEqual(n_frames, 7)
+        self.assertEqual([(first, count) for _, _, first, count in chunks], [(0, 3), (3, 3), (6, 1)])
+        data = self.gro_path.read_bytes()
+        for start, _, _, _ in chunks:
+            self.assertTrue(data[start:].startswith(b"Synthetic"))
+
+    def test_incomplete_last_frame_is_dropped(self):
+        data = self.gro_path.read_bytes()
+        self.gro_path.write_bytes(data[:-40])
+        n_frames, _ = index_gro_chunks(self.gro_path, len(ATOMS), chunk_frames=3)
+        self.assertEqual(n_frames, 6)
+
+    def test_ingest(self):
+        write_gro(self.gro_path, self.velocities, trailing_newline=False)
+        pivots = self.base / "pivots"
+        stores = ingest_gro(self.gro_path, '0600', 'effective', pivots, chunk_frames=3, workers=2)
+        atom_pivot = load_pivot_store(stores['atom'])
+        self.assertEqual(atom_pivot.index.name, 'atom')
+        self.assertEqual(atom_pivot.columns.tolist(), list(range(7)))
+        np.testing.assert_allclose(atom_pivot.to_numpy(), self.expected_KE)
+
+        residue_pivot = load_pivot_store(stores['residue'])
+        self.assertEqual(residue_pivot.index.tolist(), [1, 2, 3])
+        expected = pd.DataFrame(self.expected_KE).groupby(np.array([1, 1, 1, 2, 2, 3])).sum().to_numpy()
+        np.testing.assert_allclose(residue_pivot.to_numpy(), expected)
+
+        self.assertEqual(register_datasets_from_manifest(pivots), {('atom', 'effective'): ['0600'], ('residue', 'effective'): ['0600']})
+
+    def test_frame_chunked_stores(self):
+        stores = ingest_gro(self.gro_path, '0600', 'effective', self.base / "pivots", chunk_frames=3, workers=2, store_chunk_frames=4)
+        np.testing.assert_allclose(load_pivot_store(stores['atom']).to_numpy(), self.expected_KE)
+
+    def test_requires_velocities(self):
+        lines = self.gro_path.read_text().splitlines()
+        self.gro_path.write_text("\n".join(line[:44] if i >= 2 and i < 2 + len(ATOMS) else line for i, line in enumerate(lines)))
+        with self.assertRaises(ValueError):
+            ingest_gro(self.gro_path, '0600', 'effective', self.base / "pivots")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import json
+import tempfile
+import unittest
+import plotly.graph_objects as go
+from instrumentation import start_rerun_timings, finish_rerun_timings, timed, record_payload, plotly_payload_bytes, append_timing_log, summarize_timing_log
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.tmpdir.name, "logs", "timings.jsonl")
+
+    def tearDown(self):
+        finish_rerun_timings()
+        self.tmpdir.cleanup()
+
+    def test_spans_nest_and_payloads_follow_the_span(self):
+        start_rerun_timings("session-a", 1)
+        with timed("sidebar"):
+            with timed("load reference"):
+                pass
+        with timed("visualization"):
+            fig = go.Figure(go.Bar(x=[1, 2], y=[3, 4]))
+            record_payload('plotly_chart', "histogram", plotly_payload_bytes(fig))
+        record = finish_rerun_timings()
+        self.assertEqual([span['name'] for span in record['spans']], ["sidebar/load reference", "sidebar", "visualization"])
+        self.assertEqual(record['payloads'][0]['span'], "visualization")
+        self.assertEqual(record['payloads'][0]['bytes'], len(fig.to_json()))
+        self.assertGreaterEqual(record['total_ms'], record['spans'][1]['ms'])
+        # Outside an instrumented run spans and payloads are ignored
+        with timed("orphan"):
+            record_payload('plotly_chart', "orphan", 10)
+        self.assertIsNone(finish_rerun_timings())
+
+    def test_log_percentiles_across_sessions(self):
+        for session, rerun, ms in [("a", 1, 10.0), ("a", 2, 20.0), ("b", 1, 30.0)]:
+            append_timing_log({'session_id': session, 'rerun': rerun, 'scope': 'script', 'started_at': None, 'total_ms': ms * 2, 'spans': [{'name': "sidebar", 'ms': ms}], 'payloads': []}, self.log_path)
+        with open(self.log_path, 'a') as f:
+            f.write('{"session_id": "c", "rer')
+        with open(self.log_path) as f:
+            self.assertEqual(json.loads(f.readline())['session_id'], "a")
+        summary = summarize_timing_log(self.log_path)
+        self.assertEqual(summary.loc[('script', 'sidebar'), 'count'], 3)
+        self.assertEqual(summary.loc[('script', 'sidebar'), 'sessions'], 2)
+        self.assertEqual(summary.loc[('script', 'sidebar'), 'p50'], 20.0)
+        self.assertEqual(summary.loc[('script', 'total'), 'p50'], 40.0)
+
+if __name__ == '__main__':
+    unittest.main()
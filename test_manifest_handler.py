@@ -0,0 +1,75 @@
+import os
+import unittest
+from unittest.mock import patch
+import manifest_handler
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from manifest_handler import refresh_manifest, register_datasets_from_manifest, load_manifest, get_dataset_metadata, get_manifest_path
+
+def write_pivot(path, n_rows=4, n_frames=6, scale=1.0):
+    pivot = pd.DataFrame(
+        np.arange(n_rows * n_frames, dtype=float).reshape(n_rows, n_frames) * scale,
+        index=pd.Index(np.arange(1, n_rows + 1), name='residue'),
+        columns=pd.Index(np.arange(n_frames), name='frame'),
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pivot.to_pickle(path)
+
+class TestManifestHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.base = Path(self.tmp_dir.name)
+        write_pivot(self.base / "residue/effective/data_pivot_0500.pckl")
+        write_pivot(self.base / "residue/neutral/data_pivot_2467.pckl", n_frames=10)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_metadata(self):
+        entry = refresh_manifest(self.base)['datasets']['residue/neutral/2467']
+        self.assertEqual(entry['shape'], [4, 10])
+        self.assertEqual((entry['frame_min'], entry['frame_max']), (0, 9))
+        self.assertEqual((entry['value_min'], entry['value_max']), (0.0, 39.0))
+        self.assertEqual(register_datasets_from_manifest(self.base), {
+            ('residue', 'effective'): ['0500'],
+            ('residue', 'neutral'): ['2467'],
+        })
+
+    def test_metadata_lookups_parse_the_manifest_once(self):
+        refresh_manifest(self.base)
+        with patch.object(manifest_handler, 'load_manifest', wraps=manifest_handler.load_manifest) as load:
+            for _ in range(3):
+                self.assertEqual(get_dataset_metadata('2467', 'residue', 'neutral', self.base)['shape'], [4, 10])
+            self.assertIsNone(get_dataset_metadata('9999', 'residue', 'neutral', self.base))
+            self.assertEqual(load.call_count, 1)
+
+            # A rewritten manifest (new mtime) is read again
+            write_pivot(self.base / "residue/neutral/data_pivot_2467.pckl", n_frames=12)
+            refresh_manifest(self.base)
+            stat = os.stat(get_manifest_path(self.base))
+            os.utime(get_manifest_path(self.base), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+            load.reset_mock()
+            self.assertEqual(get_dataset_metadata('2467', 'residue', 'neutral', self.base)['shape'], [4, 12])
+            self.assertEqual(get_dataset_metadata('0500', 'residue', 'effective', self.base)['shape'], [4, 6])
+            self.assertEqual(load.call_count, 1)
+
+    def test_incremental_refresh(self):
+        refresh_manifest(self.base)
+        before = load_manifest(self.base)['datasets']
+
+        changed_path = self.base / "residue/effective/data_pivot_0500.pckl"
+        write_pivot(changed_path, scale=2.0)
+        os.utime(changed_path, ns=(0, before['residue/effective/0500']['mtime_ns'] + 10 ** 9))
+        (self.base / "residue/neutral/data_pivot_2467.pckl").unlink()
+        write_pivot(self.base / "atom/effective/data_pivot_0500.pckl")
+
+        after = refresh_manifest(self.base)['datasets']
+        self.assertEqual(sorted(after), ['atom/effective/0500', 'residue/effective/0500'])
+        self.assertEqual(after['residue/effective/0500']['value_max'], 46.0)
+        self.assertNotEqual(after['residue/effective/0500']['sha256'], before['residue/effective/0500']['sha256'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import gzip
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+import pandas as pd
+import molvis
+from molvis import generate_pdb_base64_frame, generate_structure_url, residue_selections, generate_ngl_viewer_html
+from trajectory_store import build_frame_index, load_frame_index, read_frame_block, FRAME_INDEX_SUFFIX
+
+ATOM_LINE = "ATOM      1  N   ALA     1    {x:8.3f}  53.385  64.655  1.00  0.00           N\n"
+
+class TestFrameIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "traj_0001.pdb")
+        with open(self.path, 'w') as f:
+            f.write("REMARK    GENERATED BY TRJCONV\nCRYST1  100.069  100.069  100.069  90.00  90.00  90.00 P 1           1\n")
+            for model in range(3):
+                f.write(f"MODEL {model + 1:8d}\n" + ATOM_LINE.format(x=float(model)) + "TER\nENDMDL\n")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_index_points_at_model_blocks(self):
+        models = build_frame_index(self.path)
+        self.assertEqual(len(models), 3)
+        block = read_frame_block(self.path, 2)
+        self.assertTrue(block.startswith("MODEL        3\n"))
+        self.assertTrue(block.endswith("ENDMDL\n"))
+        self.assertIn("   2.000", block)
+
+    def test_index_is_saved_and_rebuilt_when_stale(self):
+        load_frame_index(self.path)
+        with open(self.path + FRAME_INDEX_SUFFIX) as f:
+            self.assertEqual(len(json.load(f)['models']), 3)
+        with open(self.path, 'a') as f:
+            f.write("MODEL        4\n" + ATOM_LINE.format(x=3.0) + "ENDMDL\n")
+        self.assertEqual(len(load_frame_index(self.path)), 4)
+
+    def test_frames_are_cached_per_frame(self):
+        _, center_1 = generate_pdb_base64_frame(self.path, 1)
+        _, center_2 = generate_pdb_base64_frame(self.path, 2)
+        self.assertAlmostEqual(center_1[0], 1.0, places=3)
+        self.assertAlmostEqual(center_2[0], 2.0, places=3)
+        # Frames beyond the trajectory fall back to the first model
+        self.assertAlmostEqual(generate_pdb_base64_frame(self.path, 99)[1][0], 0.0, places=3)
+
+class TestStructureServing(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.patcher = patch.object(molvis, 'STRUCTURE_DIR', Path(self.tmpdir.name) / "structures")
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.tmpdir.cleanup()
+
+    def test_structures_are_published_once_under_their_content_hash(self):
+        url, center = generate_structure_url("Calmod_sample.pdb", 0)
+        self.assertTrue(url.startswith("app/static/structures/") and url.endswith(".pdb.gz"))
+        path = molvis.STRUCTURE_DIR / url.rsplit("/", 1)[1]
+        self.assertIn(b"ATOM      1  N   ALA", gzip.decompress(path.read_bytes()))
+        self.assertEqual(generate_structure_url("Calmod_sample.pdb", 0), (url, center))
+        self.assertEqual(len(list(molvis.STRUCTURE_DIR.iterdir())), 1)
+
+    def test_highlights_are_grouped_per_category(self):
+        residues = pd.DataFrame({'residue': [15, 12, 40, 15, None], 'category': ['common', 'common', 'reference only', 'common', 'neighbour']})
+        self.assertEqual(residue_selections(residues, 'residue', 'category'), {'common': ':A and (12 or 15)', 'reference only': ':A and (40)'})
+
+    def test_viewer_html_references_structures_by_url(self):
+        KE_pairs = pd.DataFrame({
+            'bin_frame_mid': [3, 3, 8], 'residue_number_reference': [5, 6, 7], 'category_ref': ['common', 'reference only', 'common'],
+            'residue_number_comparison': [5, 9, 7], 'category_comp': ['common', 'comparison only', 'common'],
+        })
+        html = generate_ngl_viewer_html(3, "Calmod_sample.pdb", "Calmod_sample.pdb", KE_pairs)
+        self.assertLess(len(html), 20000)
+        self.assertIn('compressed: "gz"', html)
+        self.assertEqual(html.count('"ball+stick"'), 4)
+
+if __name__ == '__main__':
+    unittest.main()
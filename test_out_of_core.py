@@ -0,0 +1,127 @@
+import os
+import unittest
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from functools import partial
+from unittest.mock import patch
+from pivot_store import write_pivot_store, iter_pivot_chunks, get_store_path
+from reorder_handler import calculate_persistence_scores_all_thresholds, detect_longest_streaks_all_thresholds, calculate_absolute_persistence_score, compute_KE_bins
+from data_handler import normalize_per_frame
+from out_of_core import (window_percentiles, persistence_scores_all_thresholds, longest_streaks_all_thresholds, absolute_persistence_scores,
+                         KE_bin_starts, compute_KE_bins_chunked, is_out_of_core)
+import pivot_cache
+from precompute import precompute_run, load_derived, quantile_index_name
+
+def make_pivot(n_rows=30, n_frames=257):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        rng.gamma(2.0, 1.0, (n_rows, n_frames)),
+        index=pd.Index(np.arange(1, n_rows + 1), name='residue'),
+        columns=pd.Index(np.arange(n_frames), name='frame'),
+    )
+
+class TestOutOfCore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.base = Path(self.tmp_dir.name)
+        self.pivot = make_pivot()
+        self.store_path = write_pivot_store(self.pivot, self.base / "data_pivot_0001", chunk_frames=32)
+        self.chunks = partial(iter_pivot_chunks, self.store_path, 20, 230)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_percentiles_are_exact(self):
+        percentiles = [0, 0.5, 25, 50, 70, 99.9, 100]
+        np.testing.assert_array_equal(window_percentiles(self.chunks, percentiles), np.percentile(self.pivot.loc[:, 20:230].to_numpy(), percentiles))
+
+    def test_percentiles_with_negative_values(self):
+        store_path = write_pivot_store(self.pivot - 2.0, self.base / "data_pivot_0002", chunk_frames=32)
+        percentiles = [1, 33, 50, 99]
+        np.testing.assert_array_equal(window_percentiles(partial(iter_pivot_chunks, store_path), percentiles), np.percentile(self.pivot.to_numpy() - 2.0, percentiles))
+
+    def test_persistence_matches_in_memory(self):
+        pd.testing.assert_frame_equal(persistence_scores_all_thresholds(self.chunks), calculate_persistence_scores_all_thresholds(self.pivot, 20, 230))
+
+    def test_streaks_carry_across_chunks(self):
+        pd.testing.assert_frame_equal(longest_streaks_all_thresholds(self.chunks), detect_longest_streaks_all_thresholds(self.pivot, 20, 230))
+        # A row above every threshold throughout: its streak spans all chunks
+        pivot = self.pivot.copy()
+        pivot.iloc[0] = 100.0
+        store_path = write_pivot_store(pivot, self.base / "data_pivot_0003", chunk_frames=32)
+        streaks = longest_streaks_all_thresholds(partial(iter_pivot_chunks, store_path, 20, 230), thresholds=[50, 90])
+        self.assertEqual(streaks.iloc[0].tolist(), [211, 211])
+
+    def test_absolute_persistence(self):
+        np.testing.assert_allclose(absolute_persistence_scores(self.chunks), calculate_absolute_persistence_score(self.pivot, 20, 230))
+
+    def test_KE_bins_match_in_memory(self):
+        per_frame = normalize_per_frame(self.pivot)
+        store_path = write_pivot_store(per_frame, self.base / "per_frame", chunk_frames=32)
+        expected = compute_KE_bins(per_frame, 5, 0.1)
+        bins = compute_KE_bins_chunked(partial(iter_pivot_chunks, store_path), KE_bin_starts(0, 256, 5), 5, 0.1)
+        pd.testing.assert_frame_equal(bins, expected, check_dtype=False)
+        # A window keeps the bins of the whole run that fit into it
+        bins = compute_KE_bins_chunked(partial(iter_pivot_chunks, store_path, 53, 131), KE_bin_starts(53, 130, 5), 5, 0.1)
+        in_window = expected[(expected['bin_frame_start'] >= 53) & (expected['bin_frame_stop'] <= 131)].reset_index(drop=True)
+        pd.testing.assert_frame_equal(bins, in_window, check_dtype=False)
+
+    def test_empty_window(self):
+        chunks = partial(iter_pivot_chunks, self.store_path, 1000, 2000)
+        self.assertTrue(persistence_scores_all_thresholds(chunks, thresholds=[50]).isna().all().all())
+        self.assertEqual(longest_streaks_all_thresholds(chunks, thresholds=[50]).sum().sum(), 0)
+
+    def test_is_out_of_core(self):
+        self.assertTrue(is_out_of_core({'shape': [100_000, 10_000]}, budget_mb=2048))
+        self.assertFalse(is_out_of_core({'shape': [148, 201]}, budget_mb=2048))
+        self.assertFalse(is_out_of_core(None))
+
+class TestWindowedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        self.pivot = make_pivot()
+        write_pivot_store(self.pivot, get_store_path('9001', 'residue', 'effective'), chunk_frames=32)
+        pivot_cache.get_pivot_cache().clear()
+
+    def tearDown(self):
+        pivot_cache.get_pivot_cache().clear()
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def test_window_views_match_whole_run(self):
+        window = pivot_cache.get_cached_dataset('9001', 'residue', 'effective', 'per_frame', window=(40, 99))
+        pd.testing.assert_frame_equal(window, normalize_per_frame(self.pivot).loc[:, 40:99], check_exact=False)
+
+    def test_out_of_core_scores_match(self):
+        for option in ["Reordered by Persistence", "Reordered by Streak Length", "Reordered by Absolute Persistence"]:
+            scores = pivot_cache.get_cached_reordering_scores('9001', 'residue', 'effective', 'per_frame', option, 42, 200, 70, out_of_core=True)
+            pivot_cache.get_pivot_cache().clear()
+            expected = pivot_cache.get_cached_reordering_scores('9001', 'residue', 'effective', 'per_frame', option, 42, 200, 70)
+            np.testing.assert_allclose(scores.to_numpy(dtype=float), expected.to_numpy(dtype=float))
+
+    def test_chunked_store_is_precomputed_chunk_by_chunk(self):
+        write_pivot_store(self.pivot, get_store_path('9002', 'residue', 'effective'))
+        _, written = precompute_run('9002', 'residue', 'effective')
+        _, written_chunked = precompute_run('9001', 'residue', 'effective')
+        # Only the quantile index needs the whole run
+        self.assertEqual(sorted(written_chunked), sorted(set(written) - {quantile_index_name('raw'), quantile_index_name('per_frame')}))
+        with patch('pivot_store.load_pivot_window', side_effect=AssertionError("loaded whole")):
+            precompute_run('9001', 'residue', 'effective', overwrite=True)
+        for name in written_chunked:
+            expected, artifact = load_derived('9002', 'residue', 'effective', name), load_derived('9001', 'residue', 'effective', name)
+            if name.startswith('histogram_'):
+                np.testing.assert_array_equal(artifact[0], expected[0])
+                np.testing.assert_allclose(artifact[1], expected[1])
+            elif name.startswith('ke_bins_'):
+                pd.testing.assert_frame_equal(artifact.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False)
+            else:
+                np.testing.assert_allclose(artifact.to_numpy(dtype=float), expected.to_numpy(dtype=float), rtol=1e-12, err_msg=name)
+
+if __name__ == '__main__':
+    unittest.main()
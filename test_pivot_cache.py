@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from unittest.mock import patch
+import pivot_cache
+from pivot_cache import PivotCache
+
+class TestPivotCache(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        cache = PivotCache(max_bytes=10_000)
+        calls = []
+        compute = lambda: calls.append(1) or np.zeros(10)
+        cache.get_or_compute(('0500', 'residue', 'effective', 'raw'), compute)
+        cache.get_or_compute(('0500', 'residue', 'effective', 'raw'), compute)
+        self.assertEqual(len(calls), 1)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_size_aware_eviction(self):
+        # Room for two 400 byte arrays, not three
+        cache = PivotCache(max_bytes=1000)
+        for run in ['a', 'b']:
+            cache.get_or_compute((run,), lambda: np.zeros(50))
+        cache.get_or_compute(('a',), lambda: np.zeros(50))  # 'a' becomes most recently used
+        cache.get_or_compute(('c',), lambda: np.zeros(50))
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertLessEqual(stats['current_bytes'], 1000)
+        # 'b' was the least recently used entry
+        cache.get_or_compute(('a',), lambda: self.fail("'a' should still be cached"))
+        recomputed = []
+        cache.get_or_compute(('b',), lambda: recomputed.append(1) or np.zeros(50))
+        self.assertEqual(recomputed, [1])
+
+    def test_oversized_and_missing_values_are_not_cached(self):
+        cache = PivotCache(max_bytes=100)
+        self.assertEqual(cache.get_or_compute(('big',), lambda: np.zeros(1000)).shape, (1000,))
+        self.assertIsNone(cache.get_or_compute(('missing',), lambda: None))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_ensembles_are_reduced_again_when_the_manifest_changes(self):
+        pivot_cache.get_pivot_cache().clear()
+        with patch('pivot_cache.get_manifest_version', return_value=1), patch('pivot_cache.ensemble_values', return_value=1), patch('pivot_cache.compute_ensemble', side_effect=lambda *args: {'runs': ['0001']}) as compute:
+            pivot_cache.get_cached_ensemble('residue', 'effective')
+            pivot_cache.get_cached_ensemble('residue', 'effective')
+            self.assertEqual(compute.call_count, 1)
+            with patch('pivot_cache.get_manifest_version', return_value=2):
+                pivot_cache.get_cached_ensemble('residue', 'effective')
+            self.assertEqual(compute.call_count, 2)
+        pivot_cache.get_pivot_cache().clear()
+
+    def test_pivots_rewritten_in_place_are_loaded_again(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        cwd = os.getcwd()
+        os.chdir(tmp_dir.name)
+        pivot_cache.get_pivot_cache().clear()
+        try:
+            path = os.path.join("pivots", "residue", "effective", "data_pivot_9002.pckl")
+            os.makedirs(os.path.dirname(path))
+            pd.DataFrame(np.ones((3, 4))).to_pickle(path)
+            self.assertEqual(pivot_cache.get_cached_dataset('9002', 'residue', 'effective').sum().sum(), 12)
+            pd.DataFrame(np.full((3, 5), 2.0)).to_pickle(path)
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            self.assertEqual(pivot_cache.get_cached_dataset('9002', 'residue', 'effective').sum().sum(), 30)
+        finally:
+            pivot_cache.get_pivot_cache().clear()
+            os.chdir(cwd)
+            tmp_dir.cleanup()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from pivot_store import write_pivot_store, load_pivot_store, convert_pickle_to_store, has_store, load_pivot_window, iter_pivot_chunks, PivotStoreWriter
+
+def make_pivot(n_rows=6, n_frames=5, index_name='residue'):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        rng.random((n_rows, n_frames)),
+        index=pd.Index(np.arange(1, n_rows + 1), name=index_name),
+        columns=pd.Index(np.arange(n_frames), name='frame'),
+    )
+
+class TestPivotStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.base = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        pivot = make_pivot()
+        store_path = write_pivot_store(pivot, self.base / "data_pivot_0001")
+        loaded = load_pivot_store(store_path)
+        pd.testing.assert_frame_equal(loaded, pivot)
+
+    def test_load_is_zero_copy(self):
+        store_path = write_pivot_store(make_pivot(), self.base / "data_pivot_0001")
+        loaded = load_pivot_store(store_path)
+        self.assertFalse(loaded.values.flags.writeable)
+        # Walk the view chain back to the memory map
+        base = loaded.values
+        while base is not None and not isinstance(base, np.memmap):
+            base = base.base
+        self.assertIsInstance(base, np.memmap)
+
+    def test_convert_pickle(self):
+        pivot = make_pivot(index_name='atom')
+        pickle_path = self.base / "data_pivot_0002.pckl"
+        pivot.to_pickle(pickle_path)
+        store_path = convert_pickle_to_store(pickle_path)
+        self.assertEqual(store_path, self.base / "data_pivot_0002")
+        self.assertTrue(has_store(store_path))
+        pd.testing.assert_frame_equal(load_pivot_store(store_path), pivot)
+        # A second conversion is skipped unless overwrite is requested
+        self.assertIsNone(convert_pickle_to_store(pickle_path))
+
+    def test_frame_chunked_store(self):
+        pivot = make_pivot(n_frames=23)
+        store_path = write_pivot_store(pivot, self.base / "data_pivot_0003", chunk_frames=5)
+        self.assertEqual(np.load(store_path / "values.npy", mmap_mode='r').shape, (5, 6, 5))
+        pd.testing.assert_frame_equal(load_pivot_store(store_path), pivot)
+        pd.testing.assert_frame_equal(load_pivot_window(store_path, 7, 16), pivot.loc[:, 7:16])
+        blocks = list(iter_pivot_chunks(store_path, 3, 21))
+        self.assertEqual([block.shape[1] for block in blocks], [2, 5, 5, 5, 2])
+        pd.testing.assert_frame_equal(pd.concat(blocks, axis=1), pivot.loc[:, 3:21])
+
+    def test_window_of_plain_store_is_a_view(self):
+        pivot = make_pivot()
+        store_path = write_pivot_store(pivot, self.base / "data_pivot_0004")
+        window = load_pivot_window(store_path, 1, 3)
+        pd.testing.assert_frame_equal(window, pivot.loc[:, 1:3])
+        self.assertFalse(window.values.flags.writeable)
+
+    def test_writer_in_blocks(self):
+        pivot = make_pivot(n_frames=11)
+        for chunk_frames in (None, 4):
+            writer = PivotStoreWriter(self.base / f"data_pivot_{chunk_frames}", pivot.index, pivot.columns, index_name='residue', chunk_frames=chunk_frames)
+            for start in range(0, 11, 3):
+                self.assertFalse(has_store(writer.store_path))
+                writer.write_frames(start, pivot.to_numpy()[:, start:start + 3])
+            pd.testing.assert_frame_equal(load_pivot_store(writer.close()), pivot)
+
+if __name__ == '__main__':
+    unittest.main()
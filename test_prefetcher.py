@@ -0,0 +1,50 @@
+import os
+import tempfile
+import threading
+import unittest
+from prefetcher import FramePrefetcher, neighbour_frames
+
+class TestFramePrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for name in ("traj_0001.pdb", "traj_0002.pdb"):
+            path = os.path.join(self.tmpdir.name, name)
+            open(path, 'w').close()
+            self.paths.append(path)
+        self.loaded = []
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.tmpdir.cleanup()
+
+    def _load(self, path, frame):
+        self.release.wait(5)
+        self.loaded.append((os.path.basename(path), frame))
+
+    def test_neighbour_order_and_bounds(self):
+        self.assertEqual(neighbour_frames(10, 5, 2), [15, 5, 20, 0])
+        self.assertEqual(neighbour_frames(3, 5, 2, max_frame=12), [8])
+
+    def test_prefetch_loads_both_runs(self):
+        prefetcher = FramePrefetcher(self._load, workers=2)
+        self.release.set()
+        self.assertEqual(prefetcher.prefetch(self.paths + ["missing.pdb"], 10, 5, n_bins=1), 4)
+        prefetcher.shutdown()
+        self.assertEqual(sorted(self.loaded), [("traj_0001.pdb", 5), ("traj_0001.pdb", 15), ("traj_0002.pdb", 5), ("traj_0002.pdb", 15)])
+
+    def test_queue_is_bounded_and_jumps_cancel_stale_work(self):
+        prefetcher = FramePrefetcher(self._load, workers=1, max_pending=3)
+        self.assertEqual(prefetcher.prefetch(self.paths, 50, 5, n_bins=4), 3)
+        # A jump: queued loads of the old selection are cancelled, the running one is not repeated
+        prefetcher.prefetch(self.paths[:1], 100, 5, n_bins=1)
+        self.release.set()
+        prefetcher.shutdown()
+        self.assertEqual(self.loaded[-2:], [("traj_0001.pdb", 105), ("traj_0001.pdb", 95)])
+        self.assertLessEqual(len(self.loaded), 3)
+        self.assertGreaterEqual(prefetcher.cancelled, 2)
+
+if __name__ == '__main__':
+    unittest.main()
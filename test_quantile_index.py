@@ -0,0 +1,97 @@
+import unittest
+import numpy as np
+import pandas as pd
+from quantile_index import QuantileIndex, quantile_tables
+from out_of_core import window_percentiles, persistence_scores_all_thresholds
+from reorder_handler import calculate_persistence_scores_all_thresholds, detect_longest_streaks_all_thresholds, calculate_persistence_score, detect_longest_streak
+
+def make_pivot(n_rows=40, n_frames=300):
+    rng = np.random.default_rng(0)
+    # Rounded, so many values are tied
+    return pd.DataFrame(
+        rng.gamma(2.0, 1.0, (n_rows, n_frames)).round(1),
+        index=pd.Index(np.arange(1, n_rows + 1), name='residue'),
+        columns=pd.Index(np.arange(n_frames), name='frame'),
+    )
+
+PERCENTILES = list(range(0, 101)) + [0.5, 33.3, 99.9]
+
+class TestQuantileIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.pivot = make_pivot()
+        self.index = QuantileIndex(self.pivot, block_frames=32)
+
+    def test_matches_np_percentile(self):
+        # Whole blocks only, edges only, blocks and edges, a window inside one block
+        for frame_min, frame_max in [(0, 299), (32, 95), (42, 299), (5, 20), (31, 32), (100, 100)]:
+            expected = np.percentile(self.pivot.loc[:, frame_min:frame_max].to_numpy(), PERCENTILES)
+            np.testing.assert_array_equal(self.index.percentiles(frame_min, frame_max, PERCENTILES), expected)
+
+    def test_negative_and_infinite_values(self):
+        pivot = self.pivot - 2.0
+        pivot.iloc[0, 0] = -np.inf
+        index = QuantileIndex(pivot, block_frames=16)
+        with np.errstate(invalid='ignore'):
+            np.testing.assert_array_equal(index.percentiles(0, 150, [1, 25, 50, 99]), np.percentile(pivot.loc[:, 0:150].to_numpy(), [1, 25, 50, 99]))
+
+    def test_empty_window_and_nan(self):
+        self.assertTrue(np.isnan(self.index.percentiles(500, 600, [50])).all())
+        pivot = self.pivot.copy()
+        pivot.iloc[3, 200] = np.nan
+        pivot.iloc[5, 10] = np.nan
+        index = QuantileIndex(pivot, block_frames=32)
+        self.assertEqual(index.tables['nan_counts'].sum(), 2)
+        # NaN values are left out, in whole blocks and edge frames alike
+        for frame_min, frame_max in [(150, 250), (0, 299), (10, 10), (0, 199)]:
+            np.testing.assert_array_equal(index.percentiles(frame_min, frame_max, PERCENTILES), np.nanpercentile(pivot.loc[:, frame_min:frame_max].to_numpy(), PERCENTILES))
+        pivot.iloc[:, 10] = np.nan
+        self.assertTrue(np.isnan(QuantileIndex(pivot, block_frames=32).percentiles(10, 10, [50])).all())
+
+    def test_agrees_with_out_of_core_percentiles_on_nan(self):
+        pivot = self.pivot.copy()
+        pivot.iloc[::7, 40:90] = np.nan
+        index = QuantileIndex(pivot, block_frames=32)
+        for frame_min, frame_max in [(42, 299), (50, 60), (0, 299)]:
+            window = pivot.loc[:, frame_min:frame_max]
+            chunks = lambda: (window.iloc[:, start:start + 25] for start in range(0, window.shape[1], 25))
+            np.testing.assert_array_equal(index.percentiles(frame_min, frame_max, PERCENTILES), window_percentiles(chunks, PERCENTILES))
+        # And so do the scores of both paths
+        threshold_values = index.percentiles(42, 299, list(range(0, 101)))
+        chunks = lambda: (pivot.loc[:, 42:299].iloc[:, start:start + 25] for start in range(0, 258, 25))
+        np.testing.assert_array_equal(calculate_persistence_scores_all_thresholds(pivot, 42, 299, threshold_values=threshold_values).to_numpy(), persistence_scores_all_thresholds(chunks).to_numpy())
+        np.testing.assert_array_equal(calculate_persistence_scores_all_thresholds(pivot, 42, 299).to_numpy(), persistence_scores_all_thresholds(chunks).to_numpy())
+
+    def test_precomputed_tables(self):
+        tables = quantile_tables(self.pivot, block_frames=64)
+        self.assertEqual(len(tables['block_starts']), 6)
+        self.assertEqual(tables['keys'].size, self.pivot.size)
+        self.assertTrue(np.all(np.diff(tables['keys']) >= 0))
+        index = QuantileIndex(self.pivot, tables)
+        self.assertEqual(index.block_frames, 64)
+        np.testing.assert_array_equal(index.percentiles(10, 250, [70]), np.percentile(self.pivot.loc[:, 10:250].to_numpy(), [70]))
+
+    def test_scores_from_index(self):
+        threshold_values = self.index.percentiles(42, 299, list(range(0, 101)))
+        pd.testing.assert_frame_equal(calculate_persistence_scores_all_thresholds(self.pivot, 42, 299, threshold_values=threshold_values), calculate_persistence_scores_all_thresholds(self.pivot, 42, 299))
+        pd.testing.assert_frame_equal(detect_longest_streaks_all_thresholds(self.pivot, 42, 299, threshold_values=threshold_values), detect_longest_streaks_all_thresholds(self.pivot, 42, 299))
+        pd.testing.assert_series_equal(calculate_persistence_score(self.pivot, 42, 299, 70, threshold_values[70]), calculate_persistence_score(self.pivot, 42, 299, 70))
+        pd.testing.assert_series_equal(detect_longest_streak(self.pivot, 42, 299, 70, threshold_values[70]), detect_longest_streak(self.pivot, 42, 299, 70))
+
+class TestPersistenceCurve(unittest.TestCase):
+
+    def test_curve_matches_single_thresholds(self):
+        pivot = make_pivot(n_rows=12, n_frames=90)
+        thresholds = [90, 10, 50, 50, 75]
+        table = calculate_persistence_scores_all_thresholds(pivot, 5, 80, thresholds)
+        self.assertEqual(table.columns.tolist(), thresholds)
+        for position, threshold in enumerate(thresholds):
+            np.testing.assert_array_equal(table.iloc[:, position].to_numpy(), calculate_persistence_score(pivot, 5, 80, threshold).to_numpy())
+
+    def test_curve_decreases_with_threshold(self):
+        table = calculate_persistence_scores_all_thresholds(make_pivot(), 0, 299)
+        self.assertTrue(np.all(np.diff(table.to_numpy(), axis=1) <= 0))
+        np.testing.assert_array_equal(table[0].to_numpy(), 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import itertools
+from unittest.mock import patch
+import reorder_handler
+import numpy as np
+import pandas as pd
+from reorder_handler import (longest_streaks, detect_longest_streak, detect_longest_streaks_all_thresholds,
+                             calculate_persistence_score, calculate_persistence_scores_all_thresholds,
+                             calculate_absolute_persistence_score, compute_KE_bins, add_residue_category)
+
+def reference_longest_streak(row):
+    # The former itertools.groupby implementation, with 0 for rows without a streak
+    return max((sum(1 for _ in group) for key, group in itertools.groupby(row) if key), default=0)
+
+def make_pivot(n_rows=12, n_frames=30, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(rng.random((n_rows, n_frames)), index=pd.Index(range(1, n_rows + 1), name='residue'),
+                        columns=pd.Index(range(n_frames), name='frame'))
+
+class TestStreaks(unittest.TestCase):
+
+    def test_longest_streaks(self):
+        mask = np.array([
+            [True, True, False, True, True, True],
+            [False, False, False, False, False, False],
+            [True, True, True, True, True, True],
+            [False, True, False, True, False, True],
+        ])
+        np.testing.assert_array_equal(longest_streaks(mask), [3, 0, 6, 1])
+
+    def test_matches_groupby_implementation(self):
+        pivot = make_pivot()
+        for threshold in [0, 30, 70, 95, 100]:
+            region = pivot.loc[:, 5:25]
+            expected = (region >= np.percentile(region.values, threshold)).apply(reference_longest_streak, axis=1)
+            pd.testing.assert_series_equal(detect_longest_streak(pivot, 5, 25, threshold), expected, check_names=False)
+
+    def test_all_thresholds(self):
+        pivot = make_pivot(seed=3)
+        streaks = detect_longest_streaks_all_thresholds(pivot, 3, 27)
+        persistence = calculate_persistence_scores_all_thresholds(pivot, 3, 27)
+        self.assertEqual(streaks.shape, (12, 101))
+        for threshold in [0, 50, 70, 100]:
+            np.testing.assert_array_equal(streaks[threshold].values, detect_longest_streak(pivot, 3, 27, threshold).values)
+            np.testing.assert_allclose(persistence[threshold].values, calculate_persistence_score(pivot, 3, 27, threshold).values)
+
+    def test_empty_window(self):
+        pivot = make_pivot()
+        self.assertTrue((detect_longest_streak(pivot, 40, 50, 70) == 0).all())
+        self.assertTrue((detect_longest_streaks_all_thresholds(pivot, 40, 50).values == 0).all())
+
+class TestKEBins(unittest.TestCase):
+
+    def test_matches_window_means(self):
+        pivot = make_pivot(n_rows=40, n_frames=23, seed=5)
+        bins = compute_KE_bins(pivot, step_res=4, KE_prc_threshold=0.2)
+        self.assertEqual(sorted(bins['bin_frame_start'].unique()), [0, 4, 8, 12, 16])
+        for start, group in bins.groupby('bin_frame_start'):
+            means = calculate_absolute_persistence_score(pivot, start, start + 4)
+            expected = means.sort_values(ascending=False, kind='stable').index[:8]
+            self.assertEqual(group['top_index'].tolist(), expected.tolist())
+            self.assertTrue((group['bin_frame_mid'] == start + 2).all())
+
+    def test_keeps_at_least_one(self):
+        bins = compute_KE_bins(make_pivot(n_rows=5, n_frames=10), step_res=10, KE_prc_threshold=0.01)
+        self.assertEqual(len(bins), 1)
+
+class TestResidueCategory(unittest.TestCase):
+
+    def setUp(self):
+        self.pairs = pd.DataFrame({
+            'bin_frame_mid': [3, 3, 3, 8, 8, 8],
+            'residue_number_reference': [10.0, 20.0, 31.0, 5.0, np.nan, 7.0],
+            'residue_number_comparison': [20.0, 30.0, 50.0, 7.0, 5.0, np.nan],
+        })
+        self.expected_ref = ['reference only', 'common', 'neighbour', 'common', 'Unclassified', 'common']
+        self.expected_comp = ['common', 'neighbour', 'comparison only', 'common', 'common', 'Unclassified']
+
+    def test_categories(self):
+        result = add_residue_category(self.pairs.copy())
+        self.assertEqual(result['category_ref'].tolist(), self.expected_ref)
+        self.assertEqual(result['category_comp'].tolist(), self.expected_comp)
+
+    def test_sorted_lookup_fallback(self):
+        with patch.object(reorder_handler, 'MAX_MEMBERSHIP_CELLS', 1):
+            result = add_residue_category(self.pairs.copy())
+        self.assertEqual(result['category_ref'].tolist(), self.expected_ref)
+        self.assertEqual(result['category_comp'].tolist(), self.expected_comp)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+import numpy as np
+import pandas as pd
+from reorder_handler import compute_KE_bins
+from data_handler import normalize_per_frame
+from manifest_handler import refresh_manifest
+import similarity
+from similarity import top_k_bitsets, unpack_bitsets, bin_jaccard, compute_run_similarity, load_similarity, cluster_order
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b)
+
+_score_rows = similarity._score_rows
+
+def _score_rows_failing_on_first_row(similarity_path, rows):
+    # Worker stand-in: the block holding row 0 fails once later blocks have had time to finish
+    if 0 in rows:
+        time.sleep(1.0)
+        raise RuntimeError("interrupted")
+    return _score_rows(similarity_path, rows)
+
+class TestBitsets(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        index = pd.Index(np.arange(3, 103), name='residue_number')
+        self.pivots = [normalize_per_frame(pd.DataFrame(rng.gamma(2.0, 0.5, size=(100, 31)), index=index)) for _ in range(3)]
+        self.row_index = np.arange(1, 105)
+
+    def test_jaccard_matches_python_sets(self):
+        bins = [compute_KE_bins(pivot, 5, 0.1) for pivot in self.pivots]
+        bitsets = np.stack([top_k_bitsets(b, self.row_index) for b in bins])
+        scores = bin_jaccard(bitsets[0], bitsets[1:], 6, np.array([6, 4]))
+        for other in (1, 2):
+            for b, (start, group) in enumerate(bins[0].groupby('bin_frame_start')):
+                other_group = bins[other][bins[other]['bin_frame_start'] == start]
+                expected = _jaccard(set(group['top_index']), set(other_group['top_index']))
+                if other == 2 and b >= 4:
+                    self.assertTrue(np.isnan(scores[other - 1, b]))
+                else:
+                    self.assertAlmostEqual(scores[other - 1, b], expected, places=6)
+
+    def test_unpack_round_trip(self):
+        bins = compute_KE_bins(self.pivots[0], 5, 0.1)
+        membership = unpack_bitsets(top_k_bitsets(bins, self.row_index), len(self.row_index))
+        self.assertEqual(membership.shape, (6, len(self.row_index)))
+        self.assertEqual(set(self.row_index[membership[0]]), set(bins[bins['bin_frame_start'] == 0]['top_index']))
+
+    def test_cluster_order_groups_similar_runs(self):
+        similarity = np.array([
+            [1.0, 0.1, 0.9, 0.2],
+            [0.1, 1.0, 0.2, 0.8],
+            [0.9, 0.2, 1.0, 0.1],
+            [0.2, 0.8, 0.1, 1.0],
+        ])
+        order = list(cluster_order(similarity))
+        self.assertEqual(sorted(order), [0, 1, 2, 3])
+        self.assertEqual(abs(order.index(0) - order.index(2)), 1)
+        self.assertEqual(abs(order.index(1) - order.index(3)), 1)
+
+class TestSimilarityCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.base_path = os.path.join(self.tmpdir.name, "pivots")
+        self.cache_dir = os.path.join(self.tmpdir.name, "analysis_cache")
+        rng = np.random.default_rng(8)
+        index = pd.Index(np.arange(1, 41), name='residue_number')
+        self.pivots = {}
+        for category, run in [("effective", "0001"), ("neutral", "0002"), ("neutral", "0003"), ("effective", "0004")]:
+            self.pivots[f"{category}/{run}"] = pd.DataFrame(rng.gamma(2.0, 0.5, size=(40, 21)), index=index)
+        for key in list(self.pivots)[:3]:
+            self._write(key)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, key):
+        category, run = key.split("/")
+        os.makedirs(os.path.join(self.base_path, "residue", category), exist_ok=True)
+        self.pivots[key].to_pickle(os.path.join(self.base_path, "residue", category, f"data_pivot_{run}.pckl"))
+
+    def _expected_summary(self, a, b):
+        bins_a = compute_KE_bins(normalize_per_frame(self.pivots[a]), 5, 0.1)
+        bins_b = compute_KE_bins(normalize_per_frame(self.pivots[b]), 5, 0.1)
+        return np.mean([
+            _jaccard(set(group['top_index']), set(bins_b[bins_b['bin_frame_start'] == start]['top_index']))
+            for start, group in bins_a.groupby('bin_frame_start')
+        ])
+
+    def test_new_runs_are_scored_incrementally(self):
+        self.assertIsNone(load_similarity("residue", base_path=self.base_path, cache_dir=self.cache_dir))
+        similarity = compute_run_similarity("residue", base_path=self.base_path, cache_dir=self.cache_dir, workers=2)
+        self.assertEqual(similarity['runs'], ["effective/0001", "neutral/0002", "neutral/0003"])
+        self.assertAlmostEqual(similarity['summary'][0, 2], self._expected_summary("effective/0001", "neutral/0003"), places=6)
+        np.testing.assert_array_equal(np.diag(similarity['summary']), [1, 1, 1])
+
+        self._write("effective/0004")
+        refresh_manifest(self.base_path)
+        self.assertIsNone(load_similarity("residue", base_path=self.base_path, cache_dir=self.cache_dir))
+        similarity = compute_run_similarity("residue", base_path=self.base_path, cache_dir=self.cache_dir, workers=2)
+        self.assertEqual(similarity['runs'], ["effective/0001", "effective/0004", "neutral/0002", "neutral/0003"])
+        self.assertAlmostEqual(similarity['summary'][1, 3], self._expected_summary("effective/0004", "neutral/0003"), places=6)
+        self.assertAlmostEqual(similarity['summary'][0, 3], self._expected_summary("effective/0001", "neutral/0003"), places=6)
+        np.testing.assert_array_equal(similarity['summary'], similarity['summary'].T)
+
+    def test_resume_after_failed_block(self):
+        rng = np.random.default_rng(9)
+        index = pd.Index(np.arange(1, 41), name='residue_number')
+        for run in range(5, 15):
+            key = f"neutral/{run:04d}"
+            self.pivots[key] = pd.DataFrame(rng.gamma(2.0, 0.5, size=(40, 21)), index=index)
+            self._write(key)
+        with patch.object(similarity, '_score_rows', _score_rows_failing_on_first_row):
+            with self.assertRaises(RuntimeError):
+                compute_run_similarity("residue", base_path=self.base_path, cache_dir=self.cache_dir, workers=2)
+        self.assertIsNone(load_similarity("residue", base_path=self.base_path, cache_dir=self.cache_dir))
+
+        resumed = compute_run_similarity("residue", base_path=self.base_path, cache_dir=self.cache_dir, workers=2)
+        self.assertFalse(np.isnan(resumed['summary']).any())
+        fresh = compute_run_similarity("residue", base_path=self.base_path, cache_dir=os.path.join(self.tmpdir.name, "fresh_cache"), workers=2)
+        np.testing.assert_array_equal(resumed['summary'], fresh['summary'])
+
+    def test_bitsets_are_relaid_over_a_grown_row_index(self):
+        compute_run_similarity("residue", base_path=self.base_path, cache_dir=self.cache_dir, workers=2)
+        # A run with more rows than a 64 bit word: the carried bitsets get a new row layout and word count
+        self.pivots["effective/0004"] = pd.DataFrame(np.random.default_rng(10).gamma(2.0, 0.5, size=(70, 21)), index=pd.Index(np.arange(1, 71), name='residue_number'))
+        self._write("effective/0004")
+        refresh_manifest(self.base_path)
+        carried = compute_run_similarity("residue", base_path=self.base_path, cache_dir=self.cache_dir, workers=2)
+        fresh_cache = os.path.join(self.tmpdir.name, "fresh_cache")
+        fresh = compute_run_similarity("residue", base_path=self.base_path, cache_dir=fresh_cache, workers=2)
+        np.testing.assert_array_equal(carried['summary'], fresh['summary'])
+        np.testing.assert_array_equal(np.load(similarity.get_similarity_path("residue", 5, 0.1, self.cache_dir) / similarity.BITSETS_FILE), np.load(similarity.get_similarity_path("residue", 5, 0.1, fresh_cache) / similarity.BITSETS_FILE))
+
+    def test_scores_are_copied_and_summarized_in_blocks(self):
+        # One cell per block: scores are carried over to the added run's job and summarized a row at a time
+        with patch.object(similarity, 'JACCARD_BLOCK_CELLS', 1):
+            compute_run_similarity("residue", base_path=self.base_path, cache_dir=self.cache_dir, workers=2)
+            self._write("effective/0004")
+            refresh_manifest(self.base_path)
+            blocked = compute_run_similarity("residue", base_path=self.base_path, cache_dir=self.cache_dir, workers=2)
+        fresh = compute_run_similarity("residue", base_path=self.base_path, cache_dir=os.path.join(self.tmpdir.name, "fresh_cache"), workers=2)
+        self.assertIsInstance(blocked['jaccard'], np.memmap)
+        np.testing.assert_array_equal(blocked['summary'], fresh['summary'])
+        np.testing.assert_array_equal(np.asarray(blocked['jaccard']), np.asarray(fresh['jaccard']))
+
+if __name__ == '__main__':
+    unittest.main()
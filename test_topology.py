@@ -0,0 +1,45 @@
+import unittest
+import numpy as np
+import pandas as pd
+from topology import Topology, load_topology
+from reorder_handler import construct_KE_pairs
+
+class TestTopology(unittest.TestCase):
+
+    def setUp(self):
+        self.atom_table = pd.DataFrame({
+            'atom_number': [1, 2, 3, 4, 5],
+            'atom_name': ['N', 'CA', 'N', 'CA', 'N'],
+            'residue_number': [1, 1, 2, 2, 3],
+            'residue_three_letter': ['ALA', 'ALA', 'GLY', 'GLY', 'LYS'],
+            'residue_one_letter': ['A', 'A', 'G', 'G', 'K'],
+        })
+        self.topology = Topology(self.atom_table)
+
+    def test_annotation_matches_merge(self):
+        atom_numbers = np.array([3, 0, 5, 9, 1])
+        annotation = pd.DataFrame(self.topology.annotate_atoms(atom_numbers))
+        merged = pd.DataFrame({'index': atom_numbers}).merge(self.atom_table, how='left', left_on='index', right_on='atom_number').drop(columns=['index'])
+        pd.testing.assert_frame_equal(annotation, merged)
+
+        residues = pd.DataFrame(self.topology.annotate_residues([2, 3, 1]))
+        self.assertEqual(residues['residue_three_letter'].tolist(), ['GLY', 'LYS', 'ALA'])
+        self.assertEqual(self.topology.residue_of_atoms([4, 7]).tolist(), [2, -1])
+
+    def test_multi_model_pdb_table_uses_first_model(self):
+        topology = Topology(pd.concat([self.atom_table, self.atom_table.assign(atom_name='X')]))
+        self.assertEqual(topology.n_atoms, 5)
+        self.assertEqual(topology.annotate_atoms([2])['atom_name'].tolist(), ['CA'])
+
+    def test_KE_pairs_annotated_from_topology(self):
+        pivot = pd.DataFrame(np.arange(12, dtype=float).reshape(3, 4), index=pd.Index([1, 2, 3], name='residue'), columns=pd.Index(range(4), name='frame'))
+        pairs = construct_KE_pairs(pivot, pivot, 2, 0.3, 'residue', reference_topology=self.topology, comparison_topology=self.topology)
+        self.assertEqual(pairs['residue_number_reference'].tolist(), [3, 3])
+        self.assertEqual(pairs['residue_three_letter_comparison'].tolist(), ['LYS', 'LYS'])
+        self.assertNotIn('top_index', pairs.columns)
+
+    def test_default_topology_is_cached(self):
+        self.assertIs(load_topology(), load_topology())
+
+if __name__ == '__main__':
+    unittest.main()
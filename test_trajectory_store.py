@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from io import StringIO
+from Bio import PDB
+from trajectory_store import convert_trajectory, open_trajectory_store, has_current_trajectory_store, read_frame_block
+from molvis import generate_pdb_base64_frame, pdb_to_base64
+
+ATOM_LINES = [
+    "ATOM      1  N   ALA     1    {x:8.3f}  53.385  64.655  1.00  0.00           N",
+    "ATOM      2  CA  ALA     1      54.205{y:8.3f}  65.855  1.00  0.00           C",
+    "ATOM      3  C   ALA     1      53.665  51.585{z:8.3f}  1.00  0.00           C",
+]
+
+def _coordinates(pdb_text):
+    structure = PDB.PDBParser(QUIET=True).get_structure("molecule", StringIO(pdb_text))
+    return np.array([atom.coord for atom in structure[0].get_atoms()])
+
+class TestTrajectoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "traj_0001.pdb")
+        with open(self.path, 'w') as f:
+            f.write("REMARK    GENERATED BY TRJCONV\n")
+            for model in range(4):
+                values = {'x': 54.975 + model, 'y': -100.125 - model, 'z': 66.5 * model}
+                f.write(f"MODEL {model + 1:8d}\n" + "\n".join(line.format(**values) for line in ATOM_LINES) + "\nTER\nENDMDL\n")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_frames_match_the_trajectory(self):
+        self.assertIsNone(open_trajectory_store(self.path))
+        convert_trajectory(self.path)
+        self.assertTrue(has_current_trajectory_store(self.path))
+        store = open_trajectory_store(self.path)
+        self.assertEqual((store.n_frames, store.n_atoms), (4, 3))
+        for frame in range(4):
+            expected = _coordinates(read_frame_block(self.path, frame))
+            np.testing.assert_array_equal(_coordinates(store.frame_pdb(frame)), expected)
+            np.testing.assert_allclose(store.frame_center(frame), expected.mean(axis=0), rtol=1e-6)
+        # Frames beyond the trajectory fall back to the first model
+        self.assertEqual(store.frame_pdb(10), store.frame_pdb(0))
+
+    def test_molvis_serves_converted_frames(self):
+        convert_trajectory(self.path)
+        pdb_base64, center = generate_pdb_base64_frame(self.path, 2)
+        self.assertEqual(pdb_base64, pdb_to_base64(open_trajectory_store(self.path).frame_pdb(2)))
+        self.assertAlmostEqual(center[0], np.mean([56.975, 54.205, 53.665]), places=4)
+
+    def test_store_goes_stale_with_the_trajectory(self):
+        self.assertIsNotNone(convert_trajectory(self.path))
+        self.assertIsNone(convert_trajectory(self.path))
+        with open(self.path, 'a') as f:
+            f.write("REMARK    APPENDED\n")
+        self.assertFalse(has_current_trajectory_store(self.path))
+        self.assertIsNone(open_trajectory_store(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
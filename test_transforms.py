@@ -0,0 +1,36 @@
+import unittest
+import numpy as np
+import pandas as pd
+from data_handler import normalize_per_frame
+from transforms import apply_transform_chain, apply_stage, as_chain, chain_name
+
+class TestTransforms(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        values = rng.random((5, 8)) * 4
+        values[0, 0] = 0.0
+        self.pivot = pd.DataFrame(values, index=pd.Index(range(1, 6), name='residue'), columns=pd.Index(range(8), name='frame'))
+
+    def test_named_chains_match_former_views(self):
+        pd.testing.assert_frame_equal(apply_transform_chain(self.pivot, 'per_frame'), normalize_per_frame(self.pivot))
+        expected_log = self.pivot.apply(lambda column: column.map(lambda x: np.log10(x) if x > 0 else 0))
+        pd.testing.assert_frame_equal(apply_transform_chain(self.pivot, 'log10'), expected_log)
+        self.assertIs(apply_transform_chain(self.pivot, 'raw'), self.pivot)
+
+    def test_band_map_matches_cell_by_cell_rule(self):
+        low, high, fill = 1.0, 2.5, 1.75
+        expected = self.pivot.apply(lambda column: column.map(lambda x: fill if low < x < high else x))
+        pd.testing.assert_frame_equal(apply_stage(self.pivot, ('band_map', low, high, fill)), expected)
+
+    def test_chains(self):
+        self.assertEqual(as_chain('per_frame_log10'), (('normalize',), ('log',)))
+        self.assertEqual(chain_name((('normalize',), ('log',))), 'per_frame_log10')
+        self.assertIsNone(chain_name((('clamp', 0, 1),)))
+        clamped = apply_transform_chain(self.pivot, [('clamp', 1, 2)])
+        self.assertTrue(((clamped.values >= 1) & (clamped.values <= 2)).all())
+        with self.assertRaises(ValueError):
+            as_chain([('unknown',)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# topology.py: Array-backed atom/residue topology lookups for annotating KE results
+import os
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from functools import lru_cache
+from convert_pdb import parse_pdb_to_dataframe
+
+DEFAULT_TOPOLOGY_PATH = "aa_map.csv"
+# Per run topologies: topologies/<category>/<run>.pdb (or .csv in the aa_map.csv format)
+TOPOLOGY_DIR = "topologies"
+
+def _lookup_values(values, valid):
+    # Missing entries become NaN like a left merge would leave them; fully matched integer columns stay integers
+    if valid.all():
+        return values
+    if values.dtype == object:
+        return np.where(valid, values, np.nan)
+    return np.where(valid, values, np.nan).astype(np.float64)
+
+class Topology:
+    """
+    Dense lookup arrays built once from an atom table (the output of convert_pdb.parse_pdb_to_dataframe, or aa_map.csv):
+    atom number -> atom name, residue number, residue names, and residue number -> residue names.
+    Annotating indices is then fancy indexing instead of DataFrame merges.
+    """
+
+    def __init__(self, atom_table):
+        # Multi-model PDBs repeat every atom once per model: the first model defines the topology
+        atom_table = atom_table.drop_duplicates(subset='atom_number', keep='first')
+        atom_numbers = atom_table['atom_number'].to_numpy(dtype=np.int64)
+        residue_numbers = atom_table['residue_number'].to_numpy(dtype=np.int64)
+        if len(atom_numbers) and (atom_numbers.min() < 0 or residue_numbers.min() < 0):
+            raise ValueError("Atom and residue numbers of a topology must not be negative.")
+
+        n_atom_slots = int(atom_numbers.max()) + 1 if len(atom_numbers) else 1
+        self.atom_valid = np.zeros(n_atom_slots, dtype=bool)
+        self.atom_valid[atom_numbers] = True
+        self.atom_residue_number = np.zeros(n_atom_slots, dtype=np.int64)
+        self.atom_residue_number[atom_numbers] = residue_numbers
+        self.atom_name = np.empty(n_atom_slots, dtype=object)
+        self.atom_name[atom_numbers] = atom_table['atom_name'].to_numpy(dtype=object)
+        self.atom_residue_three_letter = np.empty(n_atom_slots, dtype=object)
+        self.atom_residue_three_letter[atom_numbers] = atom_table['residue_three_letter'].to_numpy(dtype=object)
+        self.atom_residue_one_letter = np.empty(n_atom_slots, dtype=object)
+        self.atom_residue_one_letter[atom_numbers] = atom_table['residue_one_letter'].to_numpy(dtype=object)
+
+        # The first atom of each residue names it
+        residues = atom_table.drop_duplicates(subset='residue_number', keep='first')
+        residue_numbers = residues['residue_number'].to_numpy(dtype=np.int64)
+        n_residue_slots = int(residue_numbers.max()) + 1 if len(residue_numbers) else 1
+        self.residue_valid = np.zeros(n_residue_slots, dtype=bool)
+        self.residue_valid[residue_numbers] = True
+        self.residue_three_letter = np.empty(n_residue_slots, dtype=object)
+        self.residue_three_letter[residue_numbers] = residues['residue_three_letter'].to_numpy(dtype=object)
+        self.residue_one_letter = np.empty(n_residue_slots, dtype=object)
+        self.residue_one_letter[residue_numbers] = residues['residue_one_letter'].to_numpy(dtype=object)
+
+        self.n_atoms = len(atom_numbers)
+        self.n_residues = len(residue_numbers)
+
+    def _slots(self, indices, valid_table):
+        indices = np.asarray(indices)
+        numeric = pd.to_numeric(pd.Series(indices), errors='coerce').to_numpy(dtype=np.float64)
+        in_range = ~np.isnan(numeric) & (numeric >= 0) & (numeric < len(valid_table))
+        slots = np.where(in_range, numeric, 0).astype(np.int64)
+        return slots, in_range & valid_table[slots]
+
+    def annotate_atoms(self, atom_numbers):
+        """
+        Looks up atom numbers.
+
+        :return: A dict of arrays: atom_number, atom_name, residue_number, residue_three_letter, residue_one_letter
+            (NaN where an atom number is not in the topology).
+        """
+        slots, valid = self._slots(atom_numbers, self.atom_valid)
+        return {
+            'atom_number': _lookup_values(slots, valid),
+            'atom_name': _lookup_values(self.atom_name[slots], valid),
+            'residue_number': _lookup_values(self.atom_residue_number[slots], valid),
+            'residue_three_letter': _lookup_values(self.atom_residue_three_letter[slots], valid),
+            'residue_one_letter': _lookup_values(self.atom_residue_one_letter[slots], valid),
+        }
+
+    def annotate_residues(self, residue_numbers):
+        """
+        Looks up residue numbers.
+
+        :return: A dict of arrays: residue_number, residue_three_letter, residue_one_letter
+            (NaN where a residue number is not in the topology).
+        """
+        slots, valid = self._slots(residue_numbers, self.residue_valid)
+        return {
+            'residue_number': _lookup_values(slots, valid),
+            'residue_three_letter': _lookup_values(self.residue_three_letter[slots], valid),
+            'residue_one_letter': _lookup_values(self.residue_one_letter[slots], valid),
+        }
+
+    def residue_of_atoms(self, atom_numbers):
+        """Residue number of each atom number, -1 where the atom is not in the topology."""
+        slots, valid = self._slots(atom_numbers, self.atom_valid)
+        return np.where(valid, self.atom_residue_number[slots], -1)
+
+@lru_cache(maxsize=32)
+def _load_topology(path, mtime_ns):
+    # mtime_ns only keys the cache, so an edited topology file is read again
+    if Path(path).suffix.lower() == ".csv":
+        atom_table = pd.read_csv(path)
+    else:
+        atom_table = parse_pdb_to_dataframe(path)
+    return Topology(atom_table)
+
+def load_topology(path=DEFAULT_TOPOLOGY_PATH):
+    """
+    Builds (once per file version) the topology of an aa_map style CSV or a PDB file.
+    """
+    return _load_topology(str(path), os.stat(path).st_mtime_ns)
+
+def get_run_topology(run_num, category):
+    """
+    Returns the topology of a run: topologies/<category>/<run>.pdb or .csv when present, otherwise the default
+    aa_map.csv (calmodulin).
+    """
+    for suffix in (".pdb", ".csv"):
+        path = Path(TOPOLOGY_DIR) / category / f"{run_num}{suffix}"
+        if path.exists():
+            return load_topology(path)
+    return load_topology(DEFAULT_TOPOLOGY_PATH)
@@ -0,0 +1,235 @@
+# trajectory_store.py: Frame index and binary coordinate store for multi-model trajectory PDBs
+import os
+import re
+import json
+import mmap
+import argparse
+import numpy as np
+from pathlib import Path
+from functools import lru_cache
+
+# Byte offsets of the MODEL blocks of a trajectory, stored next to it as <trajectory>.frames.json
+FRAME_INDEX_SUFFIX = ".frames.json"
+_MODEL_RECORD = re.compile(rb"^MODEL ", re.MULTILINE)
+_ENDMDL_RECORD = re.compile(rb"^ENDMDL[^\n]*\n?", re.MULTILINE)
+
+# Coordinate store next to the trajectory: traj_<run>.pdb -> traj_<run>.coords/
+STORE_SUFFIX = ".coords"
+TEMPLATE_FILE = "template.pdb"
+COORDS_FILE = "coords.npy"
+CENTERS_FILE = "centers.npy"
+META_FILE = "meta.json"
+
+_COORDINATE_RECORDS = ("ATOM  ", "HETATM")
+# Columns 31-54 of ATOM/HETATM records hold x, y, z as %8.3f
+_COORDINATE_SLICE = slice(30, 54)
+
+def build_frame_index(pdb_file_path):
+    """
+    Scans a (multi-model) PDB file once for its MODEL/ENDMDL records.
+
+    :return: A list of [start, stop) byte offsets, one per model in file order. A file without MODEL records is
+        a single frame spanning the whole file.
+    """
+    with open(pdb_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        starts = [match.start() for match in _MODEL_RECORD.finditer(data)]
+        if not starts:
+            return [[0, len(data)]]
+        stops = []
+        for i, start in enumerate(starts):
+            limit = starts[i + 1] if i + 1 < len(starts) else len(data)
+            end_record = _ENDMDL_RECORD.search(data, start, limit)
+            stops.append(end_record.end() if end_record else limit)
+    return [[start, stop] for start, stop in zip(starts, stops)]
+
+def load_frame_index(pdb_file_path):
+    """
+    Returns the frame index of a trajectory, reading it from <trajectory>.frames.json when it matches the file's
+    size and modification time, otherwise building it and saving it there for the next time.
+    """
+    pdb_file_path = str(pdb_file_path)
+    stat = os.stat(pdb_file_path)
+    index_path = pdb_file_path + FRAME_INDEX_SUFFIX
+    try:
+        with open(index_path) as f:
+            saved = json.load(f)
+        if saved['source_size'] == stat.st_size and saved['source_mtime_ns'] == stat.st_mtime_ns:
+            return saved['models']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    models = build_frame_index(pdb_file_path)
+    try:
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns, 'models': models}, f)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        # A read-only trajectory directory only costs a rescan next time
+        print(f"Could not save the frame index of {pdb_file_path}: {e}")
+    return models
+
+def read_frame_block(pdb_file_path, frame_number=0):
+    """
+    Reads the PDB text of one MODEL by seeking to it through the frame index. Frames beyond the trajectory fall
+    back to the first model.
+    """
+    models = load_frame_index(pdb_file_path)
+    if not 0 <= frame_number < len(models):
+        frame_number = 0
+    start, stop = models[frame_number]
+    with open(pdb_file_path, 'rb') as f:
+        f.seek(start)
+        return f.read(stop - start).decode('utf-8')
+
+def get_trajectory_store_path(pdb_file_path):
+    return Path(pdb_file_path).with_suffix(STORE_SUFFIX)
+
+def _source_signature(pdb_file_path):
+    stat = os.stat(pdb_file_path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def has_current_trajectory_store(pdb_file_path):
+    """A store is current when its meta.json (written last) records the trajectory's present size and mtime."""
+    meta_path = get_trajectory_store_path(pdb_file_path) / META_FILE
+    try:
+        meta = json.loads(meta_path.read_text())
+    except (OSError, ValueError):
+        return False
+    return [meta.get('source_mtime_ns'), meta.get('source_size')] == _source_signature(pdb_file_path)
+
+def _block_coordinates(block):
+    # Fixed-width parse: the coordinate columns of all atom records, viewed as an (atoms x 3) array of 8 byte fields
+    fields = [line[_COORDINATE_SLICE] for line in block.splitlines() if line.startswith(_COORDINATE_RECORDS)]
+    return np.array(fields, dtype='S24').view('S8').reshape(-1, 3).astype(np.float32)
+
+def _template_lines(block):
+    # The model without its MODEL/ENDMDL records, written as a single-model PDB
+    lines = [line for line in block.splitlines() if not line.startswith(("MODEL", "ENDMDL"))]
+    if not lines or lines[-1].strip() != "END":
+        lines.append("END")
+    return lines
+
+def convert_trajectory(pdb_file_path, overwrite=False):
+    """
+    Stores a trajectory once as its first model (the topology template) plus a float32 frames x atoms x 3
+    coordinate array and the geometric center of every frame.
+
+    Args:
+        pdb_file_path (str or Path): The trajectory, e.g. trajectories/pdb/<category>/traj_<run>.pdb.
+        overwrite (bool): Rewrite a store that is already current.
+
+    Returns:
+        Path: The store directory, or None if it was already current and overwrite is False.
+    """
+    store_path = get_trajectory_store_path(pdb_file_path)
+    if has_current_trajectory_store(pdb_file_path) and not overwrite:
+        return None
+    # Taken before reading: a trajectory replaced mid-conversion then reads as stale instead of current
+    signature = _source_signature(pdb_file_path)
+    models = load_frame_index(pdb_file_path)
+    store_path.mkdir(parents=True, exist_ok=True)
+    (store_path / META_FILE).unlink(missing_ok=True)
+
+    with open(pdb_file_path, 'rb') as f:
+        def read_block(start, stop):
+            f.seek(start)
+            return f.read(stop - start).decode('utf-8')
+
+        first_block = read_block(*models[0])
+        n_atoms = len(_block_coordinates(first_block))
+        (store_path / TEMPLATE_FILE).write_text("\n".join(_template_lines(first_block)) + "\n")
+
+        # Written frame by frame into the memory map, so memory stays at one frame whatever the trajectory length
+        tmp_coords = store_path / (COORDS_FILE + ".tmp")
+        coords = np.lib.format.open_memmap(tmp_coords, mode='w+', dtype=np.float32, shape=(len(models), n_atoms, 3))
+        for frame, (start, stop) in enumerate(models):
+            frame_coords = _block_coordinates(read_block(start, stop))
+            if len(frame_coords) != n_atoms:
+                raise ValueError(f"Model {frame} of {pdb_file_path} has {len(frame_coords)} atoms, the first model has {n_atoms}.")
+            coords[frame] = frame_coords
+        coords.flush()
+        centers = coords.mean(axis=1, dtype=np.float64)
+        del coords
+    os.replace(tmp_coords, store_path / COORDS_FILE)
+    tmp_centers = store_path / (CENTERS_FILE + ".tmp")
+    with open(tmp_centers, 'wb') as file:
+        np.save(file, centers, allow_pickle=False)
+    os.replace(tmp_centers, store_path / CENTERS_FILE)
+
+    tmp_meta = store_path / (META_FILE + ".tmp")
+    tmp_meta.write_text(json.dumps({'source_mtime_ns': signature[0], 'source_size': signature[1], 'n_frames': len(models), 'n_atoms': n_atoms}))
+    os.replace(tmp_meta, store_path / META_FILE)
+    return store_path
+
+class TrajectoryStore:
+    """
+    An opened coordinate store: memory-mapped coordinates, per-frame geometric centers, and the template turned
+    into one format string so writing a frame is a single string formatting of its coordinates.
+    """
+
+    def __init__(self, store_path):
+        store_path = Path(store_path)
+        self.coords = np.load(store_path / COORDS_FILE, mmap_mode='r')
+        self.centers = np.load(store_path / CENTERS_FILE)
+        self.n_frames, self.n_atoms = self.coords.shape[:2]
+
+        template_lines = []
+        for line in (store_path / TEMPLATE_FILE).read_text().splitlines():
+            if line.startswith(_COORDINATE_RECORDS):
+                template_lines.append(line[:30].replace('%', '%%') + '%8.3f%8.3f%8.3f' + line[54:].replace('%', '%%'))
+            else:
+                template_lines.append(line.replace('%', '%%'))
+        self._template = "\n".join(template_lines) + "\n"
+
+    def _frame(self, frame_number):
+        # Frames beyond the trajectory fall back to the first model, as the PDB reader does
+        return frame_number if 0 <= frame_number < self.n_frames else 0
+
+    def frame_pdb(self, frame_number):
+        """PDB text of one frame: the template with that frame's coordinates filled in."""
+        return self._template % tuple(self.coords[self._frame(frame_number)].ravel().tolist())
+
+    def frame_center(self, frame_number):
+        """Geometric center of one frame."""
+        return self.centers[self._frame(frame_number)]
+
+@lru_cache(maxsize=32)
+def _open_trajectory_store(store_path, meta_mtime_ns):
+    # meta_mtime_ns only keys the cache, so a reconverted store is opened again
+    return TrajectoryStore(store_path)
+
+def open_trajectory_store(pdb_file_path):
+    """
+    Returns the opened coordinate store of a trajectory, or None when it has none or it is older than the trajectory.
+    """
+    if not has_current_trajectory_store(pdb_file_path):
+        return None
+    store_path = get_trajectory_store_path(pdb_file_path)
+    return _open_trajectory_store(str(store_path), os.stat(store_path / META_FILE).st_mtime_ns)
+
+def convert_all_trajectories(base_path="trajectories/pdb", overwrite=False):
+    """
+    Converts every trajectory found under base_path/<category>/traj_<run>.pdb.
+    Returns the list of store directories that were written.
+    """
+    converted = []
+    for pdb_file_path in sorted(Path(base_path).glob("*/traj_*.pdb")):
+        try:
+            store_path = convert_trajectory(pdb_file_path, overwrite=overwrite)
+        except ValueError as e:
+            print(f"Error converting {pdb_file_path}: {e}")
+            continue
+        if store_path is not None:
+            print(f"Converted {pdb_file_path} -> {store_path}")
+            converted.append(store_path)
+    return converted
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert trajectory PDBs into binary coordinate stores.")
+    parser.add_argument("--base-path", default="trajectories/pdb", help="Root of the trajectory directory tree.")
+    parser.add_argument("--overwrite", action="store_true", help="Rewrite stores that are already current.")
+    args = parser.parse_args()
+
+    converted = convert_all_trajectories(args.base_path, overwrite=args.overwrite)
+    print(f"Converted {len(converted)} trajectory(ies).")
@@ -0,0 +1,84 @@
+# transforms.py: Composable, vectorized value transforms for the KE pivot views
+import numpy as np
+import pandas as pd
+
+# A transform chain is a tuple of stages, applied left to right. Each stage is a tuple of its name followed by its
+# parameters, so chains are hashable and can key the shared cache, e.g. (('normalize',), ('log',)).
+# Every stage works on a whole rows x frames array at once and is either elementwise or row-wise, so a chain
+# commutes with reordering the rows.
+
+def normalize_values(values):
+    """Per frame distribution: each row as a percentage of its total over the frames (as normalize_per_frame)."""
+    row_sums = np.nansum(values, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return values / row_sums * 100
+
+def log_values(values):
+    """Logarithmic KE: log10 of positive values, 0 elsewhere."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(values > 0, np.log10(values), 0.0)
+
+def clamp_values(values, vmin, vmax):
+    """Clips values into [vmin, vmax]."""
+    return np.clip(values, vmin, vmax)
+
+def band_map_values(values, gap_min, gap_max, fill_value):
+    """Replaces values strictly between two colour bands (gap_min < x < gap_max) with fill_value."""
+    return np.where((values > gap_min) & (values < gap_max), fill_value, values)
+
+STAGES = {
+    'normalize': normalize_values,
+    'log': log_values,
+    'clamp': clamp_values,
+    'band_map': band_map_values,
+}
+
+# Names the sidebar and the precomputed artifacts use for the common chains
+NAMED_CHAINS = {
+    'raw': (),
+    'per_frame': (('normalize',),),
+    'log10': (('log',),),
+    'per_frame_log10': (('normalize',), ('log',)),
+}
+
+def as_chain(transform):
+    """
+    Turns a transform given by name (see NAMED_CHAINS) or as a chain into a validated chain tuple.
+    """
+    if isinstance(transform, str):
+        if transform not in NAMED_CHAINS:
+            raise ValueError(f"Unknown dataset transform: {transform}")
+        return NAMED_CHAINS[transform]
+    chain = tuple(tuple(stage) for stage in transform)
+    for stage in chain:
+        if not stage or stage[0] not in STAGES:
+            raise ValueError(f"Unknown transform stage: {stage}")
+    return chain
+
+def chain_name(chain):
+    """Returns the name of a chain if it has one (these are the chains precompute.py writes), otherwise None."""
+    for name, named_chain in NAMED_CHAINS.items():
+        if named_chain == chain:
+            return name
+    return None
+
+def apply_stage(pivot, stage):
+    """Applies a single stage to a pivot table and returns a new DataFrame with the same labels."""
+    name, *params = stage
+    values = STAGES[name](pivot.to_numpy(dtype=np.float64), *params)
+    return pd.DataFrame(values, index=pivot.index, columns=pivot.columns)
+
+def apply_transform_chain(pivot, transform):
+    """
+    Applies a transform chain (or a named transform) to a pivot table.
+
+    Args:
+        pivot (pd.DataFrame): The pivot table (residues/atoms x frames).
+        transform (str or tuple): A name from NAMED_CHAINS or a chain of stages.
+
+    Returns:
+        pd.DataFrame: The transformed pivot, or the input itself for the empty chain.
+    """
+    for stage in as_chain(transform):
+        pivot = apply_stage(pivot, stage)
+    return pivot
@@ -5,6 +5,40 @@ from plotly.subplots import make_subplots
 import streamlit as st
 import numpy as np
 import pandas as pd
+from transforms import band_map_values
+from heatmap_lod import reduce_heatmap, window_from_box
+from instrumentation import timed, record_payload, plotly_payload_bytes
+
+HEATMAP_CHART_KEY = "heatmaps"
+
+def _plotly_chart(fig, name, container=st, **kwargs):
+    # Every chart is timed as a span of the current rerun, with the size of the figure sent to the browser
+    with timed(f"chart {name}"):
+        record_payload('plotly_chart', name, plotly_payload_bytes(fig))
+        return container.plotly_chart(fig, **kwargs)
+
+def _update_heatmap_window(shape):
+    """
+    Keeps the zoom window of the heatmaps in st.session_state['heatmap_window']: a new box selection on the chart
+    narrows it, and it resets when the shape of the data changes (other dataset or resolution).
+    """
+    window = st.session_state.get('heatmap_window')
+    if window is None or window['shape'] != shape:
+        window = st.session_state['heatmap_window'] = {'shape': shape, 'rows': None, 'cols': None}
+
+    # The chart's selection state is read before the chart is drawn, so a new box is shown refined in the same run
+    chart_state = st.session_state.get(HEATMAP_CHART_KEY)
+    boxes = chart_state['selection'].get('box', []) if chart_state and 'selection' in chart_state else []
+    if boxes:
+        box = boxes[-1]
+        box_signature = (tuple(box.get('x', ())), tuple(box.get('y', ())))
+        if box_signature != st.session_state.get('heatmap_applied_box') and box.get('x') and box.get('y'):
+            st.session_state['heatmap_applied_box'] = box_signature
+            rows = window_from_box(box['y'], shape[0])
+            cols = window_from_box(box['x'], shape[1])
+            if rows is not None and cols is not None:
+                window['rows'], window['cols'] = rows, cols
+    return window
 
 # Function to render synchronized heatmaps using Plotly subplots
 def render_heatmaps(reference_data, comparison_data):
@@ -12,6 +46,7 @@ def render_heatmaps(reference_data, comparison_data):
     fig = make_subplots(rows=1, cols=2, subplot_titles=("Reference Run Heatmap", "Comparison Run Heatmap"))
     
     colorscale = 'jet'
+    band_map = None
     # Get active range values for controlling colorscale, if defined
     if 'active_ranges' in st.session_state and len(st.session_state['active_ranges']) > 0:
         ranges = st.session_state['active_ranges']
@@ -20,29 +55,42 @@ def render_heatmaps(reference_data, comparison_data):
         # Handle two ranges scenario by setting values between ranges to the midpoint
         if len(ranges) > 1:
             mid_value = (cmin + cmax) / 2
-            reference_data = reference_data.applymap(lambda x: mid_value if ranges[0]['max'] < x < ranges[1]['min'] else x)
-            comparison_data = comparison_data.applymap(lambda x: mid_value if ranges[0]['max'] < x < ranges[1]['min'] else x)
+            band_map = (ranges[0]['max'], ranges[1]['min'], mid_value)
     else:
         ranges = []
         cmin = reference_data.min().min()
         cmax = reference_data.max().max()
 
-    # Extract y-axis labels from reference_data index
-    y_labels = list(reference_data.index)
-    y_values = list(range(len(y_labels)))
+    # Level of detail: only the zoom window is sent, pooled down to at most DEFAULT_MAX_ROWS x DEFAULT_MAX_COLS cells
+    window = _update_heatmap_window(reference_data.shape)
+    pooling_col, reset_col = st.columns([3, 1])
+    with pooling_col:
+        pooling = st.radio("Heatmap Pooling", ["Max", "Mean"], horizontal=True, key="heatmap_pooling", help='How residues/atoms and frames are combined when there are more of them than the heatmap has pixels.')
+    with reset_col:
+        if st.button("Reset Heatmap Zoom", key="reset_heatmap_zoom", disabled=window['rows'] is None):
+            window['rows'] = window['cols'] = None
+    window_transform = (lambda values: band_map_values(values, *band_map)) if band_map is not None else None
+    reference_z, row_centers, col_centers, row_starts = reduce_heatmap(reference_data.values, window['rows'], window['cols'], method=pooling.lower(), window_transform=window_transform)
+    comparison_z, _, _, _ = reduce_heatmap(comparison_data.values, window['rows'], window['cols'], method=pooling.lower(), window_transform=window_transform)
+
+    # Extract y-axis labels from reference_data index (the first residue/atom of every pooled block)
+    y_labels = list(reference_data.index[row_starts])
+    y_values = list(row_centers)
 
     # Create heatmaps for reference and comparison with explicitly set y-axis labels
     trace1 = go.Heatmap(
-        z=reference_data.values,  # Use .values to avoid passing index
-        y=y_values if st.session_state['reordering_option'] != "Original Order" else None,  # Numeric values corresponding to each row
+        z=reference_z,
+        x=col_centers,
+        y=y_values,  # Row positions in the full data, so zoomed views keep the overview's coordinates
         colorscale=colorscale,
         showscale=True,
         zmin=cmin,
         zmax=cmax
     )
     trace2 = go.Heatmap(
-        z=comparison_data.values,  # Use .values to avoid passing index
-        y=y_values if st.session_state['reordering_option'] != "Original Order" else None,  # Numeric values corresponding to each row
+        z=comparison_z,
+        x=col_centers,
+        y=y_values,
         colorscale=colorscale,
         showscale=False,
         zmin=cmin,
@@ -61,6 +109,8 @@ def render_heatmaps(reference_data, comparison_data):
         yaxis2=dict(matches='y1', tickvals=y_values, ticktext=y_labels) if st.session_state['reordering_option'] != "Original Order" else dict(matches='y1'),
         # yaxis2=dict(matches='y1'),
         title_text="Synchronized Heatmaps for Reference and Comparison Runs",
+        # Box selection refines the view: the selected window is sent again at full available detail
+        dragmode='select',
         # coloraxis_colorbar=dict(
         #     title="Value Range",
         #     tickvals=[r['min'] for r in ranges] + [r['max'] for r in ranges],
@@ -69,19 +119,22 @@ def render_heatmaps(reference_data, comparison_data):
     )
 
     # Display the figure in Streamlit
-    st.plotly_chart(fig, use_container_width=True)
+    _plotly_chart(fig, "heatmaps", use_container_width=True, on_select='rerun', selection_mode='box', key=HEATMAP_CHART_KEY)
+    n_rows = (window['rows'][1] - window['rows'][0]) if window['rows'] else reference_data.shape[0]
+    n_cols = (window['cols'][1] - window['cols'][0]) if window['cols'] else reference_data.shape[1]
+    st.caption(f"Showing {n_rows} x {n_cols} cells as {reference_z.shape[0]} x {reference_z.shape[1]} ({pooling.lower()} pooled). Drag a box to zoom in.")
 
 # Function to plot histogram using Plotly
 
-def plot_histogram(reference_data, comparison_data, value_type, bin_number, plot_range_min, plot_range_max, key):
+def plot_histogram(reference_histogram, comparison_histogram, value_type, plot_range_min, plot_range_max, key):
     """
-    Plots histograms of the provided reference and comparison datasets using Plotly.
+    Plots histograms of the reference and comparison datasets as bars from counts binned on the server
+    (see histogram.rebin_histogram and pivot_cache.get_cached_histogram).
 
     Args:
-        reference_data (pd.DataFrame): The reference dataset.
-        comparison_data (pd.DataFrame): The comparison dataset.
+        reference_histogram (tuple): (counts, edges) of the reference dataset.
+        comparison_histogram (tuple): (counts, edges) of the comparison dataset.
         value_type (str): Either 'Absolute Values' or 'Per Frame Distribution'.
-        bin_number (int): The number of bins for the histogram.
         plot_range_min (float): The minimum value for the plot range.
         plot_range_max (float): The maximum value for the plot range.
 
@@ -93,18 +146,10 @@ def plot_histogram(reference_data, comparison_data, value_type, bin_number, plot
     else:
         x_label = 'Kinetic Energy Values'
     
-    # Flatten the data for histogram plotting
-    reference_values = reference_data.values.flatten()
-    comparison_values = comparison_data.values.flatten()
-    
-    # Filter values based on plot range
-    reference_values = reference_values[(reference_values >= plot_range_min) & (reference_values <= plot_range_max)]
-    comparison_values = comparison_values[(comparison_values >= plot_range_min) & (comparison_values <= plot_range_max)]
-    
-    # Create the histogram plot
+    # Create the histogram plot: one bar per bin, only the counts are sent to the browser
     fig = go.Figure()
-    fig.add_trace(go.Histogram(x=reference_values, nbinsx=bin_number, name='Reference Run', opacity=0.5))
-    fig.add_trace(go.Histogram(x=comparison_values, nbinsx=bin_number, name='Comparison Run', opacity=0.5))
+    for (counts, edges), name in [(reference_histogram, 'Reference Run'), (comparison_histogram, 'Comparison Run')]:
+        fig.add_trace(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, width=np.diff(edges), name=name, opacity=0.5))
     
     # Update layout
     fig.update_layout(
@@ -132,7 +177,34 @@ def plot_histogram(reference_data, comparison_data, value_type, bin_number, plot
                 bgcolor='rgba(0, 100, 255, 0.3)' if idx == 0 else 'rgba(0, 255, 100, 0.3)'
             )
 
-    st.plotly_chart(fig, use_container_width=True, key=key)
+    _plotly_chart(fig, "histogram", use_container_width=True, key=key)
+    return fig
+
+def plot_threshold_sensitivity(threshold_table, rows, threshold, reordering_option, container=st.sidebar):
+    """
+    Plots the persistence (or longest streak) of the selected residues/atoms against the percentile threshold,
+    with the current threshold marked.
+
+    Args:
+        threshold_table (pd.DataFrame): Scores for every threshold, residues x thresholds (see pivot_cache.get_cached_threshold_table).
+        rows (list): The residues/atoms to draw.
+        threshold (int): The selected threshold percentile.
+        reordering_option (str): 'Reordered by Persistence' or 'Reordered by Streak Length'.
+    """
+    y_label = 'Persistence Score' if reordering_option == "Reordered by Persistence" else 'Longest Streak (frames)'
+    fig = go.Figure()
+    thresholds = threshold_table.columns.to_numpy()
+    for row in rows:
+        fig.add_trace(go.Scatter(x=thresholds, y=threshold_table.loc[row].to_numpy(), mode='lines', name=str(row)))
+    fig.add_vline(x=threshold, line_dash='dash', line_color='grey')
+    fig.update_layout(
+        xaxis_title='Threshold Percentile',
+        yaxis_title=y_label,
+        height=300,
+        margin=dict(l=10, r=10, t=30, b=10),
+        legend=dict(orientation='h', y=-0.3),
+    )
+    _plotly_chart(fig, "threshold sensitivity", container=container, use_container_width=True)
     return fig
 
 def plot_aa_distribution_by_frame_mid(result_df, n_percent):
@@ -176,7 +248,7 @@ def plot_aa_distribution_by_frame_mid(result_df, n_percent):
         hover_data={"percent": ":.2f"}
     )
 
-    event_data = st.plotly_chart(fig, use_container_width=True, on_select='rerun')
+    event_data = _plotly_chart(fig, "residue types by bin", use_container_width=True, on_select='rerun')
     # st.write(event_data)
     
     # Return the bin_frame_mid of the clicked bar if any bar was clicked
@@ -223,7 +295,7 @@ def plot_residue_category_distribution(result_df):
     )
 
     # Plot the chart in Streamlit and add click event functionality
-    event_data = st.plotly_chart(fig, use_container_width=True, on_select='rerun')
+    event_data = _plotly_chart(fig, "residue categories by bin", use_container_width=True, on_select='rerun')
     # st.write(event_data)
     
     # Return the clicked frame if any bar was clicked
@@ -268,7 +340,7 @@ def show_frame_details(result_df, selected_frame, col1, col2, col3):
         row=1, col=2
     )
 
-    col2.plotly_chart(fig_aa, use_container_width=True)
+    _plotly_chart(fig_aa, "bin amino acid composition", container=col2, use_container_width=True)
 
     # Prepare data for the category composition bar chart with 'group' as x-axis
     ref_counts = selected_df['category_ref'].value_counts().reset_index()
@@ -295,6 +367,59 @@ def show_frame_details(result_df, selected_frame, col1, col2, col3):
     )
     fig_cat.update_layout(showlegend=False)  # Hide legend to save space
 
-    col3.plotly_chart(fig_cat, use_container_width=True)
+    _plotly_chart(fig_cat, "bin category composition", container=col3, use_container_width=True)
+
+    return frame_start, frame_stop
+
+
+def plot_similarity_heatmap(scores, labels, order, title, key):
+    """
+    Plots a run x run similarity matrix (see similarity.compute_run_similarity) with rows and columns in the
+    clustered order, and the run categories as a colored strip along the top.
+
+    Args:
+        scores (np.ndarray): The (runs, runs) scores in [0, 1].
+        labels (list): 'category/run' label of each run.
+        order (np.ndarray): Display order of the runs (see similarity.cluster_order).
+        title (str): The figure title.
+        key (str): The Streamlit element key.
+
+    Returns:
+        fig (plotly.graph_objects.Figure): The figure object containing the heatmap.
+    """
+    ordered = np.asarray(scores)[np.ix_(order, order)]
+    ordered_labels = [labels[i] for i in order]
+    categories = sorted({label.split("/")[0] for label in labels})
+    category_codes = [[categories.index(label.split("/")[0]) for label in ordered_labels]]
+
+    fig = make_subplots(rows=2, cols=1, row_heights=[0.03, 0.97], shared_xaxes=True, vertical_spacing=0.01)
+    fig.add_trace(go.Heatmap(
+        z=category_codes, x=ordered_labels, y=['category'], customdata=[[label.split("/")[0] for label in ordered_labels]],
+        colorscale=px.colors.qualitative.Set2[:max(len(categories), 2)], showscale=False,
+        hovertemplate='%{x}<br>%{customdata}<extra></extra>',
+    ), row=1, col=1)
+    fig.add_trace(go.Heatmap(
+        z=ordered, x=ordered_labels, y=ordered_labels, zmin=0, zmax=1, colorscale='Viridis',
+        colorbar=dict(title='Jaccard'), hovertemplate='%{y} vs %{x}<br>Jaccard: %{z:.3f}<extra></extra>',
+    ), row=2, col=1)
+    fig.update_yaxes(autorange='reversed', row=2, col=1)
+    fig.update_yaxes(showticklabels=False, row=1, col=1)
+    fig.update_layout(title=title, height=max(500, 12 * len(labels) + 150))
 
-    return frame_start, frame_stop
\ No newline at end of file
+    _plotly_chart(fig, "run similarity", use_container_width=True, key=key)
+    return fig
+
+def render_timing_panel(record):
+    """
+    Shows the timing spans and payload sizes of a rerun (see instrumentation.py) in a collapsed expander.
+    """
+    if record is None:
+        return
+    with st.expander(f"Debug: rerun {record['rerun']} took {record['total_ms']:.0f} ms", expanded=False):
+        st.caption(f"Session {record['session_id']}")
+        spans = pd.DataFrame(record['spans'], columns=['name', 'ms'])
+        st.dataframe(spans.round({'ms': 1}), use_container_width=True, hide_index=True)
+        if record['payloads']:
+            payloads = pd.DataFrame(record['payloads'], columns=['kind', 'name', 'span', 'bytes'])
+            payloads['kB'] = payloads['bytes'] / 1024
+            st.dataframe(payloads.drop(columns='bytes').round({'kB': 1}), use_container_width=True, hide_index=True)